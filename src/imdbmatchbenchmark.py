@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding=utf-8
+__version__ = "1.0.0"
+"""
+Python script that measures how long it takes ruvsarpur.py to pick the IMDB match for a title from
+the IMDB suggestion api results, and checks that the matching picks the same result, through the same
+rule, as the original matching that made separate passes over the results for every rule.
+
+See: https://github.com/sverrirs/ruvsarpur
+
+The suggestion api results are recorded once and then replayed so that the benchmark does not depend
+on the network:
+1. Record the results for the titles in your imdb-cache.json file (created by ruvsarpur.py --refresh)
+      python imdbmatchbenchmark.py --record -i imdb-suggestions.json
+2. Replay the recorded results
+      python imdbmatchbenchmark.py -i imdb-suggestions.json --repeat 20
+"""
+
+import sys, os.path, json, time
+import argparse # Command-line argument parser
+from fuzzywuzzy import fuzz
+
+import ruvsarpur
+
+# The feature types the titles are matched against, these are the types that getImdbItemTypes() produces
+BENCHMARK_ITEM_TYPES = [
+  ['feature', 'tv movie'],
+  ['short'],
+  ['feature', 'tv special'],
+  ['mini-series', 'tv mini-series'],
+  ['tv series']
+]
+
+def parseArguments():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument("-i", "--input", help="The file containing the recorded suggestion api results",
+                                       default="imdb-suggestions.json",
+                                       type=str)
+
+  parser.add_argument("--record", help="Records the suggestion api results for the titles in the imdb cache file into the input file",
+                                  action="store_true")
+
+  parser.add_argument("--imdbcache", help="The imdb cache file to take the titles from when recording",
+                                     default=ruvsarpur.createFullConfigFileName(False, ruvsarpur.IMDB_CACHE_FILE),
+                                     type=str)
+
+  parser.add_argument("--repeat", help="The number of times each recorded title is matched",
+                                  default=10,
+                                  type=int)
+
+  return parser.parse_args()
+
+# The matching as it was before all features were computed in a single pass, kept to compare the results and timing against
+def matchImdbCandidatesMultiPass(item_title, item_year, imdb_item_types, matches):
+  num_matches = len(matches)
+  result = None
+  found_via = "Nothing"
+  item_title_lower = item_title.lower()
+
+  if 1 == sum(('l' in obj and item_title_lower == obj['l'].lower()) for obj in matches):
+    result = next((obj for obj in matches if 'l' in obj and item_title_lower == obj['l'].lower()), None)
+    found_via = "Exact primary title"
+
+  if result is None and 1 == sum(('lo' in obj and item_title_lower == obj['lo'].lower()) for obj in matches):
+    result = next((obj for obj in matches if 'lo' in obj and item_title_lower == obj['lo'].lower()), None)
+    found_via = "Exact original title"
+
+  if result is None and 1 == sum(('l' in obj and fuzz.ratio( item_title_lower, obj['l'].lower() ) > 85) for obj in matches):
+    result = next((obj for obj in matches if 'l' in obj and fuzz.ratio( item_title_lower, obj['l'].lower() ) > 85), None)
+    found_via = "Similar primary title, single match"
+
+  if result is None and 1 == sum(('lo' in obj and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > 85) for obj in matches):
+    result = next((obj for obj in matches if 'lo' in obj and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > 85), None)
+    found_via = "Similar original title, single match"
+
+  if result is None:
+    result = next((obj for obj in matches if 'l' in obj and fuzz.ratio( item_title_lower, obj['l'].lower() ) > 85 and 'q' in obj and str(obj['q']).lower() in imdb_item_types), None)
+    found_via = "Similar primary title and type, first match"
+
+  if result is None:
+    result = next((obj for obj in matches if 'lo' in obj and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > 85 and 'q' in obj and str(obj['q']).lower() in imdb_item_types), None)
+    found_via = "Similar original title and type, first match"
+
+  if result is None and not item_year is None:
+    result = next((obj for obj in matches if 'q' in obj and str(obj['q']).lower() in imdb_item_types and 'y' in obj and item_year in str(obj['y'])), None)
+    found_via = "Same type and year, first match"
+
+  if result is None and num_matches == 1:
+    result = next((obj for obj in matches if 'q' in obj and str(obj['q']).lower() in imdb_item_types), None)
+    found_via = "Only result"
+
+  return result, found_via
+
+# Downloads the suggestion api results for every title in the imdb cache file
+def recordSuggestions(imdb_cache_file_name, recording_file_name):
+  imdb_cache = ruvsarpur.getExistingJsonFile(imdb_cache_file_name)
+  if imdb_cache is None:
+    print(f"No titles to record, could not read '{imdb_cache_file_name}'")
+    return 1
+
+  recorded = []
+  titles = set()
+  for entry in imdb_cache.values():
+    year = str(entry['imdb']['year']) if not entry.get('imdb') is None and not entry['imdb'].get('year') is None else None
+    for title in (entry.get('original-title'), entry.get('series_title')):
+      if title is None or len(title) < 1 or title in titles:
+        continue
+      titles.add(title)
+      matches = ruvsarpur.fetchImdbSuggestions(title)
+      if not matches is None:
+        recorded.append({'title': title, 'year': year, 'matches': matches})
+        print(f"Recorded {len(matches)} results for '{title}'")
+
+  with open(recording_file_name, 'w', encoding='utf-8') as out_file:
+    out_file.write(json.dumps(recorded, ensure_ascii=False, indent=2*' '))
+  print(f"Recorded the results for {len(recorded)} titles in '{recording_file_name}'")
+  return 0
+
+# Times the matching function over the recorded results, returns the number of seconds taken
+def timeMatching(recorded, repeat, match_function):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    for case in recorded:
+      for imdb_item_types in BENCHMARK_ITEM_TYPES:
+        match_function(case['title'], case['year'], imdb_item_types, case['matches'])
+  return time.perf_counter() - start
+
+def replaySuggestions(recording_file_name, repeat):
+  with open(recording_file_name, 'r', encoding='utf-8') as in_file:
+    recorded = json.load(in_file)
+  if len(recorded) < 1:
+    print(f"No recorded titles in '{recording_file_name}'")
+    return 1
+
+  # Both implementations must pick the same match through the same rule
+  differences = 0
+  for case in recorded:
+    for imdb_item_types in BENCHMARK_ITEM_TYPES:
+      expected, expected_via = matchImdbCandidatesMultiPass(case['title'], case['year'], imdb_item_types, case['matches'])
+      actual, actual_via = ruvsarpur.matchImdbCandidates(case['title'], case['year'], imdb_item_types, case['matches'])
+      if expected is not actual or expected_via != actual_via:
+        differences += 1
+        print(f"'{case['title']}' {imdb_item_types}: expected {expected['id'] if not expected is None else None} ({expected_via}) but got {actual['id'] if not actual is None else None} ({actual_via})")
+
+  lookups = repeat * len(recorded) * len(BENCHMARK_ITEM_TYPES)
+  multi_pass = timeMatching(recorded, repeat, matchImdbCandidatesMultiPass)
+  single_pass = timeMatching(recorded, repeat, ruvsarpur.matchImdbCandidates)
+  print(f"{len(recorded)} titles, {lookups} lookups")
+  print(f"Multi pass:  {multi_pass:.3f}s ({1000000 * multi_pass / lookups:.1f}us per lookup)")
+  print(f"Single pass: {single_pass:.3f}s ({1000000 * single_pass / lookups:.1f}us per lookup)")
+  print(f"Differences: {differences}")
+  return 1 if differences > 0 else 0
+
+def __main():
+  args = parseArguments()
+
+  if args.record:
+    return recordSuggestions(args.imdbcache, args.input)
+
+  if not os.path.isfile(args.input):
+    print(f"The recording '{args.input}' does not exist, create it first using --record")
+    return 1
+
+  return replaySuggestions(args.input, max(1, args.repeat))
+
+# If the script file is called by itself then execute the main function
+if __name__ == '__main__':
+  sys.exit(__main())
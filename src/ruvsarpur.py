@@ -41,8 +41,8 @@ import requests # Downloading of data from HTTP
 import datetime # Formatting of date objects 
 from fuzzywuzzy import fuzz # For fuzzy string matching when trying to find programs by title or description, https://towardsdatascience.com/string-matching-with-fuzzywuzzy-e982c61f8a84
 from operator import itemgetter # For sorting the download list items https://docs.python.org/3/howto/sorting.html#operator-module-functions
+import posixpath # File names in urls
 import ntpath # Used to extract file name from path for all platforms http://stackoverflow.com/a/8384788
-import glob # Used to do partial file path matching (when searching for already downloaded files) http://stackoverflow.com/a/2225582/779521
 import uuid # Used to generate a ternary backup local filename if everything else fails.
 import platform  # To get information about if we are running on windows or not
 
@@ -50,9 +50,26 @@ import urllib.request, urllib.parse # Downloading of data from URLs (used with t
 import requests # Downloading of data from HTTP
 from requests.adapters import HTTPAdapter # For Retrying
 from requests.packages.urllib3.util.retry import Retry # For Retrying
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool # For counting connection reuse
 
 import subprocess # To execute shell commands 
-from itertools import (takewhile,repeat) # To count lines for the extremely large IMDB files 
+import http.server # Serves the video segments to ffmpeg at the limited bandwidth
+import concurrent.futures # Worker pools for performing concurrent network requests
+import threading # Locks and thread local storage for state shared by the worker pools
+import queue # Passes the output of ffmpeg from the reader thread to the supervising thread
+import random # Jitter for the retry delays
+import email.utils # To parse dates in the Retry-After header
+import mmap, struct, array, bisect # For the memory mapped index of the IMDB original titles
+import hashlib # To create file names for cached HTTP responses
+import sqlite3 # Optional database backend for the tv schedule
+import unicodedata, math # Folding and indexing of the titles searched by --find
+from collections import deque # The last lines of the ffmpeg output
+from collections import ChainMap # To present the shared series information and the episode information as a single schedule entry
+from collections.abc import Mapping
+try:
+  import fcntl # To lock files that are shared between instances of the script
+except ImportError:
+  import msvcrt # fcntl is not available on Windows
 
 # Disable SSL warnings
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -83,14 +100,54 @@ LOG_DIR="{0}/{1}".format(os.path.expanduser('~'),'.ruvsarpur')
 PREV_LOG_FILE = 'prevrecorded.log'
 # Name of the log file containing the downloaded tv schedule
 TV_SCHEDULE_LOG_FILE = 'tvschedule.json'
+# Name of the database file containing the downloaded tv schedule when the sqlite schedule store is used
+TV_SCHEDULE_DB_FILE = 'tvschedule.db'
+# Name of the database containing the search index for the tv schedule
+TV_SCHEDULE_SEARCH_DB_FILE = 'tvschedule-search.db'
 # Name of the file containing cache to imdb series and movies matches
 IMDB_CACHE_FILE = 'imdb-cache.json'
+# Name of the index file for the original titles in the IMDB title.basics.tsv file
+IMDB_TITLE_INDEX_FILE = 'imdb-originaltitles.idx'
+# Name of the database used to match titles against the IMDB title.basics.tsv file without using the IMDB api
+IMDB_TITLE_SEARCH_DB_FILE = 'imdb-titles.db'
+# Number of days before a cached IMDB match is looked up again
+IMDB_CACHE_HIT_TTL_DAYS = 180
+# Number of days before a series that could not be matched to IMDB is looked up again
+IMDB_CACHE_MISS_TTL_DAYS = 30
+# Maximum number of series stored in the IMDB cache file
+IMDB_CACHE_MAX_ENTRIES = 20000
+# Name of the directory containing the checkpoints for resuming interrupted video downloads
+RESUME_DIR = 'resume'
+# Number of seconds between the checkpoints of a video download, the segments downloaded since the last checkpoint are downloaded again when resuming
+RESUME_CHECKPOINT_INTERVAL_SECONDS = 10
+# Number of days between full refreshes of the tv schedule when using incremental refreshes
+FULL_REFRESH_INTERVAL_DAYS = 7
+# Name of the directory containing the cached responses from the RUV program API
+HTTP_CACHE_DIR = 'httpcache'
+# Cached responses that have not been used for this many days are evicted
+HTTP_CACHE_MAX_AGE_DAYS = 30
+# When the cache grows beyond this size the least recently used responses are evicted
+HTTP_CACHE_MAX_SIZE_MB = 256
+# Name of the file containing the listings of the output folders
+OUTPUT_INVENTORY_FILE = 'output-inventory.json'
+# Name of the file containing the cached results of searches performed with the RUV GraphQL api
+VOD_SEARCH_CACHE_FILE = 'search-cache.json'
+# Cached search results are used for this many minutes before the search is performed again
+VOD_SEARCH_CACHE_MAX_AGE_MINUTES = 60
+# The minimum number of series that are requested concurrently when series found by --find or --sid are added to the schedule
+SEARCH_SERIES_WORKERS = 4
+# Number of times a stalled ffmpeg download is restarted before giving up
+FFMPEG_STALL_RETRIES = 2
+# Number of the last lines of ffmpeg output that are kept to show when ffmpeg fails
+FFMPEG_OUTPUT_TAIL_LINES = 200
+# Name of the directory where running instances register themselves to share the bandwidth limit
+BANDWIDTH_LEASE_DIR = 'bandwidth'
 
 # The available bitrate streams
 QUALITY_BITRATE = {
-    "Normal"  : { 'code': "1200", 'bits': "1150000", 'chunk_size':1500000},
-    "HD720"   : { 'code': "2400", 'bits': "2350000", 'chunk_size':2800000},
-    "HD1080"  : { 'code': "3600", 'bits': "3550000", 'chunk_size':4000000}
+    "Normal"  : { 'code': "1200", 'bits': "1150000", 'chunk_size':1500000, 'height': None},
+    "HD720"   : { 'code': "2400", 'bits': "2350000", 'chunk_size':2800000, 'height': 720},
+    "HD1080"  : { 'code': "3600", 'bits': "3550000", 'chunk_size':4000000, 'height': 1080}
 }
 
 MONTH_NAMES = ['', 'jan', 'feb', 'mar', 'apr', 'maí', 'jún', 'júl', 'ágú', 'sep', 'okt', 'nóv', 'des']
@@ -107,11 +164,24 @@ RE_VOD_BASE_URL = re.compile(r'(?P<vodbase>.*)\/(?P<rest>.*\.m3u8)', re.IGNORECA
 
 RUV_URL = 'https://ruv-vod.akamaized.net'
 
-# Function to count lines in very large files efficiently, see: https://stackoverflow.com/a/27517681/779521
-def countLinesInFile(filename):
-    with open(filename, 'rb') as f:
-      bufgen = takewhile(lambda x: x, (f.raw.read(1024*1024) for _ in repeat(None)))
-      return sum( buf.count(b'\n') for buf in bufgen if buf )
+# The key=value lines written by ffmpeg -progress
+RE_FFMPEG_PROGRESS_LINE = re.compile(r'^(?P<key>[a-z_0-9]+)=(?P<value>.*)$')
+
+# Default headers used when requesting playlists and video segments from the VOD servers
+VOD_REQUEST_HEADERS = {'User-Agent':'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.132 Safari/537.36'}
+
+# Progress bars are redrawn in place and are turned off when multiple shows are downloaded at the same time
+SHOW_PROGRESS_BARS = True
+
+# Set when the user interrupts a run with concurrent downloads so that the downloads running on other threads stop as well
+DOWNLOADS_CANCELLED = threading.Event()
+
+# Serializes updates to the list of previously recorded shows
+PREVIOUSLY_RECORDED_LOCK = threading.Lock()
+
+# Local file names that are being downloaded to but may not exist on disk yet
+RESERVED_LOCAL_FILE_NAMES = set()
+RESERVED_LOCAL_FILE_NAMES_LOCK = threading.Lock()
 
 # Checks to see if a file is older than a specific timedelta
 # See: https://stackoverflow.com/a/65412797/779521
@@ -128,6 +198,8 @@ def isFileOlderThan(file, delta):
 # Print console progress bar
 # http://stackoverflow.com/a/34325723
 def printProgress (iteration, total, prefix = '', suffix = '', decimals = 1, barLength = 100, color = True):
+  if not SHOW_PROGRESS_BARS:
+    return
   try:
     """
     Call in a loop to create terminal progress bar
@@ -153,6 +225,11 @@ def printProgress (iteration, total, prefix = '', suffix = '', decimals = 1, bar
   except: 
     pass # Ignore all errors when printing progress
 
+# Ends the line of a progress bar so that the subsequent prints do not end up in the same line
+def endProgress():
+  if SHOW_PROGRESS_BARS:
+    sys.stdout.write('\n')
+
 
 # Performs an optimistic lookup for the movie or show data based on its original title 
 # returns back enhancement information that can be used in PLEX to improve matching to official resources
@@ -193,7 +270,36 @@ def lookupItemInIMDB(item_title, item_year, item_type, sample_duration_sec, tota
   if item_title is None or len(item_title) < 1:
     return None
 
-  # Determine the feature type to favor
+  imdb_item_types = getImdbItemTypes(item_type, sample_duration_sec, total_episode_num)
+
+  # Match against the local IMDB title index first, the suggestion api is only used when the title cannot be matched offline.
+  # The local index returns every title containing the words, without the popularity ordering of the suggestion api, so a match is 
+  # only trusted if it is the only title left after comparing the titles, types, years and runtimes. 
+  # The offline matches have no actors or image as those are not in the title.basics.tsv file
+  if not IMDB_TITLE_SEARCH_INDEX is None:
+    matches = IMDB_TITLE_SEARCH_INDEX.findCandidates(item_title, item_year)
+    runtime_minutes = sample_duration_sec / 60 if sample_duration_sec > 0 else None
+    result, found_via = matchImdbCandidates(item_title, item_year, imdb_item_types, matches, unambiguous_only=True, runtime_minutes=runtime_minutes)
+    IMDB_TITLE_SEARCH_INDEX.countLookup(not result is None)
+    if not result is None:
+      return createImdbLookupResult(result, found_via + " (offline)")
+
+  matches = fetchImdbSuggestions(item_title)
+  if matches is None:
+    return None
+
+  # Augment the remaining matches with their original titles from the titles cache if it is available
+  if not imdb_orignal_titles is None and len(imdb_orignal_titles) > 0:
+    for m in matches:
+      org_title = imdb_orignal_titles[m['id']] if m['id'] in imdb_orignal_titles else None
+      if not org_title is None:
+        m['lo'] = org_title
+
+  result, found_via = matchImdbCandidates(item_title, item_year, imdb_item_types, matches)
+  return createImdbLookupResult(result, found_via)
+
+# Determine the IMDB feature types to favor for the RUV program type
+def getImdbItemTypes(item_type, sample_duration_sec, total_episode_num):
   imdb_item_types = ['feature'] # Default
 
   # According to the oscars website > A short film is defined as an original motion picture that has a running time of 40 minutes or less, including all credits.
@@ -207,9 +313,12 @@ def lookupItemInIMDB(item_title, item_year, item_type, sample_duration_sec, tota
     # One definition > Limited series last longer, usually between 6 and 12 episodes, while a miniseries is typically 4-6 episodes, sometimes broadcast in blocks of two to create more of an event for the viewer.
     #   > A miniseries always has a predetermined number of episodes while a series is developed to continue for several seasons.
     imdb_item_types = ['mini-series', 'tv mini-series'] if total_episode_num > 1 and total_episode_num <= 6 else ['tv series']
-  
+  return imdb_item_types
+
+# Searches for the title with the IMDB suggestion api, returns the matches in the format described above or None if nothing was found
+def fetchImdbSuggestions(item_title):
   try:
-    r = __create_retry_session().get(f"https://v2.sg.media-imdb.com/suggestion/x/{urllib.parse.quote(item_title)}.json?includeVideos=1")
+    r = getHttpSession().get(f"https://v2.sg.media-imdb.com/suggestion/x/{urllib.parse.quote(item_title)}.json?includeVideos=1")
     if( r.status_code != 200 ): 
       return None # If the status is not success then terminate
   except:
@@ -225,65 +334,149 @@ def lookupItemInIMDB(item_title, item_year, item_type, sample_duration_sec, tota
   # We remove all matches that do not have a covery photo, unlikely that it is going to be a great match
   # also remove matches that do not have any actors starring in it
   matches = [obj for obj in data['d'] if 'i' in obj and 'q' in obj and 's' in obj and len(obj['s']) > 2 and str(obj['id']).startswith('tt')]
-  num_matches = len(matches)
-  if num_matches <= 0:
+  if len(matches) <= 0:
     return None
-
-  # Augment the remaining matches with their original titles from the titles cache if it is available
-  if not imdb_orignal_titles is None and len(imdb_orignal_titles) > 0:
-    for m in matches:
-      org_title = imdb_orignal_titles[m['id']] if m['id'] in imdb_orignal_titles else None
-      if not org_title is None:
-        m['lo'] = org_title
-
+  return matches
+
+# Titles that are more similar than this, as measured by fuzz.ratio, are considered to be the same title
+IMDB_SIMILAR_TITLE_RATIO = 85
+
+# The features of an IMDB candidate that the matching rules use, each candidate is scored as a combination of these flags
+IMDB_EXACT_TITLE = 1
+IMDB_EXACT_ORIGINAL_TITLE = 2
+IMDB_SIMILAR_TITLE = 4
+IMDB_SIMILAR_ORIGINAL_TITLE = 8
+IMDB_SAME_TYPE = 16
+IMDB_SAME_YEAR = 32
+IMDB_SAME_RUNTIME = 64
+
+# The runtime of a candidate is considered to be the same as the duration of the item if they differ by less than this fraction of the 
+# runtime, or by less than the minimum number of minutes for short runtimes. The VOD durations include filler before and after the content
+IMDB_SAME_RUNTIME_TOLERANCE = 0.15
+IMDB_SAME_RUNTIME_MIN_MINUTES = 5
+
+# Scores all the candidates in a single pass over the matches, returns a list with the feature flags for each match in the same order
+# The fuzzy title similarities are the most expensive features and are only added, by scoreImdbCandidateSimilarities, if they are needed
+# Only the offline matches have a runtime, it is compared to runtime_minutes when that is known
+def scoreImdbCandidates(item_title_lower, item_year, imdb_item_types, matches, runtime_minutes=None):
+  scores = []
+  for obj in matches:
+    score = 0
+    if 'l' in obj and item_title_lower == obj['l'].lower():
+      score |= IMDB_EXACT_TITLE | IMDB_SIMILAR_TITLE
+    if 'lo' in obj and item_title_lower == obj['lo'].lower():
+      score |= IMDB_EXACT_ORIGINAL_TITLE | IMDB_SIMILAR_ORIGINAL_TITLE
+    if 'q' in obj and str(obj['q']).lower() in imdb_item_types:
+      score |= IMDB_SAME_TYPE
+    if not item_year is None and 'y' in obj and item_year in str(obj['y']):
+      score |= IMDB_SAME_YEAR
+    if not runtime_minutes is None and not obj.get('runtime') is None and abs(obj['runtime'] - runtime_minutes) <= max(IMDB_SAME_RUNTIME_MIN_MINUTES, obj['runtime'] * IMDB_SAME_RUNTIME_TOLERANCE):
+      score |= IMDB_SAME_RUNTIME
+    scores.append(score)
+  return scores
+
+# Adds the fuzzy title similarities to the scores, titles that are an exact match are already known to be similar
+def scoreImdbCandidateSimilarities(item_title_lower, matches, scores):
+  for index, obj in enumerate(matches):
+    if 'l' in obj and not scores[index] & IMDB_EXACT_TITLE and fuzz.ratio( item_title_lower, obj['l'].lower() ) > IMDB_SIMILAR_TITLE_RATIO:
+      scores[index] |= IMDB_SIMILAR_TITLE
+    if 'lo' in obj and not scores[index] & IMDB_EXACT_ORIGINAL_TITLE and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > IMDB_SIMILAR_TITLE_RATIO:
+      scores[index] |= IMDB_SIMILAR_ORIGINAL_TITLE
+
+# Returns the first match that has all the features, or if single is set the match only if it is the only one that has them
+def pickImdbCandidate(matches, scores, features, single=False):
+  picked = None
+  for obj, score in zip(matches, scores):
+    if score & features == features:
+      if not single:
+        return obj
+      if not picked is None:
+        return None
+      picked = obj
+  return picked
+
+# Returns the only match that has all the features. When several matches have them they are narrowed down to the ones of the same type,
+# then the same year and then the same runtime, a narrowing that leaves no matches is skipped. Returns None if more than one match is left
+def pickUnambiguousImdbCandidate(matches, scores, features):
+  picked = [(obj, score) for obj, score in zip(matches, scores) if score & features == features]
+  for feature in (IMDB_SAME_TYPE, IMDB_SAME_YEAR, IMDB_SAME_RUNTIME):
+    if len(picked) <= 1:
+      break
+    narrowed = [(obj, score) for obj, score in picked if score & feature]
+    if len(narrowed) > 0:
+      picked = narrowed
+  return picked[0][0] if len(picked) == 1 else None
+
+# Picks the best match for the title, the matches are in the suggestion api format with the original title in 'lo' when it is known. 
+# Returns the match and a description of the rule that picked it, or None if no rule picked a match. 
+# With unambiguous_only a title rule only picks a match if it is the only one left after breaking ties on the type, year and runtime 
+# (see pickUnambiguousImdbCandidate) and the rules that pick the first of several matches are skipped
+def matchImdbCandidates(item_title, item_year, imdb_item_types, matches, unambiguous_only=False, runtime_minutes=None):
+  num_matches = len(matches)
   result = None
   found_via = "Nothing"
   item_title_lower = item_title.lower()
+  scores = scoreImdbCandidates(item_title_lower, item_year, imdb_item_types, matches, runtime_minutes)
+
+  def pickSingle(features):
+    if unambiguous_only:
+      return pickUnambiguousImdbCandidate(matches, scores, features)
+    return pickImdbCandidate(matches, scores, features, single=True)
 
   # If there is an single exact name match for primary title, we pick that
-  if 1 == sum(('l' in obj and item_title_lower == obj['l'].lower()) for obj in matches):
-    result = next((obj for obj in matches if 'l' in obj and item_title_lower == obj['l'].lower()), None)
+  result = pickSingle(IMDB_EXACT_TITLE)
+  if not result is None:
     found_via = "Exact primary title"
 
-  if result is None and 1 == sum(('lo' in obj and item_title_lower == obj['lo'].lower()) for obj in matches):
-    result = next((obj for obj in matches if 'lo' in obj and item_title_lower == obj['lo'].lower()), None)
-    found_via = "Exact original title"
+  if result is None:
+    result = pickSingle(IMDB_EXACT_ORIGINAL_TITLE)
+    if not result is None:
+      found_via = "Exact original title"
 
   # Special case for icelandic movies, they are extremly likely to be the first result if searched by the icelandic name
   #if isIcelandic and item_type == 'movie':
   #  result = matches[0]
   #  found_via = "First match (Icelandic Movie)"
 
+  if result is None:
+    scoreImdbCandidateSimilarities(item_title_lower, matches, scores)
+
   # If there is a single slightly fuzzy name match, we pick that
-  if result is None and 1 == sum(('l' in obj and fuzz.ratio( item_title_lower, obj['l'].lower() ) > 85) for obj in matches):
-    result = next((obj for obj in matches if 'l' in obj and fuzz.ratio( item_title_lower, obj['l'].lower() ) > 85), None)
-    found_via = "Similar primary title, single match"
+  if result is None:
+    result = pickSingle(IMDB_SIMILAR_TITLE)
+    if not result is None:
+      found_via = "Similar primary title, single match"
   
   # If there is a single slightly fuzzy name match, we pick that
-  if result is None and 1 == sum(('lo' in obj and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > 85) for obj in matches):
-    result = next((obj for obj in matches if 'lo' in obj and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > 85), None)
-    found_via = "Similar original title, single match"
+  if result is None:
+    result = pickSingle(IMDB_SIMILAR_ORIGINAL_TITLE)
+    if not result is None:
+      found_via = "Similar original title, single match"
 
   # Attempt to find a match in the list with a similar name and type
-  if result is None:
-    result = next((obj for obj in matches if 'l' in obj and fuzz.ratio( item_title_lower, obj['l'].lower() ) > 85 and 'q' in obj and str(obj['q']).lower() in imdb_item_types), None)
+  if result is None and not unambiguous_only:
+    result = pickImdbCandidate(matches, scores, IMDB_SIMILAR_TITLE | IMDB_SAME_TYPE)
     found_via = "Similar primary title and type, first match"
 
   # Attempt to find a match in the list with a similar name and type
-  if result is None:
-    result = next((obj for obj in matches if 'lo' in obj and fuzz.ratio( item_title_lower, obj['lo'].lower() ) > 85 and 'q' in obj and str(obj['q']).lower() in imdb_item_types), None)
+  if result is None and not unambiguous_only:
+    result = pickImdbCandidate(matches, scores, IMDB_SIMILAR_ORIGINAL_TITLE | IMDB_SAME_TYPE)
     found_via = "Similar original title and type, first match"
 
   # Still no match, attempt to find one with a matching year if it is specified
-  if result is None and not item_year is None: 
-    result = next((obj for obj in matches if 'q' in obj and str(obj['q']).lower() in imdb_item_types and 'y' in obj and item_year in str(obj['y'])), None)
+  if result is None and not item_year is None and not unambiguous_only: 
+    result = pickImdbCandidate(matches, scores, IMDB_SAME_TYPE | IMDB_SAME_YEAR)
     found_via = "Same type and year, first match"
 
   # If there is only a single element in the list then it is likely to be it, for Icelandic movies this is very often the case
-  if result is None and num_matches == 1:
-    result = next((obj for obj in matches if 'q' in obj and str(obj['q']).lower() in imdb_item_types), None)
+  if result is None and num_matches == 1 and not unambiguous_only:
+    result = pickImdbCandidate(matches, scores, IMDB_SAME_TYPE)
     found_via = "Only result"
 
+  return result, found_via
+
+# Creates the imdb information stored with the schedule for the match
+def createImdbLookupResult(result, found_via):
   # If not a movie or short film then exit
   if result is None:
     return None
@@ -363,17 +556,18 @@ def downloadSubtitlesFiles(subtitles, local_video_filename, video_display_title,
 # From: http://stackoverflow.com/a/16696317
 def download_file(url, local_filename, display_title, keeppartial = False ):
   try:
-    # NOTE the stream=True parameter
-    r = __create_retry_session().get(url, stream=True)
-    
-    # If the status is not success then terminate
-    if( r.status_code != 200 ):
-      return None
+    # NOTE the stream=True parameter, the with block ensures the connection is returned to the pool even if the body is not read
+    with getHttpSession().get(url, stream=True) as r:
     
-    with open(local_filename, 'wb') as f:
-      for chunk in r.iter_content(chunk_size=1024): 
-        if chunk: # filter out keep-alive new chunks
-          f.write(chunk)
+      # If the status is not success then terminate
+      if( r.status_code != 200 ):
+        return None
+      
+      with open(local_filename, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=1024): 
+          if chunk: # filter out keep-alive new chunks
+            throttleTransfer(len(chunk))
+            f.write(chunk)
     
     return local_filename
   except Exception as ex:
@@ -389,26 +583,386 @@ def download_file(url, local_filename, display_title, keeppartial = False ):
         raise
     raise
 
-# Creates a new retry session for the HTTP protocol
+# Counters for the connections handed out by the shared HTTP connection pool, 
+# 'requested' counts every connection checked out of the pool and 'opened' the ones that required a new TCP+TLS handshake
+HTTP_POOL_STATS = {'requested': 0, 'opened': 0}
+HTTP_POOL_STATS_LOCK = threading.Lock()
+
+def countHttpPoolConnection(stat_name):
+  with HTTP_POOL_STATS_LOCK:
+    HTTP_POOL_STATS[stat_name] += 1
+
+# Connection pools that count how often a connection is reused vs. opened
+# urllib3 calls _get_conn for every request and _new_conn only when no idle keep-alive connection is available for the host
+class ConnectionCountingMixin:
+  def _get_conn(self, timeout=None):
+    countHttpPoolConnection('requested')
+    return super()._get_conn(timeout)
+
+  def _new_conn(self):
+    countHttpPoolConnection('opened')
+    return super()._new_conn()
+
+class CountingHTTPConnectionPool(ConnectionCountingMixin, HTTPConnectionPool):
+  pass
+
+class CountingHTTPSConnectionPool(ConnectionCountingMixin, HTTPSConnectionPool):
+  pass
+
+class PooledHTTPAdapter(HTTPAdapter):
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+# Creates a new retry adapter for the HTTP protocol, the adapter owns one keep-alive connection pool per host
+# Without retry_responses only the connection attempts are retried, read errors and error responses are left to the caller
 # See: https://www.peterbe.com/plog/best-practice-with-retries-with-requests
-def __create_retry_session(retries=5):
-  session = requests.Session()
+def __create_retry_adapter(retries=5, pool_maxsize=10, retry_responses=True):
   retry = Retry(
     total=retries,
-    read=retries,
+    read=retries if retry_responses else False,
     connect=retries,
     backoff_factor=0.3,
-    status_forcelist=(500, 502, 504))
-  adapter = HTTPAdapter(max_retries=retry)
-  session.mount('http://', adapter)
-  session.mount('https://', adapter)
+    status_forcelist=(500, 502, 504) if retry_responses else ())
+  return PooledHTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=pool_maxsize)
+
+# The process wide adapters shared by all sessions, see configureHttpPool(). The api adapter is used by clients that retry failed requests themselves
+HTTP_ADAPTER = None
+HTTP_API_ADAPTER = None
+HTTP_ADAPTER_LOCK = threading.RLock()
+HTTP_SESSIONS = threading.local()
+
+# (Re)creates the process wide connection pool, pool_maxsize controls how many connections are kept alive per host
+def configureHttpPool(pool_maxsize=10, retries=5):
+  global HTTP_ADAPTER, HTTP_API_ADAPTER
+  with HTTP_ADAPTER_LOCK:
+    for adapter in (HTTP_ADAPTER, HTTP_API_ADAPTER):
+      if not adapter is None:
+        adapter.close()
+    HTTP_ADAPTER = __create_retry_adapter(retries, pool_maxsize)
+    HTTP_API_ADAPTER = __create_retry_adapter(retries, pool_maxsize, retry_responses=False)
+
+# Returns the HTTP session for the calling thread. Sessions are not shared between threads (their cookie jars are not thread safe)
+# but all of them are mounted on the same adapter and therefore share the same thread safe connection pools. 
+# Without retry_responses the session only retries failed connection attempts, for clients that retry failed requests themselves
+def getHttpSession(retry_responses=True):
+  session_name = 'session' if retry_responses else 'api_session'
+  session = getattr(HTTP_SESSIONS, session_name, None)
+  if session is None or not session.get_adapter('https://') is (HTTP_ADAPTER if retry_responses else HTTP_API_ADAPTER):
+    with HTTP_ADAPTER_LOCK:
+      if HTTP_ADAPTER is None:
+        configureHttpPool()
+      adapter = HTTP_ADAPTER if retry_responses else HTTP_API_ADAPTER
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # API responses are counted against the bandwidth limit, streamed downloads are throttled while they are read
+    session.hooks['response'].append(throttleHttpResponse)
+    setattr(HTTP_SESSIONS, session_name, session)
   return session
 
+def printHttpPoolStats():
+  with HTTP_POOL_STATS_LOCK:
+    requested = HTTP_POOL_STATS['requested']
+    opened = HTTP_POOL_STATS['opened']
+  if requested <= 0:
+    return
+  print("{0} | {1} requests, {2} connections opened, {3} reused".format(color_info('HTTP connections'), requested, opened, requested - opened))
+
+# Parses a rate such as 500K, 20M or 1.5G into bytes per second, 0 means unlimited
+def parseTransferRate(rate_text):
+  rate_text = rate_text.strip().upper()
+  multiplier = {'K': 1024, 'M': 1024*1024, 'G': 1024*1024*1024}.get(rate_text[-1:], 1)
+  if multiplier > 1:
+    rate_text = rate_text[:-1]
+  return float(rate_text) * multiplier
+
+# Parses the --maxrate value, a comma separated list of rates where each rate can be limited to a time of day, e.g. "00:00-07:00=0,20M"
+# is unlimited at night and 20 MB/s during the day. Returns a list of (start minute, end minute, bytes per second) tuples with the 
+# rate without a time window last (covering the whole day)
+def parseMaxRateSchedule(max_rate_text):
+  rate_schedule = []
+  default_rate = 0
+  for entry in max_rate_text.split(','):
+    if '=' in entry:
+      window, rate_text = entry.split('=', 1)
+      start_text, end_text = window.split('-', 1)
+      start_minute, end_minute = [int(t.strip().split(':')[0]) * 60 + int(t.strip().split(':')[1]) for t in (start_text, end_text)]
+      rate_schedule.append((start_minute, end_minute, parseTransferRate(rate_text)))
+    else:
+      default_rate = parseTransferRate(entry)
+  rate_schedule.append((0, 24*60, default_rate))
+  return rate_schedule
+
+# Limits the bandwidth used by all downloads and API calls. Transfers reserve time on a shared clock in the order they ask for it so 
+# concurrent transfers that read in similar chunks get an equal share. Instances of the script running at the same time register 
+# themselves in the lease directory and split the rate evenly between them
+class BandwidthLimiter:
+  # Seconds of unused bandwidth that can be used in a burst
+  BURST_SECONDS = 1.0
+  # Instances that have not renewed their lease within this many seconds are not counted anymore
+  LEASE_TIMEOUT_SECONDS = 15
+  LEASE_RENEW_SECONDS = 5
+
+  def __init__(self, rate_schedule, lease_dir=None):
+    self.rate_schedule = rate_schedule
+    self.lease_dir = lease_dir
+    self.lease_file_name = os.path.join(lease_dir, "{0}.lease".format(os.getpid())) if not lease_dir is None else None
+    self.lease_renewed = 0
+    self.running_instances = 1
+    self.next_free_time = time.monotonic()
+    self.lock = threading.Lock()
+    self.lease_lock = threading.Lock()
+
+  # The rate for the time of day shared with the other running instances, 0 means unlimited
+  def currentRate(self):
+    now = datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start_minute, end_minute, rate in self.rate_schedule:
+      # Windows such as 22:00-06:00 wrap around midnight
+      if (start_minute <= minute < end_minute) if start_minute <= end_minute else (minute >= start_minute or minute < end_minute):
+        break
+    return rate / self.running_instances
+
+  # Counts the running instances, the lease directory is scanned by one thread at a time without blocking the other transfers
+  def renewLease(self):
+    if self.lease_file_name is None or time.monotonic() - self.lease_renewed < self.LEASE_RENEW_SECONDS:
+      return
+    if not self.lease_lock.acquire(blocking=False):
+      return
+    try:
+      if time.monotonic() - self.lease_renewed >= self.LEASE_RENEW_SECONDS:
+        self.__scanLeases()
+    finally:
+      self.lease_lock.release()
+
+  def __scanLeases(self):
+    self.lease_renewed = time.monotonic()
+    try:
+      os.makedirs(self.lease_dir, exist_ok=True)
+      Path(self.lease_file_name).touch()
+      running_instances = 0
+      for lease in os.scandir(self.lease_dir):
+        age = time.time() - lease.stat().st_mtime
+        if age < self.LEASE_TIMEOUT_SECONDS:
+          running_instances += 1
+        elif age > 3600:
+          # Left behind by an instance that did not exit cleanly
+          os.remove(lease.path)
+      self.running_instances = max(1, running_instances)
+    except OSError:
+      self.running_instances = 1
+
+  # Waits until the number of bytes can be transferred without going over the rate limit
+  def consume(self, nbytes):
+    self.renewLease()
+    with self.lock:
+      rate = self.currentRate()
+      if rate <= 0:
+        return
+      now = time.monotonic()
+      self.next_free_time = max(self.next_free_time, now - self.BURST_SECONDS) + nbytes / rate
+      wait_seconds = self.next_free_time - now
+    if wait_seconds > 0:
+      time.sleep(wait_seconds)
+
+  def close(self):
+    try:
+      if not self.lease_file_name is None and os.path.isfile(self.lease_file_name):
+        os.remove(self.lease_file_name)
+    except OSError:
+      pass
+
+BANDWIDTH_LIMITER = None
+
+def throttleTransfer(nbytes):
+  if not BANDWIDTH_LIMITER is None:
+    BANDWIDTH_LIMITER.consume(nbytes)
+
+def throttleHttpResponse(response, *args, **kwargs):
+  if not BANDWIDTH_LIMITER is None and not kwargs.get('stream', False):
+    throttleTransfer(len(response.content))
+
+# Serves the video segments to ffmpeg from localhost while the bandwidth is limited. ffmpeg cannot be throttled from the outside so the 
+# playlist that ffmpeg reads points to this proxy instead, the proxy downloads the segments over the shared connection pool and hands them 
+# to ffmpeg chunk by chunk at the rate the BandwidthLimiter allows. The rate therefore follows the time of day and the number of running 
+# instances during the download, the same as for the native download engine. Only the urls of the playlists being downloaded are served
+class ThrottledSegmentProxy:
+  def __init__(self):
+    self.urls = []
+    self.url_ids = {}
+    self.lock = threading.Lock()
+    proxy = self
+
+    class SegmentRequestHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        url_id = self.path.lstrip('/').split('/')[0]
+        with proxy.lock:
+          url = proxy.urls[int(url_id)] if url_id.isdigit() and int(url_id) < len(proxy.urls) else None
+        if url is None:
+          self.send_error(404)
+          return
+        try:
+          with getHttpSession().get(url, timeout=30, verify=False, headers=VOD_REQUEST_HEADERS, stream=True) as r:
+            self.send_response(r.status_code)
+            if 'Content-Length' in r.headers:
+              self.send_header('Content-Length', r.headers['Content-Length'])
+            self.end_headers()
+            for chunk in r.iter_content(chunk_size=64*1024):
+              throttleTransfer(len(chunk))
+              self.wfile.write(chunk)
+        except requests.exceptions.RequestException:
+          self.send_error(502)
+        except (BrokenPipeError, ConnectionResetError):
+          pass # ffmpeg stopped reading the segment
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SegmentRequestHandler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  # Returns the local url that serves the url through the proxy, the local url ends with the same file name so that ffmpeg sees the same file type
+  def createUrl(self, url):
+    with self.lock:
+      url_id = self.url_ids.get(url)
+      if url_id is None:
+        url_id = self.url_ids[url] = len(self.urls)
+        self.urls.append(url)
+    return "http://127.0.0.1:{0}/{1}/{2}".format(self.server.server_address[1], url_id, urllib.parse.quote(posixpath.basename(urllib.parse.urlparse(url).path)))
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+THROTTLED_SEGMENT_PROXY = None
+THROTTLED_SEGMENT_PROXY_LOCK = threading.Lock()
+
+# Returns the proxy that ffmpeg downloads should use, None when the bandwidth is not limited
+def getThrottledSegmentProxy():
+  global THROTTLED_SEGMENT_PROXY
+  if BANDWIDTH_LIMITER is None:
+    return None
+  with THROTTLED_SEGMENT_PROXY_LOCK:
+    if THROTTLED_SEGMENT_PROXY is None:
+      THROTTLED_SEGMENT_PROXY = ThrottledSegmentProxy()
+    return THROTTLED_SEGMENT_PROXY
+
+#
+# Persistent cache of HTTP responses that are revalidated using conditional GET requests
+# Each response is stored in a separate file named after the hash of its url, the file contains the ETag and 
+# Last-Modified headers of the response and the schedule that was parsed from it. The modification time of the 
+# file is updated every time the response is used and is used for the eviction of old entries.
+class HttpResponseCache:
+  # Increase when the schedule parsed from the responses changes (see parseVodSeriesSchedule and normalizeSchedule), 
+  # entries stored with a different version are treated as not cached so that the responses are downloaded and parsed again
+  FORMAT_VERSION = 1
+
+  def __init__(self, cache_dir, max_age_days=HTTP_CACHE_MAX_AGE_DAYS, max_size_mb=HTTP_CACHE_MAX_SIZE_MB):
+    self.cache_dir = cache_dir
+    self.max_age = datetime.timedelta(days=max_age_days)
+    self.max_size = max_size_mb * 1024 * 1024
+    self.stats = {'hits': 0, 'misses': 0}
+    self.stats_lock = threading.Lock()
+
+  def __entryFileName(self, url):
+    return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+  # Returns the cached entry for the url or None if nothing usable is cached
+  def load(self, url):
+    try:
+      with open(self.__entryFileName(url), 'r', encoding='utf-8') as in_file:
+        entry = json.load(in_file)
+      return entry if entry.get('url') == url and entry.get('format') == self.FORMAT_VERSION else None
+    except Exception:
+      return None
+
+  # Creates the request headers needed to revalidate the entry with the server
+  @staticmethod
+  def createConditionalHeaders(entry):
+    headers = {}
+    if entry is None:
+      return headers
+    if entry.get('etag') is not None:
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified') is not None:
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+  # Stores the response and the data parsed from it, responses that cannot be revalidated are not stored
+  def store(self, url, response, parsed):
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag is None and last_modified is None:
+      return
+
+    entry = {'url': url, 'format': self.FORMAT_VERSION, 'etag': etag, 'last_modified': last_modified, 'parsed': parsed}
+    try:
+      writeFileAtomically(self.__entryFileName(url), lambda out_file: out_file.write(json.dumps(entry, ensure_ascii=False)))
+    except Exception as ex:
+      print(f"Could not store cached response for '{url}', {ex}")
+
+  # Marks the cached entry as used, this pushes back its eviction
+  def touch(self, url):
+    try:
+      os.utime(self.__entryFileName(url))
+    except OSError:
+      pass
+
+  def countHit(self):
+    with self.stats_lock:
+      self.stats['hits'] += 1
+
+  def countMiss(self):
+    with self.stats_lock:
+      self.stats['misses'] += 1
+
+  # Removes entries that have not been used within the max age and then the least recently used entries until the cache is within its max size
+  def evict(self):
+    if not os.path.isdir(self.cache_dir):
+      return
+
+    cutoff = time.time() - self.max_age.total_seconds()
+    entries = []
+    for dir_entry in os.scandir(self.cache_dir):
+      if not dir_entry.is_file():
+        continue
+      try:
+        stat = dir_entry.stat()
+        if stat.st_mtime < cutoff or dir_entry.name.endswith('.tmp'):
+          os.remove(dir_entry.path)
+        else:
+          entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+      except OSError:
+        continue
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total_size <= self.max_size:
+        break
+      try:
+        os.remove(path)
+        total_size -= size
+      except OSError:
+        continue
+
+  def printStats(self):
+    with self.stats_lock:
+      hits = self.stats['hits']
+      misses = self.stats['misses']
+    if hits + misses <= 0:
+      return
+    print("{0} | {1} not modified, {2} downloaded ({3:.0f}% hit rate)".format(color_info('Program cache'), hits, misses, 100.0 * hits / (hits + misses)))
+
+# The cache used for the RUV program API, see runMain()
+HTTP_RESPONSE_CACHE = None
+
 # Attempts to discover the correct playlist file
 def find_m3u8_playlist_url(item, display_title, video_quality):
   
   # use default headers
-  headers = {'User-Agent':'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.132 Safari/537.36'}
+  headers = VOD_REQUEST_HEADERS
 
   # Store the program id
   pid = item['pid']
@@ -433,32 +987,51 @@ def find_m3u8_playlist_url(item, display_title, video_quality):
   #       3600/index.m3u8
 
   url_first_file = item['vod_url_full']
+  url_formatted = url_first_file
+  target_bandwidth = int(QUALITY_BITRATE[video_quality]['bits'])
 
   try:
     # Perform the first get
-    request = __create_retry_session().get(url_first_file, stream=False, timeout=5, verify=False, headers=headers)
+    request = getHttpSession().get(url_first_file, stream=False, timeout=5, verify=False, headers=headers)
     if request is None or not request.status_code == 200 or len(request.text) <= 0:
       print( "{0} not found on server (first file, pid={1}, url={2})".format(color_title(display_title), pid, url_first_file))
       return None
 
-    # Assume the new format
-    url_formatted = '{0}/{1}/index.m3u8'.format(item['vod_url'], QUALITY_BITRATE[video_quality]['code']) 
+    if '#EXT-X-STREAM-INF' in request.text:
+      # Try the streams in the master playlist starting with the one for the requested quality
+      variants = orderM3u8Variants(parseM3u8MasterPlaylist(request.text, url_first_file), video_quality)
+
+      # Fall back to the known url formats if the master playlist could not be understood
+      if len(variants) < 1:
+        # Assume the new format
+        url_formatted = '{0}/{1}/index.m3u8'.format(item['vod_url'], QUALITY_BITRATE[video_quality]['code']) 
+        # Check if this actually is the old format
+        if request.text.find('.m3u8?tlm=hls&streams') > 0:
+          url_formatted = '{0}/asset-audio=50000-video={1}.m3u8'.format(item['vod_url'], QUALITY_BITRATE[video_quality]['bits'])       
+        variants = [{'uri': url_formatted, 'bandwidth': target_bandwidth, 'resolution': None, 'is_requested_quality': True}]
+
+      # Do the second request to get the actual stream data in the correct format
+      request = None
+      for variant in variants:
+        url_formatted = variant['uri']
+        request = getHttpSession().get(url_formatted, stream=False, timeout=5, verify=False, headers=headers)
+        if not request is None and request.status_code == 200 and len(request.text) > 0:
+          break
+        print( "{0} not found on server (second file, pid={1}, url={2})".format(color_title(display_title), pid, url_formatted))
+        request = None
 
-    # Check if this actually is the old format
-    if request.text.find('.m3u8?tlm=hls&streams') > 0:
-      url_formatted = '{0}/asset-audio=50000-video={1}.m3u8'.format(item['vod_url'], QUALITY_BITRATE[video_quality]['bits'])       
+      if request is None:
+        return None
 
-    # Do the second request to get the actual stream data in the correct format
-    request = __create_retry_session().get(url_formatted, stream=False, timeout=5, verify=False, headers=headers)
-    if request is None or not request.status_code == 200 or len(request.text) <= 0:
-      print( "{0} not found on server (second file, pid={1}, url={2})".format(color_title(display_title), pid, url_formatted))
-      return None
+      # Let the user know if the stream is not the requested quality
+      if not variant['is_requested_quality']:
+        print( "{0} | {1} is not available, using the closest stream ({2} kbps)".format(color_title(display_title), video_quality, int(variant['bandwidth']/1000)))
 
-    # Count the number of fragments in the file, used to estimate download time
-    fragments = [line.strip() for line in request.text.splitlines() if len(line) > 1 and line[0] != '#']
+    # Parse the media playlist, the segments are used to estimate the download time and are downloaded by the download engines without fetching the playlist again
+    playlist = parseM3u8MediaPlaylist(request.text, url_formatted)
 
-    # We found a playlist file, let's return the url and the fragments
-    return {'url': url_formatted, 'fragments':len(fragments)}
+    # We found a playlist file, let's return the url, the fragments and the parsed playlist
+    return {'url': url_formatted, 'fragments':len(playlist['segments']), 'playlist': playlist}
 
   except Exception as ex:
     print( "Error while discovering playlist for {1} from '{0}'".format(url_formatted, color_title(display_title)))
@@ -466,8 +1039,133 @@ def find_m3u8_playlist_url(item, display_title, video_quality):
     traceback.print_stack()
     return None
 
-# FFMPEG download of the playlist
-def download_m3u8_playlist_using_ffmpeg(ffmpegexec, playlist_url, playlist_fragments, local_filename, display_title, keeppartial, video_quality, disable_metadata, videoInfo):
+# Parses the streams available in a HLS master playlist, returns the absolute url, bandwidth and resolution of each stream
+#   #EXT-X-STREAM-INF:BANDWIDTH=4406504,CODECS="avc1.640028,mp4a.40.2",RESOLUTION=1920x1080,FRAME-RATE=25.000,AUDIO="2@48000-mp4a-0"
+#   3600/index.m3u8
+def parseM3u8MasterPlaylist(playlist_text, playlist_url):
+  variants = []
+  stream_info = None
+
+  for line in playlist_text.splitlines():
+    line = line.strip()
+    if len(line) < 1:
+      continue
+
+    if line.startswith('#EXT-X-STREAM-INF:'):
+      stream_info = {match.group('name').upper(): match.group('value').strip('"') for match in RE_M3U8_ATTRIBUTE.finditer(line[len('#EXT-X-STREAM-INF:'):])}
+    elif not line.startswith('#') and not stream_info is None:
+      try:
+        variants.append({'uri': urllib.parse.urljoin(playlist_url, line), 
+                         'bandwidth': int(stream_info.get('AVERAGE-BANDWIDTH', stream_info.get('BANDWIDTH'))),
+                         'resolution': stream_info.get('RESOLUTION')})
+      except (TypeError, ValueError):
+        pass # Streams without a bandwidth cannot be compared
+      stream_info = None
+
+  return variants
+
+# Orders the streams from a master playlist in the order they should be tried for the requested quality. The streams for the quality are
+# recognized by the quality code in their url (e.g. 3600/index.m3u8 or video=3550000 in the older format) or by their resolution, the
+# bandwidth in the playlist includes audio and overhead and is not close enough to the quality bitrate to tell the streams apart.
+# The remaining streams follow, first the highest bandwidth below the quality bitrate and then the lowest one above it.
+# Each stream is marked with 'is_requested_quality'
+def orderM3u8Variants(variants, video_quality):
+  quality = QUALITY_BITRATE[video_quality]
+  target_bandwidth = int(quality['bits'])
+
+  def isRequestedQuality(variant):
+    uri_path = urllib.parse.urlparse(variant['uri']).path
+    if '/{0}/'.format(quality['code']) in uri_path or 'video={0}'.format(quality['bits']) in uri_path:
+      return True
+    height = getGroup(RE_M3U8_RESOLUTION_HEIGHT, 'height', variant['resolution'] if not variant.get('resolution') is None else '')
+    return not quality['height'] is None and not height is None and int(height) == quality['height']
+
+  requested = []
+  below = []
+  above = []
+  for variant in variants:
+    variant['is_requested_quality'] = isRequestedQuality(variant)
+    if variant['is_requested_quality']:
+      requested.append(variant)
+    elif variant['bandwidth'] <= target_bandwidth:
+      below.append(variant)
+    else:
+      above.append(variant)
+
+  return requested + sorted(below, key=lambda variant: -variant['bandwidth']) + sorted(above, key=lambda variant: variant['bandwidth'])
+
+RE_M3U8_RESOLUTION_HEIGHT = re.compile(r'^\d+x(?P<height>\d+)$', re.IGNORECASE)
+
+# Parses a HLS media playlist, returns the absolute urls and durations of all segments, the initialization segment (fMP4 streams)
+# and if the segments are encrypted
+# ex.
+#   #EXTM3U
+#   #EXT-X-TARGETDURATION:10
+#   #EXTINF:10.000,
+#   segment-1-f1-v1-a1.ts
+def parseM3u8MediaPlaylist(playlist_text, playlist_url):
+  playlist = {'segments': [], 'map': None, 'encrypted': False, 'duration': 0.0}
+  duration = None
+  # The playlist with all the urls made absolute so that ffmpeg can read it from a local file
+  absolute_lines = []
+
+  for line in playlist_text.splitlines():
+    line = line.strip()
+    if len(line) < 1:
+      continue
+    if line.startswith('#'):
+      absolute_lines.append(RE_M3U8_URI_ATTRIBUTE.sub(lambda match: 'URI="{0}"'.format(urllib.parse.urljoin(playlist_url, match.group('uri'))), line))
+    else:
+      absolute_lines.append(urllib.parse.urljoin(playlist_url, line))
+
+    if line.startswith('#EXTINF:'):
+      try:
+        duration = float(line[len('#EXTINF:'):].split(',')[0])
+      except ValueError:
+        duration = None
+    elif line.startswith('#EXT-X-MAP:'):
+      map_uri = getGroup(RE_M3U8_URI_ATTRIBUTE, 'uri', line)
+      if not map_uri is None:
+        playlist['map'] = urllib.parse.urljoin(playlist_url, map_uri)
+    elif line.startswith('#EXT-X-KEY:'):
+      playlist['encrypted'] = playlist['encrypted'] or not 'METHOD=NONE' in line
+    elif not line.startswith('#'):
+      playlist['segments'].append({'uri': urllib.parse.urljoin(playlist_url, line), 'duration': duration})
+      playlist['duration'] += duration if not duration is None else 0.0
+      duration = None
+
+  playlist['text'] = '\n'.join(absolute_lines) + '\n'
+  return playlist
+
+# Writes the playlist next to the local file so that ffmpeg does not have to download it again, returns the name of the playlist file
+# When the bandwidth is limited the segments are downloaded through the ThrottledSegmentProxy, the encryption keys are not
+def writeLocalM3u8Playlist(playlist, local_filename):
+  playlist_text = playlist['text']
+  proxy = getThrottledSegmentProxy()
+  if not proxy is None:
+    lines = []
+    for line in playlist_text.splitlines():
+      if line.startswith('#EXT-X-MAP:'):
+        line = RE_M3U8_URI_ATTRIBUTE.sub(lambda match: 'URI="{0}"'.format(proxy.createUrl(match.group('uri'))), line)
+      elif not line.startswith('#'):
+        line = proxy.createUrl(line)
+      lines.append(line)
+    playlist_text = '\n'.join(lines) + '\n'
+
+  playlist_file_name = "{0}.m3u8".format(local_filename)
+  with open(playlist_file_name, 'w', encoding='utf-8') as out_file:
+    out_file.write(playlist_text)
+  return playlist_file_name
+
+# Extracts the URI="..." attribute from a playlist tag
+RE_M3U8_URI_ATTRIBUTE = re.compile(r'URI="(?P<uri>[^"]+)"', re.IGNORECASE)
+
+# Attributes of a playlist tag, quoted values can contain commas
+RE_M3U8_ATTRIBUTE = re.compile(r'(?P<name>[A-Z0-9-]+)=(?P<value>"[^"]*"|[^,]*)', re.IGNORECASE)
+
+# Creates the ffmpeg arguments to copy the input source into the local mp4 file, including the metadata for the video
+# returns the arguments and the final local filename
+def createFfmpegArgs(ffmpegexec, input_source, local_filename, disable_metadata, videoInfo, report_progress=True):
   prog_args = [ffmpegexec]
 
   # Don't show copyright header
@@ -475,17 +1173,25 @@ def download_m3u8_playlist_using_ffmpeg(ffmpegexec, playlist_url, playlist_fragm
 
   # Don't show excess logging (only things that cause the exe to terminate)
   prog_args.append("-loglevel")
-  prog_args.append("verbose") 
+  prog_args.append("error") 
   
-  # Force showing progress indicator text
-  prog_args.append("-stats") 
+  # The progress is written as key=value lines to stdout instead of the human readable stats line, see parseFfmpegProgressLine
+  prog_args.append("-nostats")
+  if report_progress:
+    prog_args.append("-progress")
+    prog_args.append("pipe:1")
 
   # Overwrite any prompts with YES
   prog_args.append("-y")
 
+  # A local playlist refers to the video segments on the VOD servers
+  if input_source.endswith('.m3u8') and os.path.isfile(input_source):
+    prog_args.append('-protocol_whitelist')
+    prog_args.append('file,http,https,tcp,tls,crypto')
+
   # Add the input url
   prog_args.append('-i')
-  prog_args.append(playlist_url)
+  prog_args.append(input_source)
 
   # conversion configuration
   prog_args.append('-c')
@@ -567,53 +1273,383 @@ def download_m3u8_playlist_using_ffmpeg(ffmpegexec, playlist_url, playlist_fragm
   # Finally the output file path
   prog_args.append(local_filename)
 
+  return prog_args, local_filename
+
+# FFMPEG download of the playlist
+# The stats of the download are written to the download_stats dict if one is given, see updateFfmpegDownloadStats
+def download_m3u8_playlist_using_ffmpeg(ffmpegexec, playlist_url, playlist_duration, local_filename, display_title, keeppartial, video_quality, disable_metadata, videoInfo, stall_timeout=None, download_stats=None):
+  if download_stats is None:
+    download_stats = {}
+  prog_args, local_filename = createFfmpegArgs(ffmpegexec, playlist_url, local_filename, disable_metadata, videoInfo)
+
   # Force a UTF8 environment for the subprocess so that files with non-ascii characters are read correctly
-  # for this to work we must not use the universal line endings parameter
   my_env = os.environ
   my_env['PYTHONIOENCODING'] = 'utf-8'
 
-  # Some counting for progress bars
-  total_chunks = playlist_fragments
-  completed_chunks = 0
-  total_size = QUALITY_BITRATE[video_quality]['chunk_size'] * total_chunks
-  total_size_mb = str(int(total_size/1024.0/1024.0))
-
+  # The estimate is based on the nominal bitrate of the stream, the real size is reported by ffmpeg as it downloads
+  total_size_mb = str(int(int(QUALITY_BITRATE[video_quality]['bits']) / 8 * playlist_duration / 1024.0 / 1024.0))
   print("{0} | Estimated: {1} MB".format(color_title(display_title), total_size_mb))
-  printProgress(completed_chunks, total_chunks, prefix = 'Downloading:', suffix = 'Starting', barLength = 25)
+
+  # ffmpeg reports its progress every half a second, when the output has not grown for a while then the download is stuck
+  progress = {}
+  last_progress = {}
+  def isDownloadProgressing(line):
+    return isFfmpegDownloadProgressing(line, progress, last_progress)
+
+  def onOutput(line):
+    if parseFfmpegProgressLine(line, progress):
+      updateFfmpegDownloadStats(download_stats, progress, playlist_duration, time.monotonic() - start_time)
+      printProgress(min(download_stats['out_time_seconds'], playlist_duration), max(playlist_duration, 1), prefix = 'Downloading:', suffix = formatFfmpegDownloadStats(download_stats), barLength = 25)
 
   # Run the app and collect the output
   # print(prog_args)
-  ret = subprocess.Popen(prog_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, env=my_env)
+  start_time = time.monotonic()
+  for attempt in range(FFMPEG_STALL_RETRIES + 1):
+    progress.clear()
+    last_progress.clear()
+    printProgress(0, 1, prefix = 'Downloading:', suffix = 'Starting', barLength = 25)
+    ret = runFfmpegProcess(prog_args, on_output=onOutput, is_activity=isDownloadProgressing, stall_timeout=stall_timeout, env=my_env)
+    if not ret['stalled']:
+      break
+    endProgress()
+    print(color_warn("ffmpeg has not downloaded anything for {0} seconds{1}".format(stall_timeout, ", restarting the download" if attempt < FFMPEG_STALL_RETRIES else "")))
+
+  printProgress(1, 1, prefix = 'Downloading:', suffix = 'Complete -> {0}'.format(local_filename), barLength = 25, color = False)
+  # Write one extra line break after operation finishes otherwise the subsequent prints will end up in the same line
+  endProgress()
+
+  download_stats['elapsed_seconds'] = time.monotonic() - start_time
+  download_stats['cpu_seconds'] = ret['cpu_seconds']
+
+  # If the process returned ok then return the local name otherwise a None to signify an error
+  if not ret['stalled'] and ret['returncode'] == 0:
+    download_stats['bytes'] = os.path.getsize(local_filename) if os.path.isfile(local_filename) else download_stats.get('bytes', 0)
+    return local_filename
+
+  # Anything ffmpeg printed that is not progress information is an error message
+  errors = [line for line in ret['output'] if not RE_FFMPEG_PROGRESS_LINE.match(line)]
+  if len(errors) > 0:
+    print(color_error(os.linesep.join(errors)))
+  return None
+
+# Parses a key=value line from the ffmpeg -progress output into the progress dict, returns True when a complete progress report has been read
+#   total_size=1048576
+#   out_time_us=10000000
+#   bitrate=838.9kbits/s
+#   speed=4.01x
+#   progress=continue
+def parseFfmpegProgressLine(line, progress):
+  match = RE_FFMPEG_PROGRESS_LINE.match(line)
+  if match is None:
+    return False
+  key, value = match.group('key'), match.group('value').strip()
+  try:
+    if key in ('total_size', 'out_time_us'):
+      progress[key] = int(value)
+    elif key == 'bitrate':
+      progress[key] = float(value.replace('kbits/s', ''))
+    elif key == 'speed':
+      progress[key] = float(value.rstrip('x'))
+  except ValueError:
+    pass # ffmpeg reports N/A until it knows the value
+  return key == 'progress'
+
+# True if the progress line shows that ffmpeg has written more of the output or more of the video than before, a stuck ffmpeg keeps
+# reporting its progress with the same values. The progress dict must already contain the line, last_progress keeps the values seen so far
+def isFfmpegDownloadProgressing(line, progress, last_progress):
+  key = line.split('=', 1)[0]
+  if not key in ('total_size', 'out_time_us') or progress.get(key, 0) <= last_progress.get(key, -1):
+    return False
+  last_progress[key] = progress.get(key, 0)
+  return True
+
+# Updates the stats record for a download from the latest ffmpeg progress report
+#   bytes             - bytes written to the output file
+#   bitrate_kbps      - bitrate of the output so far
+#   speed             - how many times faster than realtime the stream is downloaded
+#   out_time_seconds  - how much of the video has been downloaded
+#   duration_seconds  - length of the video according to the playlist
+#   eta_seconds       - estimated time until the download finishes, None until ffmpeg reports the speed
+#   elapsed_seconds   - time since the download started
+#   cpu_seconds       - CPU time used by ffmpeg, set when ffmpeg exits and None where it is not available
+def updateFfmpegDownloadStats(download_stats, progress, duration_seconds, elapsed_seconds):
+  download_stats['bytes'] = progress.get('total_size', 0)
+  download_stats['bitrate_kbps'] = progress.get('bitrate')
+  download_stats['speed'] = progress.get('speed')
+  download_stats['out_time_seconds'] = max(progress.get('out_time_us', 0), 0) / 1000000.0
+  download_stats['duration_seconds'] = duration_seconds
+  download_stats['elapsed_seconds'] = elapsed_seconds
+  speed = download_stats['speed']
+  download_stats['eta_seconds'] = max(duration_seconds - download_stats['out_time_seconds'], 0) / speed if not speed is None and speed > 0 else None
+
+def formatFfmpegDownloadStats(download_stats):
+  eta = download_stats['eta_seconds']
+  return "{0:,.1f} MB {1} {2} ETA {3}   ".format(download_stats['bytes']/1024.0/1024.0, 
+                                            "{0:.0f} kbit/s".format(download_stats['bitrate_kbps']) if not download_stats['bitrate_kbps'] is None else '-',
+                                            "{0:.1f}x".format(download_stats['speed']) if not download_stats['speed'] is None else '-',
+                                            "{0}:{1:02d}".format(int(eta // 60), int(eta % 60)) if not eta is None else '-')
+
+# Runs ffmpeg and blocks until it exits, each line of output is passed to on_output and then to is_activity. If stall_timeout is set and no line matching 
+# is_activity has been seen for that many seconds then ffmpeg is considered stuck and stopped.
+# Returns a dict with the 'returncode', whether the process 'stalled', the last FFMPEG_OUTPUT_TAIL_LINES 'output' lines and the 'cpu_seconds' 
+# used by ffmpeg (None when this is not available on the platform)
+def runFfmpegProcess(prog_args, on_output=None, is_activity=None, stall_timeout=None, env=None):
+  process = subprocess.Popen(prog_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, errors='replace', env=env)
+
+  # The output is read on a separate thread so that waiting for the next line can time out
+  lines = queue.Queue()
+  def readOutput():
+    try:
+      for line in process.stdout:
+        lines.put(line)
+    finally:
+      lines.put(None)
+  reader = threading.Thread(target=readOutput, daemon=True)
+  reader.start()
+
+  output = deque(maxlen=FFMPEG_OUTPUT_TAIL_LINES)
+  stalled = False
+  last_activity = time.monotonic()
   try:
     while True:
+      if DOWNLOADS_CANCELLED.is_set():
+        raise KeyboardInterrupt()
+      # ffmpeg keeps printing its progress while it is stuck, so the deadline is checked for every line and not only when no line arrives
+      if stall_timeout and time.monotonic() - last_activity > stall_timeout:
+        stalled = True
+        break
       try:
-        line = ret.stdout.readline()
-        if not line:
-          break
-        line = line.strip()
-        if ' Opening \'{0}'.format(RUV_URL) in line:
-          completed_chunks += 1
-          printProgress(min(completed_chunks, total_chunks), total_chunks, prefix = 'Downloading:', suffix = 'Working ', barLength = 25)
-      except UnicodeDecodeError:
-        continue # Ignore all unicode errors, don't care!
-
-    # Ensure that the return code was ok before continuing
-    # Check if child process has terminated. Set and return returncode attribute. Otherwise, returns None.
-    retcode = ret.poll()
-    while retcode is None:
-      retcode = ret.poll()
-  except KeyboardInterrupt:
-    ret.terminate()
+        line = lines.get(timeout=1)
+      except queue.Empty:
+        continue
+      if line is None:
+        break
+      line = line.strip()
+      output.append(line)
+      if not on_output is None:
+        on_output(line)
+      if is_activity is None or is_activity(line):
+        last_activity = time.monotonic()
+  except BaseException:
+    stopProcess(process)
     raise
 
-  printProgress(total_chunks, total_chunks, prefix = 'Downloading:', suffix = 'Complete -> {0}'.format(local_filename), barLength = 25, color = False)
-  # Write one extra line break after operation finishes otherwise the subsequent prints will end up in the same line
-  sys.stdout.write('\n')
-
-  # If the process returned ok then return the local name otherwise a None to signify an error
-  if ret.returncode == 0:
-    return local_filename
+  if stalled:
+    stopProcess(process)
+    cpu_seconds = None
+  else:
+    cpu_seconds = waitForProcess(process)
+  # The output pipe can be held open by processes ffmpeg started, do not wait for those
+  reader.join(timeout=5)
+  return {'returncode': process.returncode, 'stalled': stalled, 'output': output, 'cpu_seconds': cpu_seconds}
+
+# Waits for a process to exit without polling, returns the CPU time used by the process where available
+def waitForProcess(process):
+  if hasattr(os, 'wait4'):
+    try:
+      _, status, rusage = os.wait4(process.pid, 0)
+      process.returncode = os.waitstatus_to_exitcode(status)
+      return rusage.ru_utime + rusage.ru_stime
+    except ChildProcessError:
+      pass
+  process.wait()
   return None
+
+# Asks a process to stop and kills it if it does not exit in time
+def stopProcess(process):
+  process.terminate()
+  try:
+    process.wait(timeout=10)
+  except subprocess.TimeoutExpired:
+    process.kill()
+    process.wait()
+
+# Native download of the playlist, the segments are downloaded concurrently over the shared connection pool and written in order 
+# into a local file, ffmpeg then only remuxes the local file into the final mp4 file without touching the network
+# The segments that have been written to the local file are checkpointed in resume_dir, if the download is interrupted the next download of the
+# same pid continues from the first missing segment
+# The stats of the download are written to the download_stats dict if one is given
+#   bytes             - bytes downloaded, not counting the segments downloaded before the download was resumed
+#   resumed_bytes     - bytes of the segments downloaded before the download was resumed
+#   segments          - number of segments in the playlist
+#   duration_seconds  - length of the video according to the playlist
+#   elapsed_seconds   - time the download and remux took
+#   cpu_seconds       - CPU time used by ffmpeg to remux the video, None where it is not available
+def download_m3u8_playlist_using_native(ffmpegexec, playlist, local_filename, display_title, keeppartial, disable_metadata, videoInfo, segment_workers=4, resume_dir=None, download_stats=None):
+  # fMP4 streams start with an initialization segment that must be written before the media segments
+  segment_uris = ([playlist['map']] if not playlist['map'] is None else []) + [segment['uri'] for segment in playlist['segments']]
+  total_segments = len(segment_uris)
+
+  # Continue an interrupted download of the same playlist if possible, the local file name may have changed since then (e.g. by a date suffix)
+  # so the partial file from the interrupted download is used
+  resume_file_name = os.path.join(resume_dir, "{0}.json".format(sanitizeFileName(str(videoInfo['pid']), '_'))) if not resume_dir is None and 'pid' in videoInfo else None
+  playlist_id = hashlib.sha1('\n'.join(uri.split('?')[0] for uri in segment_uris).encode('utf-8')).hexdigest()
+  resume_state = loadDownloadResumeState(resume_file_name, playlist_id, total_segments)
+  part_filename = resume_state['part_filename'] if not resume_state is None else "{0}.part".format(local_filename)
+  completed_segments = resume_state['completed_segments'] if not resume_state is None else 0
+  completed_bytes = resume_state['completed_bytes'] if not resume_state is None else 0
+
+  prog_args, local_filename = createFfmpegArgs(ffmpegexec, part_filename, local_filename, disable_metadata, videoInfo, report_progress=False)
+  start_time = time.monotonic()
+  resumed_bytes = completed_bytes
+  checkpointed_segments = completed_segments
+  last_checkpoint_time = start_time
+
+  # Makes sure the written segments are on disk and then checkpoints them
+  def checkpoint(part_file):
+    nonlocal checkpointed_segments, last_checkpoint_time
+    last_checkpoint_time = time.monotonic()
+    if resume_file_name is None or completed_segments <= checkpointed_segments:
+      return
+    part_file.flush()
+    os.fsync(part_file.fileno())
+    saveDownloadResumeState(resume_file_name, {'pid': str(videoInfo['pid']), 'playlist_id': playlist_id, 'part_filename': part_filename, 
+                                               'completed_segments': completed_segments, 'completed_bytes': completed_bytes})
+    checkpointed_segments = completed_segments
+
+  print("{0} | {1} segments, {2} workers".format(color_title(display_title), total_segments, segment_workers))
+  if completed_segments > 0:
+    print("{0} | Continuing from segment {1} of {2}".format(color_info('Resuming'), completed_segments + 1, total_segments))
+  printProgress(completed_segments, total_segments, prefix = 'Downloading:', suffix = 'Starting', barLength = 25)
+
+  try:
+    with open(part_filename, 'r+b' if completed_segments > 0 else 'wb') as part_file:
+      # Anything written after the last checkpoint is incomplete
+      part_file.truncate(completed_bytes)
+      part_file.seek(completed_bytes)
+
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, segment_workers)) as executor:
+        # Only keep a limited number of segments in flight so that finished segments waiting to be written do not use too much memory
+        max_in_flight = max(1, segment_workers) * 2
+        in_flight = {}
+        next_segment = completed_segments
+        try:
+          for segment_index in range(completed_segments, total_segments):
+            while next_segment < total_segments and next_segment < segment_index + max_in_flight:
+              in_flight[next_segment] = executor.submit(downloadVodSegment, segment_uris[next_segment])
+              next_segment += 1
+
+            if DOWNLOADS_CANCELLED.is_set():
+              raise KeyboardInterrupt()
+            segment_data = in_flight.pop(segment_index).result()
+            part_file.write(segment_data)
+            completed_segments += 1
+            completed_bytes += len(segment_data)
+
+            # The segments are checkpointed periodically, a resumed download repeats the segments written since the last checkpoint
+            if time.monotonic() - last_checkpoint_time >= RESUME_CHECKPOINT_INTERVAL_SECONDS:
+              checkpoint(part_file)
+
+            printProgress(completed_segments, total_segments, prefix = 'Downloading:', suffix = '{0} MB'.format(int(completed_bytes/1024.0/1024.0)), barLength = 25)
+          checkpoint(part_file)
+        except BaseException:
+          executor.shutdown(wait=False, cancel_futures=True)
+          # Keep what has been written when the download is interrupted or a segment fails
+          try:
+            checkpoint(part_file)
+          except OSError:
+            pass
+          raise
+
+    printProgress(total_segments, total_segments, prefix = 'Remuxing:', suffix = 'Working', barLength = 25)
+    ret = runFfmpegProcess(prog_args)
+    if ret['returncode'] != 0:
+      endProgress()
+      print(color_error("ffmpeg could not remux '{0}'".format(part_filename)))
+      print(os.linesep.join(ret['output']))
+      # The downloaded data cannot be used so there is nothing to resume
+      removeDownloadResumeState(resume_file_name, part_filename if not keeppartial else None)
+      return None
+
+    os.remove(part_filename)
+  except BaseException as ex:
+    endProgress()
+    if not isinstance(ex, KeyboardInterrupt):
+      print(color_error("Error while downloading segments for {0}".format(display_title)))
+      print(ex)
+    # Without a checkpoint the partial file cannot be resumed
+    if resume_file_name is None and not keeppartial and os.path.isfile(part_filename):
+      print( "Interrupted: Deleting partial file '{0}'".format(ntpath.basename(part_filename)))
+      os.remove(part_filename)
+    elif not resume_file_name is None and checkpointed_segments > 0:
+      print( "Interrupted: Download will continue from segment {0} of {1} on the next run".format(checkpointed_segments + 1, total_segments))
+    if isinstance(ex, Exception):
+      return None
+    raise
+
+  printProgress(total_segments, total_segments, prefix = 'Downloading:', suffix = 'Complete -> {0}'.format(local_filename), barLength = 25, color = False)
+  endProgress()
+  if not download_stats is None:
+    download_stats.update({'bytes': completed_bytes - resumed_bytes, 'resumed_bytes': resumed_bytes, 'segments': total_segments, 'duration_seconds': playlist['duration'], 
+                           'elapsed_seconds': time.monotonic() - start_time, 'cpu_seconds': ret['cpu_seconds']})
+  return local_filename
+
+# Loads the checkpoint for an interrupted download, returns None if there is nothing to resume for the playlist or the checkpoint is not valid
+def loadDownloadResumeState(resume_file_name, playlist_id, total_segments):
+  if resume_file_name is None or not os.path.isfile(resume_file_name):
+    return None
+  try:
+    with open(resume_file_name, 'r', encoding='utf-8') as in_file:
+      resume_state = json.load(in_file)
+
+    # The playlist must be the same and the partial file must at least contain all the checkpointed segments
+    if not isinstance(resume_state, dict) or resume_state.get('playlist_id') != playlist_id:
+      return None
+    part_filename = resume_state.get('part_filename')
+    completed_segments = resume_state.get('completed_segments')
+    completed_bytes = resume_state.get('completed_bytes')
+    if not isinstance(part_filename, str) or not isinstance(completed_segments, int) or not isinstance(completed_bytes, int):
+      return None
+    if completed_segments < 0 or completed_segments > total_segments or completed_bytes < 0:
+      return None
+    if not os.path.isfile(part_filename) or os.path.getsize(part_filename) < completed_bytes:
+      return None
+  except Exception:
+    return None
+  return resume_state
+
+def saveDownloadResumeState(resume_file_name, resume_state):
+  writeFileAtomically(resume_file_name, lambda out_file: out_file.write(json.dumps(resume_state, ensure_ascii=False)))
+
+# Removes the checkpoint and optionally the partial file of an interrupted download
+def removeDownloadResumeState(resume_file_name, part_filename=None):
+  for file_name in [resume_file_name, part_filename]:
+    try:
+      if not file_name is None and os.path.isfile(file_name):
+        os.remove(file_name)
+    except OSError:
+      pass
+
+# Removes any leftover resume state for a pid once it has been recorded as downloaded
+def cleanupDownloadResumeState(resume_dir, pid):
+  resume_file_name = os.path.join(resume_dir, "{0}.json".format(sanitizeFileName(str(pid), '_')))
+  if not os.path.isfile(resume_file_name):
+    return
+  part_filename = None
+  try:
+    with open(resume_file_name, 'r', encoding='utf-8') as in_file:
+      part_filename = json.load(in_file)['part_filename']
+  except Exception:
+    pass
+  removeDownloadResumeState(resume_file_name, part_filename)
+
+# Downloads a single video segment, raises an exception if the segment cannot be downloaded
+def downloadVodSegment(segment_url):
+  # The segment is read in chunks so that the bandwidth limit is spread evenly over the concurrent segment downloads
+  with getHttpSession().get(segment_url, timeout=30, verify=False, headers=VOD_REQUEST_HEADERS, stream=True) as r:
+    if r.status_code != 200:
+      raise IOError("Segment not found on server (status={0}, url={1})".format(r.status_code, segment_url))
+    segment_data = bytearray()
+    for chunk in r.iter_content(chunk_size=64*1024):
+      throttleTransfer(len(chunk))
+      segment_data += chunk
+  return bytes(segment_data)
+
+# Prints the size and speed of a finished download and the CPU time used by ffmpeg if known
+def printDownloadThroughput(total_bytes, elapsed_seconds, cpu_seconds=None):
+  total_mb = total_bytes/1024.0/1024.0
+  cpu_info = ", ffmpeg CPU time {0:.1f}s".format(cpu_seconds) if not cpu_seconds is None else ""
+  print("{0} | {1:,.1f} MB in {2:.0f}s ({3:.2f} MB/s){4}".format(color_info('Downloaded'), total_mb, elapsed_seconds, total_mb / max(elapsed_seconds, 0.001), cpu_info))
   
 def printTvShowDetails(args, show):
   if( not 'pid' in show ):
@@ -657,7 +1693,25 @@ def parseArguments():
   parser.add_argument("--imdbfolder", help="Folder storing the downloaded and unzipped title.basics.tsv database snapshot from IMDB, see https://www.imdb.com/interfaces/", 
                                       type=str)
 
-  parser.add_argument("--incremental", help="Performs fast incremental intra-day refreshes. Setting this switch instructs the refresh mechanism to only download information for items that are new since the last full TV schedule refresh from the same day. This option has no effect and a full refresh is performed if the date of this refresh is newer than the latest refresh data. ", action="store_true")
+  parser.add_argument("--imdbcachedays", help="The number of days a series matched to IMDB is kept in the {0} file before it is looked up again. The default is {1} days.".format(IMDB_CACHE_FILE, IMDB_CACHE_HIT_TTL_DAYS),
+                                         default=IMDB_CACHE_HIT_TTL_DAYS,
+                                         type=int)
+
+  parser.add_argument("--imdbmisscachedays", help="The number of days a series that could not be matched to IMDB is kept in the {0} file before it is looked up again. The default is {1} days.".format(IMDB_CACHE_FILE, IMDB_CACHE_MISS_TTL_DAYS),
+                                             default=IMDB_CACHE_MISS_TTL_DAYS,
+                                             type=int)
+
+  parser.add_argument("--incremental", help="Performs fast incremental refreshes. Setting this switch instructs the refresh mechanism to only download information for series whose number of available episodes has changed since the last refresh and to remove series that are no longer available. A full refresh is still performed if the last full refresh is older than {0} days.".format(FULL_REFRESH_INTERVAL_DAYS), action="store_true")
+
+  parser.add_argument("--sqlite", help="Stores the tv schedule in a sqlite database ({0}) instead of the {1} file. Looking up series and program ids then no longer requires loading the full schedule. An existing {1} file is migrated the first time this switch is used.".format(TV_SCHEDULE_DB_FILE, TV_SCHEDULE_LOG_FILE), action="store_true")
+
+  parser.add_argument("--refreshworkers", help="The number of series that are requested concurrently when refreshing the TV schedule. The default is 1, i.e. the series are requested one after another.",
+                                          default=1,
+                                          type=int)
+
+  parser.add_argument("--poolsize", help="The maximum number of keep-alive connections kept open to each server. The default is 10.",
+                                    default=10,
+                                    type=int)
 
   parser.add_argument("--plex", help="Creates Plex Media Server compatible file names and folder structures. See https://support.plex.tv/articles/naming-and-organizing-your-tv-show-files/", action="store_true")
 
@@ -686,6 +1740,28 @@ def parseArguments():
   parser.add_argument("--includeenglishsubs", help="When set the system will also download entries that have burnt in English subtitles available. This is true for some special schedule items. By default this is off.", 
                                              action="store_true")
 
+  parser.add_argument("--hlsengine", help="Selects how the video is downloaded, 'ffmpeg' (default) has ffmpeg download the video stream, 'native' downloads the video segments concurrently and only uses ffmpeg to remux the downloaded file.",
+                                     choices=['ffmpeg', 'native'],
+                                     default='ffmpeg',
+                                     type=str)
+
+  parser.add_argument("--segmentworkers", help="The number of video segments downloaded concurrently when using '--hlsengine native'. The default is 4.",
+                                          default=4,
+                                          type=int)
+
+  parser.add_argument("--parallel", help="The number of shows that are downloaded at the same time. The default is 1, progress bars are not shown when downloading more than one show at a time.",
+                                    default=1,
+                                    type=int)
+
+  parser.add_argument("--stalltimeout", help="Restarts ffmpeg if it has not downloaded a new video segment for this many seconds, 0 disables the check. The default is 120 seconds.",
+                                        default=120,
+                                        type=int)
+
+  parser.add_argument("--maxrate", help="Limits the bandwidth used by all downloads, in bytes per second with an optional K, M or G suffix (e.g. 20M). "
+                                        "The limit can depend on the time of day, e.g. '00:00-07:00=0,20M' is unlimited between midnight and 7 and 20M otherwise. "
+                                        "The limit is shared between all instances of the script that are running at the same time.",
+                                   type=str)
+
   parser.add_argument("--ffmpeg",       help="Full path to the ffmpeg executable file", 
                                         type=str)
 
@@ -698,27 +1774,122 @@ def createFullConfigFileName(portable, file_name):
   else:
     return "{0}/{1}".format(LOG_DIR,file_name)
 
-# Saves a list of program ids to a file
+# The prevrecorded.log file is an append only journal with one program id per line, it is compacted when it contains this many duplicate ids
+PREV_LOG_COMPACT_DUPLICATES = 100
+
+# Holds an exclusive lock on a lock file next to the given file while in the with block, so that instances of the script that run at the same 
+# time do not write to the file at the same time. The lock is released by the OS if the script is killed
+class InterProcessFileLock:
+  def __init__(self, file_name):
+    self.lock_file_name = file_name + '.lock'
+    self.lock_file = None
+
+  def __enter__(self):
+    os.makedirs(os.path.dirname(os.path.abspath(self.lock_file_name)), exist_ok=True)
+    self.lock_file = open(self.lock_file_name, 'a+b')
+    try:
+      if 'fcntl' in globals():
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+      else:
+        # LK_LOCK gives up after trying for 10 seconds, keep trying until the other instance is done with the file
+        self.lock_file.seek(0)
+        while True:
+          try:
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            break
+          except OSError:
+            pass
+    except:
+      self.lock_file.close()
+      raise
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    try:
+      if 'fcntl' in globals():
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+      else:
+        self.lock_file.seek(0)
+        msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+      self.lock_file.close()
+
+# Writes the file through a temporary file next to it that then replaces the file in a single step, so that the file is never left half written.
+# The writer is called with the temporary file opened in the given mode, or with the name of the temporary file if the mode is None for writers
+# that open the file themselves. The temporary file is named after the process and the thread so that instances of the script and worker threads
+# that write the same file at the same time never share it, and it is removed if the writer fails
+def writeFileAtomically(file_name, writer, mode='w', fsync=False):
+  os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+  tmp_file_name = "{0}.{1}.{2}.tmp".format(file_name, os.getpid(), threading.get_ident())
+  try:
+    if mode is None:
+      writer(tmp_file_name)
+    else:
+      with open(tmp_file_name, mode, encoding=None if 'b' in mode else 'utf-8') as out_file:
+        writer(out_file)
+        if fsync:
+          out_file.flush()
+          os.fsync(out_file.fileno())
+    os.replace(tmp_file_name, file_name)
+  except BaseException:
+    try:
+      os.remove(tmp_file_name)
+    except OSError:
+      pass
+    raise
+
+# Adds a program id to the set of previously recorded shows and appends it to the file, the file is synced to disk before returning
+# so that the id is not lost if the script is interrupted. Shows downloaded concurrently are written one at a time
 def appendNewPidAndSavePreviouslyRecordedShows(new_pid, previously_recorded_pids, rec_file_name):
+  with PREVIOUSLY_RECORDED_LOCK:
+    # Store the new pid in memory first
+    previously_recorded_pids.add(new_pid)
 
-  # Store the new pid in memory first
-  previously_recorded_pids.append(new_pid)
+    # Make sure that the directory exists and then append the pid to it, other instances of the script may be appending or compacting the file
+    os.makedirs(os.path.dirname(rec_file_name), exist_ok=True)
 
-  # Make sure that the directory exists and then write the full list of pids to it
-  os.makedirs(os.path.dirname(rec_file_name), exist_ok=True)
+    with InterProcessFileLock(rec_file_name), open(rec_file_name, 'a') as theFile:
+      theFile.write("%s\n" % new_pid)
+      theFile.flush()
+      os.fsync(theFile.fileno())
 
-  with open(rec_file_name, 'w+') as theFile:
-    for item in previously_recorded_pids:
-      theFile.write("%s\n" % item)
+# Rewrites the file with only the given program ids, the file is replaced in a single step so it is never left half written
+# The caller must hold the InterProcessFileLock for the file so that ids appended by other instances of the script are not lost
+def compactPreviouslyRecordedShows(previously_recorded_pids, rec_file_name):
+  with PREVIOUSLY_RECORDED_LOCK:
+    writeFileAtomically(rec_file_name, lambda theFile: theFile.writelines("%s\n" % item for item in previously_recorded_pids), fsync=True)
 
-# Gets a list of program ids from a file
+# Gets the set of program ids from a file
 def getPreviouslyRecordedShows(rec_file_name):
-  rec_file = Path(rec_file_name)
-  if rec_file.is_file():
-    lines = [line.rstrip('\n') for line in rec_file.open('r+')]
-    return lines
-  else:
-    return []
+  if not os.path.isfile(rec_file_name):
+    return set()
+
+  # The file is read and compacted while holding the same lock as the instances that append to it
+  with InterProcessFileLock(rec_file_name):
+    try:
+      with open(rec_file_name, 'rb') as in_file:
+        data = in_file.read()
+    except FileNotFoundError:
+      return set()
+
+    # Every id is written with a trailing new line, a last line without one was cut short while being written and is dropped
+    lines = data.decode('utf-8', errors='replace').split('\n')
+    last_line = lines.pop().strip()
+    if len(last_line) > 0:
+      print(color_warn(f"Ignoring the incomplete line '{last_line}' at the end of {rec_file_name}"))
+
+    pids = [line.strip() for line in lines if len(line.strip()) > 0]
+    previously_recorded = set(pids)
+
+    # Shows that are downloaded again with --force are appended again, the duplicates are removed once there are enough of them. 
+    # The file is also rewritten without the incomplete last line so that the next id is not appended to it
+    if (len(data) > 0 and not data.endswith(b'\n')) or len(pids) - len(previously_recorded) >= PREV_LOG_COMPACT_DUPLICATES:
+      try:
+        compactPreviouslyRecordedShows(dict.fromkeys(pids), rec_file_name)
+      except OSError as ex:
+        print(color_warn(f"Could not compact {rec_file_name}, {ex}"))
+
+  return previously_recorded
 
 def saveCurrentTvSchedule(schedule,tv_file_name):
   today = datetime.date.today()
@@ -726,18 +1897,125 @@ def saveCurrentTvSchedule(schedule,tv_file_name):
   # Format the date field
   schedule['date'] = today.strftime('%Y-%m-%d')
 
-  #make sure that the log directory exists
-  os.makedirs(os.path.dirname(tv_file_name), exist_ok=True)
+  # Each series is only stored once, the episodes reference their series by its sid
+  stored = normalizeSchedule(schedule)
+  for key in TV_SCHEDULE_METADATA_KEYS:
+    if key in schedule:
+      stored[key] = schedule[key]
 
-  with open(tv_file_name, 'w+', encoding='utf-8') as out_file:
-    out_file.write(json.dumps(schedule, ensure_ascii=False, sort_keys=True, indent=2*' '))
+  writeFileAtomically(tv_file_name, lambda out_file: out_file.write(json.dumps(stored, ensure_ascii=False, sort_keys=True, indent=2*' ')))
 
-def saveImdbCache(imdb_cache, imdb_cache_file_name):
-  os.makedirs(os.path.dirname(imdb_cache_file_name), exist_ok=True)
+#
+# Cache of the IMDB matches for each series, stored in the imdb-cache.json file
+# Both successful matches and series that could not be matched are cached, the 'checked' date of each entry is used to 
+# look the series up again once the entry is older than the time-to-live for its kind. Entries without a 'checked' date 
+# are either older entries or manual corrections and never expire. The file is capped at a maximum number of entries, 
+# when it grows beyond it the series that could not be matched and then the oldest matches are removed first.
+class ImdbLookupCache:
+  def __init__(self, entries=None, hit_ttl_days=IMDB_CACHE_HIT_TTL_DAYS, miss_ttl_days=IMDB_CACHE_MISS_TTL_DAYS, max_entries=IMDB_CACHE_MAX_ENTRIES):
+    self.entries = entries if not entries is None else {}
+    self.hit_ttl = datetime.timedelta(days=hit_ttl_days)
+    self.miss_ttl = datetime.timedelta(days=miss_ttl_days)
+    self.max_entries = max_entries
+    self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0}
+    self.stats_lock = threading.Lock()
+
+  @classmethod
+  def load(cls, file_name, hit_ttl_days=IMDB_CACHE_HIT_TTL_DAYS, miss_ttl_days=IMDB_CACHE_MISS_TTL_DAYS):
+    entries = getExistingJsonFile(file_name)
+    return cls(entries if isinstance(entries, dict) else None, hit_ttl_days, miss_ttl_days)
+
+  def __len__(self):
+    return len(self.entries)
+
+  # Returns the date the entry was last looked up or None if the entry has no date
+  @staticmethod
+  def getCheckedDate(entry):
+    try:
+      return datetime.datetime.strptime(entry['checked'], '%Y-%m-%d').date()
+    except (KeyError, TypeError, ValueError):
+      return None
+
+  def isExpired(self, entry):
+    checked = ImdbLookupCache.getCheckedDate(entry)
+    if checked is None:
+      return False
+    ttl = self.miss_ttl if entry.get('imdb') is None else self.hit_ttl
+    return checked + ttl < datetime.date.today()
+
+  # True if the series has a cached entry that should be looked up again
+  def needsRevalidation(self, sid):
+    entry = self.entries.get(str(sid))
+    return not entry is None and self.isExpired(entry)
+
+  # Returns a tuple of (is_cached, imdb_result), the result of an expired match is still returned so that it can be 
+  # kept if looking the series up again does not succeed, is_cached is only True for entries that have not expired
+  def lookup(self, sid):
+    entry = self.entries.get(str(sid))
+    if entry is None:
+      return (False, None)
+    if self.isExpired(entry):
+      return (False, entry.get('imdb'))
+
+    with self.stats_lock:
+      if entry.get('imdb') is None:
+        self.stats['negative_hits'] += 1
+      else:
+        self.stats['hits'] += 1
+    return (True, entry.get('imdb'))
+
+  def contains(self, sid):
+    return str(sid) in self.entries
+
+  # Stores the result of looking the series up in IMDB, a result of None records that no match was found
+  def store(self, sid, foreign_title, series_title, imdb_result):
+    with self.stats_lock:
+      self.stats['misses'] += 1
+    self.entries[str(sid)] = {
+      'series_id': sid,
+      'original-title': foreign_title, 
+      'series_title': series_title, 
+      'imdb': imdb_result,
+      'checked': datetime.date.today().strftime('%Y-%m-%d')
+    }
+
+  # Marks the entry as checked today without looking the series up again
+  def renew(self, sid):
+    entry = self.entries.get(str(sid))
+    if not entry is None:
+      entry['checked'] = datetime.date.today().strftime('%Y-%m-%d')
+
+  # Removes the entries that exceed the max number of entries, unmatched series go first and then the oldest matches
+  def evict(self):
+    excess = len(self.entries) - self.max_entries
+    if excess <= 0:
+      return
+
+    candidates = []
+    for key, entry in self.entries.items():
+      checked = ImdbLookupCache.getCheckedDate(entry)
+      if checked is None:
+        continue
+      candidates.append((not entry.get('imdb') is None, checked, key))
+
+    for _, _, key in sorted(candidates)[:excess]:
+      del self.entries[key]
+
+  def save(self, file_name):
+    if len(self.entries) <= 0:
+      return
+    self.evict()
+    writeFileAtomically(file_name, lambda out_file: out_file.write(json.dumps(self.entries, ensure_ascii=False, sort_keys=True, indent=2*' ')))
+
+  def printStats(self):
+    with self.stats_lock:
+      hits = self.stats['hits']
+      negative_hits = self.stats['negative_hits']
+      misses = self.stats['misses']
+    if hits + negative_hits + misses <= 0:
+      return
+    print("{0} | {1} cached matches, {2} cached misses, {3} looked up".format(color_info('IMDB cache'), hits, negative_hits, misses))
 
-  with open(imdb_cache_file_name, 'w+', encoding='utf-8') as out_file:
-    out_file.write(json.dumps(imdb_cache, ensure_ascii=False, sort_keys=True, indent=2*' '))
-  
 def getExistingJsonFile(file_name):
   try:
     tv_file = Path(file_name)
@@ -758,17 +2036,233 @@ def getExistingTvSchedule(tv_file_name):
     if tv_file.is_file():
       with tv_file.open('r+',encoding='utf-8') as in_file:
         existing = json.load(in_file)
+
+      # Older versions stored a flat dictionary of entries, which is converted so that the series information is shared
+      stored = existing if 'episodes' in existing else normalizeSchedule(existing)
+      schedule = denormalizeSchedule(stored)
+      for key in TV_SCHEDULE_METADATA_KEYS:
+        if key in existing:
+          schedule[key] = existing[key]
       
       # format the date field
-      existing['date'] = datetime.datetime.strptime(existing['date'], '%Y-%m-%d')
+      schedule['date'] = datetime.datetime.strptime(schedule['date'], '%Y-%m-%d')
       
-      return existing
+      return schedule
     else:
       return None
   except:
     print("Could not open existing tv schedule, downloading new one (invalid file at "+tv_file_name+")")
     return None
     
+# The fields of a schedule entry that are the same for all episodes in a series, these are stored once per series
+SERIES_FIELDS = ['sid', 'imdb', 'series_title', 'series_desc', 'series_sdesc', 'series_image', 'portrait_image', 'original-title', 
+                 'is_movie', 'is_sport', 'is_docu', 'english_subtitled', 'categories', 'multiple_episodes', 'web_available_episodes']
+
+# Creates a schedule entry from the episode and the series information, the entry reads as a single dictionary with all the fields 
+# of both, episode fields override series fields of the same name and any changes to the entry are only made to the episode
+def createScheduleEntry(episode, series):
+  return ChainMap(episode, series)
+
+# Splits a single flat schedule entry (as stored by older versions) into its episode and series parts
+def splitScheduleEntry(entry, series=None):
+  if series is None:
+    series = {key: entry[key] for key in SERIES_FIELDS if key in entry}
+  episode = {key: value for key, value in entry.items() if not key in series or series[key] != value or key == 'sid'}
+  return episode, series
+
+# Converts the episode entries in the schedule into the stored format, where each series is stored only once
+# {'series': {sid: series}, 'episodes': {pid: episode}}
+def normalizeSchedule(schedule):
+  normalized = {'series': {}, 'episodes': {}}
+  for key, entry in schedule.items():
+    if key in TV_SCHEDULE_METADATA_KEYS or not isinstance(entry, Mapping) or not 'pid' in entry:
+      continue
+    if isinstance(entry, ChainMap):
+      episode, series = entry.maps[0], entry.maps[1]
+    else:
+      episode, series = splitScheduleEntry(entry, normalized['series'].get(entry.get('sid')))
+    normalized['episodes'][key] = episode
+    if 'sid' in series and not series['sid'] in normalized['series']:
+      normalized['series'][series['sid']] = series
+  return normalized
+
+# Converts the stored format back into a dictionary of schedule entries keyed by pid
+def denormalizeSchedule(normalized):
+  schedule = {}
+  series = normalized['series'] if 'series' in normalized else {}
+  for pid, episode in normalized['episodes'].items():
+    schedule[pid] = createScheduleEntry(episode, series[episode['sid']] if 'sid' in episode and episode['sid'] in series else {})
+  return schedule
+
+# The keys in the tv schedule that do not hold episode entries
+TV_SCHEDULE_METADATA_KEYS = ['date', 'series_index', 'full_refresh_date']
+
+#
+# Stores the tv schedule in the tvschedule.json file, the whole schedule is always loaded and saved
+class JsonTvScheduleStore:
+  def __init__(self, tv_file_name):
+    self.tv_file_name = tv_file_name
+
+  # The json file cannot be partially loaded, the pids and sids filters are only a hint
+  def load(self, pids=None, sids=None):
+    return getExistingTvSchedule(self.tv_file_name)
+
+  def save(self, schedule, prune=True):
+    saveCurrentTvSchedule(schedule, self.tv_file_name)
+
+# Stay well below the sqlite limit on the number of host parameters, the values of an IN list are passed in chunks of this size
+SQLITE_IN_CHUNK_SIZE = 500
+
+# Runs the query, which has a '{0}' placeholder for the IN list, once for each chunk of the values with the args as the parameters 
+# that follow the IN list, returns the rows of all the chunks
+def executeSqliteInChunks(conn, query, values, *args):
+  values = list(values)
+  rows = []
+  for i in range(0, len(values), SQLITE_IN_CHUNK_SIZE):
+    chunk = values[i:i+SQLITE_IN_CHUNK_SIZE]
+    rows.extend(conn.execute(query.format(','.join('?' * len(chunk))), chunk + list(args)).fetchall())
+  return rows
+
+#
+# Stores the tv schedule in a sqlite database with one row per series and one row per episode. Episodes are indexed on their pid, sid and showtime 
+# and series on their categories so that looking up individual series or episodes does not require reading the whole schedule, and saving only writes the rows that changed.
+class SqliteTvScheduleStore:
+  # Increase when the layout of the tables changes, databases with an older layout are recreated
+  SCHEMA_VERSION = 2
+
+  def __init__(self, db_file_name, json_file_name=None):
+    self.db_file_name = db_file_name
+    os.makedirs(os.path.dirname(os.path.abspath(db_file_name)), exist_ok=True)
+    self.conn = sqlite3.connect(db_file_name)
+
+    # The database only holds data downloaded from RUV, so an outdated layout is simply dropped and refreshed
+    if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+      self.conn.executescript("""
+        DROP TABLE IF EXISTS meta;
+        DROP TABLE IF EXISTS series;
+        DROP TABLE IF EXISTS episodes;
+        DROP TABLE IF EXISTS categories;
+      """)
+      self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    self.conn.executescript("""
+      CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+      CREATE TABLE IF NOT EXISTS series (sid TEXT PRIMARY KEY, hash TEXT NOT NULL, data TEXT NOT NULL);
+      CREATE TABLE IF NOT EXISTS episodes (pid TEXT PRIMARY KEY, sid TEXT, showtime TEXT, hash TEXT NOT NULL, data TEXT NOT NULL);
+      CREATE TABLE IF NOT EXISTS categories (sid TEXT NOT NULL, category TEXT NOT NULL);
+      CREATE INDEX IF NOT EXISTS idx_episodes_sid ON episodes (sid);
+      CREATE INDEX IF NOT EXISTS idx_episodes_showtime ON episodes (showtime);
+      CREATE INDEX IF NOT EXISTS idx_categories_category ON categories (category);
+      CREATE INDEX IF NOT EXISTS idx_categories_sid ON categories (sid);
+    """)
+
+    # One time migration of an existing json schedule into the empty database
+    if not json_file_name is None and self.__getMeta('date') is None and os.path.isfile(json_file_name):
+      existing = getExistingTvSchedule(json_file_name)
+      if not existing is None:
+        print(color_info("Migrating tv schedule")+ f" | {json_file_name} -> {db_file_name}")
+        existing_date = existing['date']
+        self.save(existing)
+        self.__setMeta('date', existing_date.strftime('%Y-%m-%d'))
+        self.conn.commit()
+
+  def __getMeta(self, key):
+    row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if not row is None else None
+
+  def __setMeta(self, key, value):
+    self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+  # Loads the schedule, if either pids or sids are set then only the matching episodes are loaded
+  def load(self, pids=None, sids=None):
+    schedule_date = self.__getMeta('date')
+    if schedule_date is None:
+      return None
+
+    if not pids is None:
+      episode_rows = executeSqliteInChunks(self.conn, "SELECT data FROM episodes WHERE pid IN ({0})", pids)
+    elif not sids is None:
+      episode_rows = executeSqliteInChunks(self.conn, "SELECT data FROM episodes WHERE sid IN ({0})", sids)
+    else:
+      episode_rows = self.conn.execute("SELECT data FROM episodes").fetchall()
+
+    stored = {'series': {}, 'episodes': {}}
+    for (data,) in episode_rows:
+      episode = json.loads(data)
+      stored['episodes'][episode['pid']] = episode
+
+    if pids is None and sids is None:
+      series_rows = self.conn.execute("SELECT data FROM series").fetchall()
+    else:
+      series_rows = executeSqliteInChunks(self.conn, "SELECT data FROM series WHERE sid IN ({0})", set(episode['sid'] for episode in stored['episodes'].values() if 'sid' in episode))
+    for (data,) in series_rows:
+      series = json.loads(data)
+      stored['series'][series['sid']] = series
+
+    schedule = denormalizeSchedule(stored)
+    for key in TV_SCHEDULE_METADATA_KEYS:
+      value = self.__getMeta(key)
+      if not value is None:
+        schedule[key] = value
+
+    # format the date field
+    schedule['date'] = datetime.datetime.strptime(schedule_date, '%Y-%m-%d')
+    return schedule
+
+  # Returns the serialized data and its hash if it differs from the existing hash, otherwise None
+  @staticmethod
+  def __serializeIfChanged(item, existing_hash):
+    data = json.dumps(item, ensure_ascii=False, sort_keys=True)
+    data_hash = hashlib.sha1(data.encode('utf-8')).hexdigest()
+    return (data, data_hash) if existing_hash != data_hash else None
+
+  # Saves the schedule, only series and episodes that are new or have changed are written. If prune is set then
+  # episodes in the database that are no longer in the schedule are deleted, otherwise the schedule is assumed to be partial
+  def save(self, schedule, prune=True):
+    stored = normalizeSchedule(schedule)
+    existing_series_hashes = dict(self.conn.execute("SELECT sid, hash FROM series").fetchall())
+    existing_episode_hashes = dict(self.conn.execute("SELECT pid, hash FROM episodes").fetchall())
+    upserted = 0
+
+    with self.conn:
+      for sid, series in stored['series'].items():
+        changed = self.__serializeIfChanged(series, existing_series_hashes.get(sid))
+        if changed is None:
+          continue
+        self.conn.execute("INSERT OR REPLACE INTO series (sid, hash, data) VALUES (?, ?, ?)", (sid, changed[1], changed[0]))
+        self.conn.execute("DELETE FROM categories WHERE sid = ?", (sid,))
+        self.conn.executemany("INSERT INTO categories (sid, category) VALUES (?, ?)", 
+                              [(sid, category) for category in (series['categories'] if 'categories' in series and not series['categories'] is None else [])])
+        upserted += 1
+
+      for pid, episode in stored['episodes'].items():
+        changed = self.__serializeIfChanged(episode, existing_episode_hashes.get(pid))
+        if changed is None:
+          continue
+        self.conn.execute("INSERT OR REPLACE INTO episodes (pid, sid, showtime, hash, data) VALUES (?, ?, ?, ?, ?)", 
+                          (pid, episode['sid'] if 'sid' in episode else None, episode['showtime'] if 'showtime' in episode else None, changed[1], changed[0]))
+        upserted += 1
+
+      if prune:
+        executeSqliteInChunks(self.conn, "DELETE FROM episodes WHERE pid IN ({0})", [pid for pid in existing_episode_hashes if not pid in stored['episodes']])
+        self.conn.execute("DELETE FROM series WHERE NOT sid IN (SELECT DISTINCT sid FROM episodes WHERE NOT sid IS NULL)")
+        self.conn.execute("DELETE FROM categories WHERE NOT sid IN (SELECT sid FROM series)")
+
+      # Format the date field
+      schedule['date'] = datetime.date.today().strftime('%Y-%m-%d')
+      for key in TV_SCHEDULE_METADATA_KEYS:
+        if key in schedule:
+          self.__setMeta(key, schedule[key])
+
+    return upserted
+
+# Creates the store for the tv schedule based on the command line arguments
+def createTvScheduleStore(args):
+  tv_schedule_file_name = createFullConfigFileName(args.portable, TV_SCHEDULE_LOG_FILE)
+  if args.sqlite:
+    return SqliteTvScheduleStore(createFullConfigFileName(args.portable, TV_SCHEDULE_DB_FILE), tv_schedule_file_name)
+  return JsonTvScheduleStore(tv_schedule_file_name)
+
 def sanitizeFileName(local_filename, sep=" "):
   #These are symbols that are not "kosher" on a NTFS filesystem.
   local_filename = re.sub(r"[\.\,\';\"/:<>|?*\n\r\t\x00]", sep, local_filename)
@@ -870,14 +2364,124 @@ def createLocalFileName(show, include_original_title=False, use_plex_formatting=
   # Clean up any possible characters that would interfere with the local OS filename rules
   return "{0}.mp4".format(sanitizeFileName(local_filename))
 
+#
+# Inventory of the video files in the output folders, used instead of listing a folder for every show that is checked. Each folder is listed 
+# at most once per run when a file in it is first checked, the names of the .mp4 files in it are kept sorted so that the files starting with 
+# a name can be found quickly. The listings are saved between runs along with the modification time of the folder and are only used again 
+# if the folder has not been modified since, files added by the downloads are added to the inventory as they are written.
+class LocalFileInventory:
+  def __init__(self, inventory_file_name=None):
+    self.inventory_file_name = inventory_file_name
+    self.folders = {}
+    self.dirty_folders = set()
+    self.lock = threading.Lock()
+    self.saved_folders = getExistingJsonFile(inventory_file_name) if not inventory_file_name is None and os.path.isfile(inventory_file_name) else None
+    if not isinstance(self.saved_folders, dict):
+      self.saved_folders = {}
+
+  # Splits the file name into its folder and the start of the name that the files must have, file names are compared as the file system does
+  @staticmethod
+  def splitFileName(local_filename):
+    folder, name = os.path.split(os.path.abspath(local_filename))
+    return os.path.normcase(folder), os.path.normcase(name.split(".mp4")[0])
+
+  # Returns the sorted names of the .mp4 files in the folder without the extension, must be called with the lock held
+  def __getFolder(self, folder):
+    if folder in self.folders:
+      return self.folders[folder]['stems']
+
+    try:
+      mtime = os.stat(folder).st_mtime_ns
+    except OSError:
+      # The folder does not exist yet, it is created when the first file is written to it
+      self.folders[folder] = {'mtime': None, 'stems': []}
+      self.dirty_folders.add(folder)
+      return self.folders[folder]['stems']
+
+    saved = self.saved_folders.get(folder)
+    if isinstance(saved, dict) and saved.get('mtime') == mtime and isinstance(saved.get('stems'), list):
+      stems = saved['stems']
+    else:
+      stems = []
+      try:
+        for dir_entry in os.scandir(folder):
+          name = os.path.normcase(dir_entry.name)
+          if name.endswith('.mp4') and not name.startswith('.'):
+            stems.append(name[:-len('.mp4')])
+      except OSError:
+        pass
+      stems.sort()
+
+    self.folders[folder] = {'mtime': mtime, 'stems': stems}
+    return stems
+
+  # True if a .mp4 file starting with the name of the file (without the extension) exists in its folder
+  def exists(self, local_filename):
+    folder, prefix = LocalFileInventory.splitFileName(local_filename)
+    with self.lock:
+      stems = self.__getFolder(folder)
+      index = bisect.bisect_left(stems, prefix)
+      return index < len(stems) and stems[index].startswith(prefix)
+
+  # Adds a file that was written by this run to the inventory
+  def add(self, local_filename):
+    folder, name = os.path.split(os.path.abspath(local_filename))
+    name = os.path.normcase(name)
+    if not name.endswith('.mp4'):
+      return
+    with self.lock:
+      stems = self.__getFolder(os.path.normcase(folder))
+      bisect.insort(stems, name[:-len('.mp4')])
+      # The folder has been modified by this run, its listing is not saved as it may not match the modification time of the folder
+      self.dirty_folders.add(os.path.normcase(folder))
+
+  def save(self):
+    if self.inventory_file_name is None:
+      return
+    with self.lock:
+      for folder, listing in self.folders.items():
+        if folder in self.dirty_folders:
+          self.saved_folders.pop(folder, None)
+        else:
+          self.saved_folders[folder] = listing
+      saved_folders = dict(self.saved_folders)
+
+    try:
+      writeFileAtomically(self.inventory_file_name, lambda out_file: out_file.write(json.dumps(saved_folders, ensure_ascii=False)))
+    except Exception as ex:
+      print(f"Could not save the inventory of the output folders, {ex}")
+
+# The inventory of the output folders, see runMain()
+LOCAL_FILE_INVENTORY = LocalFileInventory()
+
 def isLocalFileNameUnique(local_filename):
   # Check to see if the filename specified already exists, must be a complete path
   ###########################
-  # Using glob as I allow partial renaming of the file as long as the original part is left untouched
+  # Partial renaming of the file is allowed as long as the original part is left untouched
   # Meaning you can rename files to "Original Show Name (2 of 4) HERE IS MY CUSTOM EXTRA NAME.mp4"
-  fileSearchString = local_filename.split(".mp4")[0]+"*.mp4"
-  retval = glob.glob(fileSearchString)
-  return not retval
+  return not LOCAL_FILE_INVENTORY.exists(local_filename)
+
+# Finds a file name for a new download that neither exists on disk nor is being downloaded to by another concurrent download,
+# the file name is reserved until releaseLocalFileName is called. Returns None if no unique file name could be created
+def reserveUniqueLocalFileName(local_filename):
+  with RESERVED_LOCAL_FILE_NAMES_LOCK:
+    # So, check for the existence of a file with the same name, if one is found then attempt to give
+    # our new file a different name and check again (append date and time), if still not unique then 
+    # create file name with guid, if still not unique then fail!
+    candidates = [local_filename, 
+                  "{0}_{1}.mp4".format(local_filename.split(".mp4")[0], datetime.datetime.now().strftime("%Y-%m-%d"))]
+    candidates.append("{0}_{1}.mp4".format(candidates[-1].split(".mp4")[0], str(uuid.uuid4())))
+    for candidate in candidates:
+      # Matches the same partially renamed files as isLocalFileNameUnique
+      candidate_prefix = candidate.split(".mp4")[0]
+      if isLocalFileNameUnique(candidate) and not any(reserved.startswith(candidate_prefix) for reserved in RESERVED_LOCAL_FILE_NAMES):
+        RESERVED_LOCAL_FILE_NAMES.add(candidate)
+        return candidate
+  return None
+
+def releaseLocalFileName(local_filename):
+  with RESERVED_LOCAL_FILE_NAMES_LOCK:
+    RESERVED_LOCAL_FILE_NAMES.discard(local_filename)
 
 #
 # Locates the ffmpeg executable and returns a full path to it
@@ -905,7 +2509,7 @@ RE_CAPTURE_VOD_EPNUM_FROM_TITLE = re.compile(r'(?P<ep_num>\d+) af (?P<ep_total>\
 #
 # Downloads the full front page VOD schedule and for each episode in there fetches all available episodes
 # uses the new RUV GraphQL queries
-def getVodSchedule(existing_schedule, args_incremental_refresh=False, imdb_cache=None, imdb_orignal_titles=None):
+def getVodSchedule(existing_schedule, args_incremental_refresh=False, imdb_cache=None, imdb_orignal_titles=None, refresh_workers=1):
 
   # Start with getting all the series available on RUV through their API, this gives us basic information about each of the series
   # https://api.ruv.is/api/programs/tv/all
@@ -917,7 +2521,7 @@ def getVodSchedule(existing_schedule, args_incremental_refresh=False, imdb_cache
   # https://api.ruv.is/api/programs/get_ids/32978
 
   ruv_api_url_all = 'https://api.ruv.is/api/programs/featured/tv'
-  r = __create_retry_session().get(ruv_api_url_all)  
+  r = getHttpSession().get(ruv_api_url_all)  
   api_data = r.json()
 
   # Now the api returns everything categorised into panels
@@ -944,6 +2548,9 @@ def getVodSchedule(existing_schedule, args_incremental_refresh=False, imdb_cache
   if not data or len(data) <=0:
     return schedule
 
+  # The index of the series in the schedule, keeps track of the number of available episodes and the pids for each series
+  series_index = schedule['series_index'] if 'series_index' in schedule else {}
+
   # Filter out all programs that do not have any vod files to download and have an id field
   panels = [p for p in data if 'web_available_episodes' in p and 'id' in p and p['web_available_episodes'] > 0]
 
@@ -953,10 +2560,10 @@ def getVodSchedule(existing_schedule, args_incremental_refresh=False, imdb_cache
   print("{0} | Total: {1} series available".format(color_title('Downloading VOD schedule'), total_programs))
   printProgress(completed_programs, total_programs, prefix = 'Reading:', suffix = '', barLength = 25)
 
-  # Now iterate first through every group and for every thing in the group request all episodes for that 
-  # item (there is no programmatic way of distinguishing between how many episodes there are)
+  # Now iterate first through every group and determine which of the programs need their episodes requested
+  # (there is no programmatic way of distinguishing between how many episodes there are)
+  programs_to_fetch = []
   for program in panels:
-    completed_programs += 1
 
     #if str(program['id']) != '32957': 
     #  continue
@@ -964,51 +2571,241 @@ def getVodSchedule(existing_schedule, args_incremental_refresh=False, imdb_cache
     # If incremental, then check if we already have this series if we don't we want to add it, 
     # if we have the series check if the web_available_episodes match if not then we want to re-add it
     if args_incremental_refresh:
-      existing_vod_episodes_count = sum(type(schedule[p]) is dict and schedule[p]['sid'] == str(program['id']) for p in schedule)
-      if( program['web_available_episodes'] <= existing_vod_episodes_count and existing_vod_episodes_count > 0 ):
+      indexed_series = series_index[str(program['id'])] if str(program['id']) in series_index else None
+      if( not indexed_series is None and program['web_available_episodes'] == indexed_series['web_available_episodes'] ):
+        completed_programs += 1
         continue
       else:
-        existing_vs_new_diff = program['web_available_episodes'] - existing_vod_episodes_count
-        printProgress(completed_programs, total_programs, prefix = 'Detected {0} new entries for {1}:'.format(existing_vs_new_diff, color_sid(program['title'])), suffix ='', barLength = 25)
+        existing_vs_new_diff = program['web_available_episodes'] - (indexed_series['web_available_episodes'] if not indexed_series is None else 0)
+        printProgress(completed_programs, total_programs, prefix = 'Detected {0} {1} entries for {2}:'.format(abs(existing_vs_new_diff), 'new' if existing_vs_new_diff >= 0 else 'removed', color_sid(program['title'])), suffix ='', barLength = 25)
 
-    # Add all details for the given program to the schedule
-    try:
-      # We want to not override existing items in the schedule dictionary in case they are downloaded again
-      program_schedule = getVodSeriesSchedule(program['id'], program, imdb_cache, imdb_orignal_titles)
-      # This joining of the two dictionaries below is necessary to ensure that 
-      # the existing items are not overwritten, therefore schedule is appended to the new list, existing items overwriting any new items.
-      #schedule = dict(list(program_schedule.items()) + list(schedule.items())) 
-      schedule.update(program_schedule) # Want to override existing keys again!
-    except Exception as ex:
-        print( "Unable to retrieve schedule for VOD program '{0}', no episodes will be available for download from this program.".format(program['title']))
-        print(traceback.format_exc())
-        continue
+    programs_to_fetch.append(program)
+
+  # Add all details for the given programs to the schedule, the results are merged in the same order as the programs
+  # appear in the api listing regardless of the order in which the workers finish
+  def onProgramCompleted(_):
+    nonlocal completed_programs
+    completed_programs += 1
     printProgress(completed_programs, total_programs, prefix = 'Reading:', suffix ='', barLength = 25)
 
+  program_schedules = getVodSeriesSchedules(programs_to_fetch, imdb_cache, imdb_orignal_titles, refresh_workers, onProgramCompleted)
+  for program, program_schedule in zip(programs_to_fetch, program_schedules):
+    # If the series could not be retrieved then we keep whatever episodes we already had for it
+    if program_schedule is None:
+      continue
+
+    # Replace all the episodes of the series, episodes no longer in the series have been removed from the VOD
+    sid = str(program['id'])
+    if sid in series_index:
+      removeSeriesFromSchedule(schedule, series_index, sid)
+
+    schedule.update(program_schedule)
+    series_index[sid] = {
+      'web_available_episodes': program['web_available_episodes'],
+      'pids': list(program_schedule.keys())
+    }
+
+  # Drop all series that are no longer available on the VOD
+  available_sids = set(str(program['id']) for program in panels)
+  for sid in [sid for sid in series_index if not sid in available_sids]:
+    removeSeriesFromSchedule(schedule, series_index, sid)
+
+  schedule['series_index'] = series_index
+  if not args_incremental_refresh or not 'full_refresh_date' in schedule:
+    schedule['full_refresh_date'] = datetime.date.today().strftime('%Y-%m-%d')
+
   return schedule
 
-def requestsVodDataRetrieveWithRetries(graphdata):
-  retries_left = 3
+# Removes all the episodes of the series from the schedule and the series index
+def removeSeriesFromSchedule(schedule, series_index, sid):
+  for pid in series_index[sid]['pids']:
+    schedule.pop(pid, None)
+  del series_index[sid]
 
-  while True:
-    retries_left = retries_left - 1
-    r = requests.get(
-      url='https://www.ruv.is/gql/'+graphdata, 
-      headers={'content-type': 'application/json', 'Referer' : 'https://www.ruv.is/sjonvarp', 'Origin': 'https://www.ruv.is' })
-    data = json.loads(r.content.decode())
+# Checks if the schedule can be refreshed incrementally, i.e. only fetching changed series, or if a full refresh should be done
+def isIncrementalRefreshPossible(schedule):
+  if schedule is None or not 'series_index' in schedule or not 'full_refresh_date' in schedule:
+    return False
 
-    if 'data' in data:
-      return data
+  full_refresh_date = datetime.datetime.strptime(schedule['full_refresh_date'], '%Y-%m-%d').date()
+  return datetime.date.today() - full_refresh_date < datetime.timedelta(days=FULL_REFRESH_INTERVAL_DAYS)
 
-    if retries_left <= 0:
-      return None
+#
+# Requests the series schedule for each of the programs using a pool of at most max_workers concurrent workers. 
+# Returns a list of schedules in the same order as the programs list, programs that could not be retrieved
+# have a None entry in the list so that a single failing series does not fail the whole refresh
+def getVodSeriesSchedules(programs, imdb_cache, imdb_orignal_titles, max_workers=1, on_completed=None):
+  program_schedules = [None] * len(programs)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+    futures = {executor.submit(getVodSeriesSchedule, program['id'], program, imdb_cache, imdb_orignal_titles): index for index, program in enumerate(programs)}
+
+    # Results are collected on the calling thread only, this keeps the progress printing free of interleaving
+    for future in concurrent.futures.as_completed(futures):
+      index = futures[future]
+      try:
+        program_schedules[index] = future.result()
+      except Exception as ex:
+        print( "Unable to retrieve schedule for VOD program '{0}', no episodes will be available for download from this program.".format(programs[index]['title']))
+        print(traceback.format_exc())
 
-    if not 'errors' in data:
-      print("Unexpected data in VOD download reply, "+str(data))
-      return None
+      if not on_completed is None:
+        on_completed(programs[index])
+
+  return program_schedules
+
+# Client for the RUV GraphQL api. Requests are spaced out by a token bucket, failed requests are retried with an exponential backoff 
+# with jitter (or after the time the server asks for in the Retry-After header) and the latency and errors of the requests are counted
+class VodGraphQLClient:
+  URL = 'https://www.ruv.is/gql/'
+  HEADERS = {'content-type': 'application/json', 'Referer' : 'https://www.ruv.is/sjonvarp', 'Origin': 'https://www.ruv.is' }
+
+  def __init__(self, timeout=15, max_attempts=4, backoff_base=1.0, backoff_max=30.0, requests_per_second=4.0, burst=8):
+    self.timeout = timeout
+    self.max_attempts = max_attempts
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.requests_per_second = requests_per_second
+    self.burst = burst
+    self.tokens = burst
+    self.last_refill = time.monotonic()
+    self.stats = {'requests': 0, 'retries': 0, 'latency_total': 0.0, 'latency_max': 0.0, 'errors': {}}
+    self.lock = threading.Lock()
+
+  # Returns the data for the query or None if it could not be retrieved
+  def request(self, graphdata):
+    for attempt in range(1, self.max_attempts + 1):
+      self.acquireToken()
+      retry_after = None
+      start_time = time.monotonic()
+      try:
+        # The session does not retry error responses, those are retried here with the backoff and the Retry-After header
+        r = getHttpSession(retry_responses=False).get(url=self.URL+graphdata, headers=self.HEADERS, timeout=self.timeout)
+        self.countLatency(time.monotonic() - start_time)
+
+        if r.status_code == 429 or r.status_code >= 500:
+          # The server is overloaded or failing, try again later
+          self.countError('http {0}'.format(r.status_code))
+          retry_after = parseRetryAfter(r.headers.get('Retry-After'))
+        elif r.status_code != 200:
+          self.countError('http {0}'.format(r.status_code))
+          return None
+        else:
+          data = json.loads(r.content.decode())
+          if 'data' in data:
+            return data
+
+          if not 'errors' in data:
+            print("Unexpected data in VOD download reply, "+str(data))
+            self.countError('unexpected reply')
+            return None
+          self.countError('graphql errors')
+      except requests.exceptions.Timeout:
+        self.countLatency(time.monotonic() - start_time)
+        self.countError('timeout')
+      except requests.exceptions.RequestException:
+        self.countError('connection')
+      except ValueError:
+        self.countError('invalid json')
+
+      if attempt < self.max_attempts:
+        with self.lock:
+          self.stats['retries'] += 1
+        time.sleep(self.getRetryDelay(attempt, retry_after))
+
+    return None
 
-    # OK we will try again, but first we sleep a little bit to throttle the requests
-    time.sleep(3)
+  def getRetryDelay(self, attempt, retry_after=None):
+    if not retry_after is None:
+      return min(max(retry_after, 0), self.backoff_max)
+    # Full jitter, spreads out the retries of concurrent requests that failed at the same time
+    return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+  # Waits until the token bucket allows another request
+  def acquireToken(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.requests_per_second)
+        self.last_refill = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait_seconds = (1 - self.tokens) / self.requests_per_second
+      time.sleep(wait_seconds)
+
+  def countLatency(self, latency):
+    with self.lock:
+      self.stats['requests'] += 1
+      self.stats['latency_total'] += latency
+      self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+  def countError(self, error):
+    with self.lock:
+      self.stats['errors'][error] = self.stats['errors'].get(error, 0) + 1
+
+  def printStats(self):
+    with self.lock:
+      requests_made = self.stats['requests']
+      if requests_made <= 0 and len(self.stats['errors']) <= 0:
+        return
+      errors = ", ".join("{0} {1}".format(count, error) for error, count in sorted(self.stats['errors'].items()))
+      print("{0} | {1} requests, {2:.0f} ms average, {3:.0f} ms max, {4} retries{5}".format(color_info('RUV api'), requests_made, 
+            1000 * self.stats['latency_total'] / max(requests_made, 1), 1000 * self.stats['latency_max'], self.stats['retries'], 
+            ", errors: " + errors if len(errors) > 0 else ""))
+
+# Parses the Retry-After header which is either a number of seconds or a date, returns the number of seconds to wait or None
+def parseRetryAfter(retry_after):
+  if retry_after is None:
+    return None
+  try:
+    return float(retry_after)
+  except ValueError:
+    pass
+  try:
+    retry_date = email.utils.parsedate_to_datetime(retry_after)
+    return (retry_date - datetime.datetime.now(retry_date.tzinfo)).total_seconds()
+  except (TypeError, ValueError):
+    return None
+
+VOD_GRAPHQL_CLIENT = VodGraphQLClient()
+
+def requestsVodDataRetrieveWithRetries(graphdata):
+  return VOD_GRAPHQL_CLIENT.request(graphdata)
+
+# Creates the GraphQL query for the stream urls of episodes in a series
+def createProgramTypeQuery(sid, pids):
+  return '?operationName=getProgramType&variables={"id":'+str(sid)+',"episodeId":'+json.dumps([str(pid) for pid in pids], separators=(',', ':'))+'}&extensions={"persistedQuery":{"version":1,"sha256Hash":"9d18a07f82fcd469ad52c0656f47fb8e711dc2436983b53754e0c09bad61ca29"}}'
+
+def hasVodFileUrl(item):
+  return 'file' in item and not item['file'] is None and len(item['file']) > 0 and str(item['file']).startswith(RUV_URL)
+
+# Looks up the stream urls for all the episodes in the download list that do not have one with a single request per series. 
+# The urls are stored in the schedule entries so they are saved with the schedule, returns True if any url was found
+def resolveVodEpisodeUrls(download_list):
+  unresolved_items = {}
+  for item in download_list:
+    if not hasVodFileUrl(item):
+      unresolved_items.setdefault(item['sid'], {})[str(item['pid'])] = item
+
+  any_resolved = False
+  for sid, items in unresolved_items.items():
+    data = requestsVodDataRetrieveWithRetries(createProgramTypeQuery(sid, items.keys()))
+    if data is None or not 'data' in data or data['data'] is None or data['data'].get('Program') is None:
+      continue
+
+    episodes = data['data']['Program'].get('episodes') or []
+    for ep_data in episodes:
+      # The episodes are matched on their id, if a single episode was requested then the answer can only be for that episode
+      ep_id = str(ep_data['id']) if 'id' in ep_data and not ep_data['id'] is None else (next(iter(items)) if len(items) == 1 else None)
+      if not ep_id in items or ep_data.get('file') is None:
+        continue
+      items[ep_id]['file'] = ep_data['file']
+      if items[ep_id].get('subtitles') is None and 'subtitles' in ep_data:
+        items[ep_id]['subtitles'] = ep_data['subtitles']
+      any_resolved = True
+
+  return any_resolved
 
 #
 # Replaces image size macro in cover art URLs with a high res version
@@ -1026,14 +2823,50 @@ def formatCoverArtResolutionMacro(rawsrc):
 #
 # Given a series id and program data, downloads all episodes available for that series
 def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
-  schedule = {}  
 
   # Perform two lookups, first to the API as this gives us a more complete information about the series, but unfortunately no episode data
   ruv_api_url_sid = 'https://api.ruv.is/api/programs/program/{0}/all'.format(sid)
 
-  r = __create_retry_session().get(ruv_api_url_sid)  
-  prog = r.json()  
-  if r.status_code != 200 or prog is None or not 'episodes' in prog or len(prog['episodes']) < 1:
+  # Revalidate any previously cached response, if the series has not changed there is no need to download or parse it again
+  response_cache = HTTP_RESPONSE_CACHE
+  cache_entry = response_cache.load(ruv_api_url_sid) if not response_cache is None else None
+  if not cache_entry is None and (not 'parsed' in cache_entry or not 'episodes' in cache_entry['parsed']):
+    cache_entry = None
+
+  # The series has to be parsed again if its IMDB match has expired and needs to be looked up again
+  if not imdb_cache is None and imdb_cache.needsRevalidation(sid):
+    cache_entry = None
+
+  r = getHttpSession().get(ruv_api_url_sid, headers=HttpResponseCache.createConditionalHeaders(cache_entry))
+  if r.status_code == 304 and not cache_entry is None:
+    response_cache.countHit()
+    response_cache.touch(ruv_api_url_sid)
+    parsed = cache_entry['parsed']
+
+    # The imdb cache may have been updated or corrected since the response was cached
+    if not imdb_cache is None and imdb_cache.contains(sid):
+      _, imdb_result = imdb_cache.lookup(sid)
+      for series in parsed['series'].values():
+        series['imdb'] = imdb_result
+    return denormalizeSchedule(parsed)
+
+  if r.status_code != 200:
+    return {}
+
+  schedule = parseVodSeriesSchedule(sid, r.json(), imdb_cache, imdb_orignal_titles)
+
+  if not response_cache is None:
+    response_cache.countMiss()
+    response_cache.store(ruv_api_url_sid, r, normalizeSchedule(schedule))
+
+  return schedule
+
+#
+# Given a series id and the series data returned by the program API, creates the schedule entries for all episodes in the series
+def parseVodSeriesSchedule(sid, prog, imdb_cache, imdb_orignal_titles):
+  schedule = {}  
+
+  if prog is None or not 'episodes' in prog or len(prog['episodes']) < 1:
     return schedule
   
   # Fix the image and portrait image fields as they come pre-formatted from the API
@@ -1067,20 +2900,20 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
   foreign_title = prog['foreign_title']
   total_episodes = len(prog['episodes'])
   imdb_result = None
+  imdb_cached = False
 
   # Is it icelandic?
   isIcelandic = str(series_description).lower().startswith('íslensk')
 
   # First check to see if the series sid is present in the imdb_cache file
-  # if it is then we already have our imdb data, if not then we have to look it up
-  if not imdb_cache is None and str(sid) in imdb_cache:
-    imdb_cache_entry = imdb_cache[str(sid)]
-    imdb_result = imdb_cache_entry['imdb']
+  # if it is then we already have our imdb data (or know that there is none), if not or if it has expired then we have to look it up
+  if not imdb_cache is None:
+    imdb_cached, imdb_result = imdb_cache.lookup(sid)
 
   # 
   # Attempt to find the entry in IMDB if possible, but only for foreign titles, i.e. movies and shows that 
   # have a foreign title set
-  if imdb_result is None and not series_type is None and len(series_type) > 0 and not 'born' in prog['cat_slugs'] :
+  if not imdb_cached and not series_type is None and len(series_type) > 0 and not 'born' in prog['cat_slugs'] :
     # Attempt to extract the year from the description field
     series_year = getGroup(RE_CAPTURE_YEAR_FROM_DESCRIPTION, 'year', series_shortdescription)
 
@@ -1091,6 +2924,8 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
     detected_num = getGroup(RE_CAPTURE_VOD_EPNUM_FROM_TITLE, 'ep_total', prog['episodes'][0]['title'] if not prog['episodes'][0]['title'] is None else series_title )
     total_episode_num = max(int(prog['web_available_episodes']), int(detected_num) if not detected_num is None else 1 ) if 'multiple_episodes' in prog and prog['multiple_episodes'] else 1
     
+    # An expired match is kept if the series cannot be found again
+    expired_result = imdb_result
     imdb_result = None
     # first check the foreign title, this is most likely to result in a match
     if imdb_result is None and not foreign_title is None:
@@ -1102,26 +2937,40 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
     if imdb_result is None and not series_title is None and isMovie:
       imdb_result = lookupItemInIMDB(series_title, series_year, series_type, sample_duration_sec, total_episode_num, isIcelandic, imdb_orignal_titles)
 
-    # If the imdb result was found then store it in the corrections file for later reuse
-    if not imdb_result is None:
-      imdb_cache[str(sid)] = {
-        'series_id': sid,
-        'original-title': foreign_title, 
-        'series_title': series_title, 
-        'imdb': imdb_result
-      }
+    if imdb_result is None:
+      imdb_result = expired_result
+
+    # Store the result in the corrections file for later reuse, series that were not found are stored as well so they are not looked up on every refresh
+    if not imdb_cache is None:
+      imdb_cache.store(sid, foreign_title, series_title, imdb_result)
+  elif not imdb_cache is None and imdb_cache.needsRevalidation(sid):
+    # The series is not looked up anymore, otherwise its entry stays expired and its cached response is never revalidated
+    imdb_cache.renew(sid)
+
+  # The series level information is stored once and shared by all the episode entries in the series
+  series = {}
+  series['sid'] = str(sid)
+  series['imdb'] = imdb_result
+  series['series_title'] = series_title
+  series['series_desc'] = series_description
+  series['series_sdesc'] = series_shortdescription
+  series['series_image'] = series_image
+  series['portrait_image'] = portrait_image
+  series['original-title'] = foreign_title
+  series['is_movie'] = isMovie
+  series['is_sport'] = isSport
+  series['is_docu'] = isDocumentary
+  series['english_subtitled'] = isEnglishSubtitlesEntry
+  series['categories'] = prog['cat_names']
+  series['multiple_episodes'] = prog['multiple_episodes']
+  series['web_available_episodes'] = prog['web_available_episodes']
+
+  # The season number can mostly be determined from the series titles, the episode descriptions are checked for each episode below
+  series_season_index = detectSeasonIndexFromTitles(series_title_wseason, foreign_title)
 
   for episode in prog['episodes']:
     entry = {}
 
-    entry['imdb'] = imdb_result
-
-    entry['series_title'] = series_title
-    entry['series_desc'] = series_description
-    entry['series_sdesc'] = series_shortdescription
-    entry['series_image'] = series_image
-    entry['portrait_image'] = portrait_image
-
     # Fix the episode description if needed
     episode['description'] = ' '.join(episode['description']) if type(episode['description']) is list else episode['description']
     # Fix episode title
@@ -1129,7 +2978,8 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
       #episode['title'] = series_title
       episode['title'] = ''
 
-    entry['episode'] = episode
+    # Only the parts of the raw episode data that are used when downloading are kept
+    entry['episode'] = {'description': episode['description']} if 'description' in episode else {}
     entry['episode_title'] = episode['title']
     entry['episode_image'] = formatCoverArtResolutionMacro(episode['image'])
     entry['title'] = series_title
@@ -1140,7 +2990,6 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
     entry['sid'] = str(sid)
 
     entry['desc'] = episode['description'] if 'description' in episode and len(episode['description']) > 10 else prog['short_description']
-    entry['original-title'] = foreign_title
 
     # The file
     entry['file'] = episode['file']
@@ -1161,16 +3010,6 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
     entry['rating'] = episode['rating']
     entry['slug'] = episode['slug']
 
-    entry['is_movie'] = isMovie
-    entry['is_sport'] = isSport
-    entry['is_docu'] = isDocumentary
-
-    entry['english_subtitled'] = isEnglishSubtitlesEntry
-
-    entry['categories'] = prog['cat_names']
-    entry['multiple_episodes'] = prog['multiple_episodes']
-    entry['web_available_episodes'] = prog['web_available_episodes']
-
     entry['ep_num'] = str(episode['number']) if 'number' in episode else getGroup(RE_CAPTURE_VOD_EPNUM_FROM_TITLE, 'ep_num', episode['title'])
     if not entry['ep_num'] is None:
       entry['ep_num'] = str(entry['ep_num'])
@@ -1184,25 +3023,7 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
       entry['ep_total'] = str(len(prog['episodes']))
 
     # Attempt to parse out the season number, start with 1 as the default
-    entry['season_num'] = '1'
-    if str(series_title_wseason).endswith(' 2') or str(series_title_wseason).endswith(' II') or str(foreign_title).endswith(' II') or 'önnur þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '2'
-    elif str(series_title_wseason).endswith(' 3') or str(series_title_wseason).endswith(' III') or str(foreign_title).endswith(' III') or 'þriðja þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '3'
-    elif str(series_title_wseason).endswith(' 4') or str(series_title_wseason).endswith(' IV') or str(foreign_title).endswith(' IV') or 'fjórða þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '4'
-    elif str(series_title_wseason).endswith(' 5') or str(series_title_wseason).endswith(' V') or str(foreign_title).endswith(' V') or 'fimmta þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '5'
-    elif str(series_title_wseason).endswith(' 6') or str(series_title_wseason).endswith(' VI') or str(foreign_title).endswith(' VI') or 'sjötta þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '6'
-    elif str(series_title_wseason).endswith(' 7') or str(series_title_wseason).endswith(' VII') or str(foreign_title).endswith(' VII') or 'sjöunda þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '7'
-    elif str(series_title_wseason).endswith(' 8') or  str(series_title_wseason).endswith(' VIII') or str(foreign_title).endswith(' VIII') or 'áttunda þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '8'
-    elif str(series_title_wseason).endswith(' 9') or str(series_title_wseason).endswith(' IX') or str(foreign_title).endswith(' IX') or 'níunda þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '9'
-    elif str(series_title_wseason).endswith(' 10') or str(series_title_wseason).endswith(' XX') or str(foreign_title).endswith(' XX') or 'tíunda þáttaröð' in str(entry['desc']).lower():
-      entry['season_num'] = '10'
+    entry['season_num'] = detectSeasonNumber(series_season_index, entry['desc'])
 
     # Create the episode numbers programatically to ensure consistency if we're dealing with multi-episode program
     if not entry['ep_total'] is None and int(entry['ep_total']) > 1:
@@ -1217,26 +3038,59 @@ def getVodSeriesSchedule(sid, _, imdb_cache, imdb_orignal_titles):
     # Special title handling for sporting events
     if isSport:
       # Ensure that the year is in the title, because PLEX doesn't handle seasons that are longer than 3 digits, i.e. we cannot use 'Season 2022' there will just be garbage created, i.e. 'Season 230'
-      if not str(entry['showtime'])[:4] in entry['series_title']:
+      # this overrides the series title for this episode only
+      if not str(entry['showtime'])[:4] in series_title:
         entry['series_title'] = f"{series_title} {str(entry['showtime'])[:4]}"
+      episode_series_title = entry['series_title'] if 'series_title' in entry else series_title
 
       # If the episode name is the date then we only append the timeportion
       if( entry['episode_title'] == f"{str(entry['showtime'])[8:10]}.{str(entry['showtime'])[5:7]}.{str(entry['showtime'])[:4]}"):
-        entry['title'] = f"{entry['series_title']} ({entry['episode_title']}) kl.{(str(entry['showtime'])[11:16]).replace(':','.')}"  
+        entry['title'] = f"{episode_series_title} ({entry['episode_title']}) kl.{(str(entry['showtime'])[11:16]).replace(':','.')}"  
       else: # we add the date as well
         # Add the subtitle into the final title of the episode, i.e. to include dates or the teams playing, use the full show time at the end with the HH:mm
-        entry['title'] = f"{entry['series_title']} ({entry['episode_title']}) {str(entry['showtime'])[8:10]}.{str(MONTH_NAMES[int(entry['showtime'][5:7])])} kl.{(str(entry['showtime'])[11:16]).replace(':','.')}"
+        entry['title'] = f"{episode_series_title} ({entry['episode_title']}) {str(entry['showtime'])[8:10]}.{str(MONTH_NAMES[int(entry['showtime'][5:7])])} kl.{(str(entry['showtime'])[11:16]).replace(':','.')}"
 
       # We cannot use seasons numbers that are longer than 999 as there are only three digits allowed for season numbers
-      entry['sport_season'] = entry['showtime'][:4] if 'showtime' in entry and not entry['showtime'] is None and len(entry['showtime']) > 4 else str(date.today().year)
+      entry['sport_season'] = entry['showtime'][:4] if 'showtime' in entry and not entry['showtime'] is None and len(entry['showtime']) > 4 else str(datetime.date.today().year)
 
-    schedule[entry['pid']] = entry
+    schedule[entry['pid']] = createScheduleEntry(entry, series)
 
     # Decrease the episode count
     total_episodes = total_episodes - 1
 
   return schedule
 
+# The season number suffixes and the description phrases that identify the season of a series, in the order that they are checked
+SEASON_NUMBER_PATTERNS = [
+  # (season, title suffix, roman title suffix, description phrase)
+  ('2',  ' 2',  ' II',   'önnur þáttaröð'),
+  ('3',  ' 3',  ' III',  'þriðja þáttaröð'),
+  ('4',  ' 4',  ' IV',   'fjórða þáttaröð'),
+  ('5',  ' 5',  ' V',    'fimmta þáttaröð'),
+  ('6',  ' 6',  ' VI',   'sjötta þáttaröð'),
+  ('7',  ' 7',  ' VII',  'sjöunda þáttaröð'),
+  ('8',  ' 8',  ' VIII', 'áttunda þáttaröð'),
+  ('9',  ' 9',  ' IX',   'níunda þáttaröð'),
+  ('10', ' 10', ' XX',   'tíunda þáttaröð'),
+]
+
+# Returns the index into SEASON_NUMBER_PATTERNS of the first season that matches the series titles or None if no season matches
+def detectSeasonIndexFromTitles(series_title_wseason, foreign_title):
+  for index, (_, title_suffix, roman_suffix, _) in enumerate(SEASON_NUMBER_PATTERNS):
+    if str(series_title_wseason).endswith(title_suffix) or str(series_title_wseason).endswith(roman_suffix) or str(foreign_title).endswith(roman_suffix):
+      return index
+  return None
+
+# Determines the season number for an episode given the season detected from the series titles and the episode description, 
+# seasons are checked in order so an earlier season mentioned in the description takes precedence over a later season in the titles
+def detectSeasonNumber(series_season_index, description):
+  description = str(description).lower()
+  last_index = series_season_index if not series_season_index is None else len(SEASON_NUMBER_PATTERNS)
+  for index in range(last_index):
+    if SEASON_NUMBER_PATTERNS[index][3] in description:
+      return SEASON_NUMBER_PATTERNS[index][0]
+  return SEASON_NUMBER_PATTERNS[series_season_index][0] if not series_season_index is None else '1'
+
 #
 # Removes any season number related suffixes for a given series title
 # Ex. Monsurnar 1 => Monsurnar   
@@ -1262,7 +3116,7 @@ def getGroup(regex, group_name, haystack):
 
 # Attempts to load the IMDB enhancment files from the given imdb path
 # this is optional and if the files are not present then this enhancement information will not be available
-def loadImdbOriginalTitles(args_imdbfolder):
+def loadImdbOriginalTitles(args_imdbfolder, index_file_name, db_file_name=None):
   imdb_title_cache = {}
 
   if not args_imdbfolder or args_imdbfolder is None:
@@ -1282,6 +3136,268 @@ def loadImdbOriginalTitles(args_imdbfolder):
   if isFileOlderThan(imdb_basics_file_path, datetime.timedelta(days=183)):
     print(color_warn(f"The '{imdb_basics_file_path}' file is older than 6 months, consider downloading a newer 'title.basics.tsv' file from https://www.imdb.com/interfaces/"))
   
+  # The original titles are read from an index that is only rebuilt when the tsv file changes, the offline title index is rebuilt
+  # from the same pass over the tsv file if it is out of date as well
+  imdb_title_cache = ImdbOriginalTitleIndex.open(index_file_name, imdb_basics_file_path)
+  if imdb_title_cache is None:
+    print(color_info("Processing IMDB data files")+ f" | Folder {args_imdbfolder}")
+    buildImdbTitleIndexes(imdb_basics_file_path, index_file_name, db_file_name)
+    imdb_title_cache = ImdbOriginalTitleIndex.open(index_file_name, imdb_basics_file_path)
+
+  return imdb_title_cache if not imdb_title_cache is None else {}
+
+# Read only mapping of IMDB title ids (tconst) to original titles, backed by a memory mapped index file so that opening it is instant
+# and only the parts of the file that are looked up are read into memory. The index file is laid out as
+#   header  - magic, mtime and size of the tsv file the index was built from and the number of titles
+#   ids     - the numeric part of the title ids, sorted
+#   offsets - offsets of the titles in the strings block, one more than there are titles
+#   strings - the utf-8 encoded titles
+class ImdbOriginalTitleIndex(Mapping):
+  # The arrays are stored in the native byte order, the magic tells which one
+  MAGIC = b'RUVIMDB1' if sys.byteorder == 'little' else b'RUVIMDBB'
+  HEADER = struct.Struct('<8sqqQ')
+
+  def __init__(self, index_file, index_map, count):
+    self.index_file = index_file
+    self.index_map = index_map
+    self.count = count
+    ids_start = self.HEADER.size
+    offsets_start = ids_start + count * 4
+    self.strings_start = offsets_start + (count + 1) * 4
+    self.ids = memoryview(index_map)[ids_start:offsets_start].cast('I')
+    self.offsets = memoryview(index_map)[offsets_start:self.strings_start].cast('I')
+
+  # Opens the index for the tsv file, returns None if the index does not exist or was built from a different version of the tsv file
+  @classmethod
+  def open(cls, index_file_name, tsv_file_name):
+    try:
+      tsv_stat = os.stat(tsv_file_name)
+      index_file = open(index_file_name, 'rb')
+    except OSError:
+      return None
+    try:
+      magic, tsv_mtime_ns, tsv_size, count = cls.HEADER.unpack(index_file.read(cls.HEADER.size))
+      if magic != cls.MAGIC or tsv_mtime_ns != tsv_stat.st_mtime_ns or tsv_size != tsv_stat.st_size:
+        index_file.close()
+        return None
+      return cls(index_file, mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ), count)
+    except (struct.error, ValueError, OSError):
+      index_file.close()
+      return None
+
+  # True if the index exists and was built from the current version of the tsv file
+  @classmethod
+  def isCurrent(cls, index_file_name, tsv_file_name):
+    try:
+      tsv_stat = os.stat(tsv_file_name)
+      with open(index_file_name, 'rb') as index_file:
+        magic, tsv_mtime_ns, tsv_size, _ = cls.HEADER.unpack(index_file.read(cls.HEADER.size))
+      return magic == cls.MAGIC and tsv_mtime_ns == tsv_stat.st_mtime_ns and tsv_size == tsv_stat.st_size
+    except (struct.error, OSError):
+      return False
+
+  # Writes the (numeric title id, original title) tuples read from the tsv file to a new index file, see buildImdbTitleIndexes()
+  @classmethod
+  def build(cls, index_file_name, tsv_stat, titles):
+    titles.sort()
+
+    ids = array.array('I', (title_id for title_id, _ in titles))
+    offsets = array.array('I', [0])
+    strings = bytearray()
+    for _, title in titles:
+      strings += title.encode('utf-8')
+      offsets.append(len(strings))
+
+    def writeIndex(out_file):
+      out_file.write(cls.HEADER.pack(cls.MAGIC, tsv_stat.st_mtime_ns, tsv_stat.st_size, len(ids)))
+      ids.tofile(out_file)
+      offsets.tofile(out_file)
+      out_file.write(strings)
+    writeFileAtomically(index_file_name, writeIndex, mode='wb')
+
+  # The numeric part of a title id, None for ids that cannot be in the index
+  @staticmethod
+  def parseTitleId(tconst):
+    if not isinstance(tconst, str) or not tconst.startswith('tt') or not tconst[2:].isdigit():
+      return None
+    title_id = int(tconst[2:])
+    # Ids are zero padded to 7 digits, other paddings are different ids
+    return title_id if formatImdbTitleId(title_id) == tconst and title_id < 2**32 else None
+
+  def findTitle(self, tconst):
+    title_id = self.parseTitleId(tconst)
+    if title_id is None:
+      return None
+    position = bisect.bisect_left(self.ids, title_id)
+    if position >= self.count or self.ids[position] != title_id:
+      return None
+    return self.index_map[self.strings_start + self.offsets[position]:self.strings_start + self.offsets[position + 1]].decode('utf-8')
+
+  def __getitem__(self, tconst):
+    title = self.findTitle(tconst)
+    if title is None:
+      raise KeyError(tconst)
+    return title
+
+  def __contains__(self, tconst):
+    return not self.findTitle(tconst) is None
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    for position in range(self.count):
+      yield formatImdbTitleId(self.ids[position])
+
+# Loads the original titles the first time they are used, most series are already in the IMDB cache and never need them
+# When db_file_name is set the offline title index is rebuilt along with the original titles if it is out of date
+class LazyImdbOriginalTitles(Mapping):
+  def __init__(self, args_imdbfolder, index_file_name, db_file_name=None):
+    self.args_imdbfolder = args_imdbfolder
+    self.index_file_name = index_file_name
+    self.db_file_name = db_file_name
+    self.titles = None
+    self.load_seconds = None
+    self.lock = threading.Lock()
+
+  def getTitles(self):
+    # The refresh workers can ask for the titles at the same time, only load them once
+    with self.lock:
+      if self.titles is None:
+        start_time = time.monotonic()
+        self.titles = loadImdbOriginalTitles(self.args_imdbfolder, self.index_file_name, self.db_file_name)
+        self.load_seconds = time.monotonic() - start_time
+      return self.titles
+
+  def isLoaded(self):
+    return not self.titles is None
+
+  def __getitem__(self, tconst):
+    return self.getTitles()[tconst]
+
+  def __contains__(self, tconst):
+    return tconst in self.getTitles()
+
+  def __len__(self):
+    return len(self.getTitles())
+
+  def __iter__(self):
+    return iter(self.getTitles())
+
+  def printStats(self):
+    if self.isLoaded():
+      print("{0} | Loaded for uncached IMDB lookups in {1:.1f}s".format(color_info('IMDB original titles'), self.load_seconds))
+    else:
+      print("{0} | Not loaded, all IMDB lookups were cached".format(color_info('IMDB original titles')))
+
+def formatImdbTitleId(title_id):
+  return "tt{0:07d}".format(title_id)
+
+# Files smaller than this are not worth starting worker processes for
+IMDB_PARALLEL_MIN_BYTES = 64*1024*1024
+# Size of the parts of the file that are parsed by each worker process
+IMDB_PARALLEL_RANGE_BYTES = 32*1024*1024
+
+# Builds the original title index and the offline title index (if db_file_name is set) that are out of date from a single pass over the tsv file
+IMDB_TITLE_INDEXES_LOCK = threading.Lock()
+def buildImdbTitleIndexes(tsv_file_name, index_file_name, db_file_name=None):
+  with IMDB_TITLE_INDEXES_LOCK:
+    build_titles = not ImdbOriginalTitleIndex.isCurrent(index_file_name, tsv_file_name)
+    build_search_titles = not db_file_name is None and not ImdbTitleSearchIndex.isCurrent(db_file_name, tsv_file_name)
+    if not build_titles and not build_search_titles:
+      return
+
+    tsv_stat = os.stat(tsv_file_name)
+    titles, search_titles = readImdbTitles(tsv_file_name, tsv_stat.st_size, include_search_titles=build_search_titles)
+    if build_titles:
+      ImdbOriginalTitleIndex.build(index_file_name, tsv_stat, titles)
+    if build_search_titles:
+      ImdbTitleSearchIndex.build(db_file_name, tsv_stat, search_titles)
+
+# Reads the titles that have an original title that is different from the primary title from the title.basics.tsv file, returns a list of 
+# (numeric title id, original title) tuples and, if include_search_titles is set, a list of the titles for the offline title index (see 
+# parseImdbSearchTitleFields) or None. Large files are split into byte ranges that are parsed in parallel by worker processes
+def readImdbTitles(imdb_basics_file_path, total_bytes, include_search_titles=False, max_workers=None):
+  max_workers = max_workers if not max_workers is None else (os.cpu_count() or 1)
+  num_ranges = max(1, -(-total_bytes // IMDB_PARALLEL_RANGE_BYTES)) if total_bytes >= IMDB_PARALLEL_MIN_BYTES and max_workers > 1 else 1
+  byte_ranges = [(total_bytes * i // num_ranges, total_bytes * (i + 1) // num_ranges) for i in range(num_ranges)]
+
+  titles = []
+  search_titles = [] if include_search_titles else None
+  bytes_read = 0
+  lines_read = 0
+  printProgress(0, max(total_bytes, 1), prefix = 'Reading IMDB titles:', suffix = "", barLength = 25)
+
+  def addRangeResult(byte_range, result):
+    nonlocal bytes_read, lines_read
+    title_ids, range_titles, range_search_titles, range_lines = result
+    titles.extend(zip(array.array('I', title_ids), range_titles.split('\n') if len(range_titles) > 0 else []))
+    if include_search_titles:
+      search_titles.extend(range_search_titles)
+    bytes_read += byte_range[1] - byte_range[0]
+    lines_read += range_lines
+    printProgress(bytes_read, max(total_bytes, 1), prefix = 'Reading IMDB titles:', suffix = f" | item {lines_read:,}", barLength = 25)
+
+  if num_ranges > 1:
+    try:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, num_ranges)) as executor:
+        futures = {executor.submit(readImdbTitlesRange, imdb_basics_file_path, start, end, include_search_titles): (start, end) for start, end in byte_ranges}
+        for future in concurrent.futures.as_completed(futures):
+          addRangeResult(futures[future], future.result())
+      byte_ranges = []
+    except (OSError, concurrent.futures.BrokenExecutor) as ex:
+      # Fall back to parsing the whole file in this process if worker processes cannot be used
+      print(color_warn("Unable to parse the IMDB file in parallel, {0}".format(ex)))
+      titles, bytes_read, lines_read = [], 0, 0
+      search_titles = [] if include_search_titles else None
+      byte_ranges = [(0, total_bytes)]
+
+  for start, end in byte_ranges:
+    addRangeResult((start, end), readImdbTitlesRange(imdb_basics_file_path, start, end, include_search_titles))
+
+  printProgress(total_bytes, max(total_bytes, 1), prefix = 'Reading IMDB titles:', suffix = f" | Processed {lines_read:,} items           ", barLength = 25)
+  print()
+
+  return titles, search_titles
+
+# Parses the lines that start within the byte range [start, end) of the title.basics.tsv file, runs in the worker processes.
+# To keep the results cheap to send between processes the title ids are returned as the bytes of an array and the titles as a single string
+# with one title per line (titles cannot contain tabs or line breaks in the tsv file), along with the titles for the offline title index 
+# (or None) and the number of lines parsed
+def readImdbTitlesRange(imdb_basics_file_path, start, end, include_search_titles=False):
+  title_ids = array.array('I')
+  titles = []
+  search_titles = [] if include_search_titles else None
+  lines_read = 0
+
+  with open(imdb_basics_file_path, 'rb') as f:
+    # A line that crosses the start of the range belongs to the previous range
+    position = start
+    if start > 0:
+      f.seek(start - 1)
+      position = start - 1 + len(f.readline())
+
+    while position < end:
+      raw_line = f.readline()
+      if not raw_line:
+        break
+      position += len(raw_line)
+      lines_read += 1
+
+      fields = raw_line.rstrip(b'\r\n').split(b'\t')
+      title = parseImdbTitleFields(fields)
+      if not title is None:
+        title_ids.append(title[0])
+        titles.append(title[1])
+      if include_search_titles:
+        search_title = parseImdbSearchTitleFields(fields, title[1] if not title is None else None)
+        if not search_title is None:
+          search_titles.append(search_title)
+
+  return title_ids.tobytes(), '\n'.join(titles), search_titles, lines_read
+
+# Returns the (numeric title id, original title) for the fields of a line in the title.basics.tsv file, None if the title does not have an 
+# original title that is different from its primary title or is filtered out
 #  title.basics.tsv.gz - Contains the following information for titles:
 #    tconst (string) - alphanumeric unique identifier of the title
 #    titleType (string) – the type/format of the title (e.g. movie, short, tvseries, tvepisode, video, etc)
@@ -1292,41 +3408,457 @@ def loadImdbOriginalTitles(args_imdbfolder):
 #    endYear (YYYY) – TV Series end year. ‘\N’ for all other title types
 #    runtimeMinutes – primary runtime of the title, in minutes
 #    genres (string array) – includes up to three genres associated with the title
+#  The fields are compared as bytes, only the original title needs to be decoded
+def parseImdbTitleFields(fields):
+  if len(fields) != 9:
+    return None
+  (tconst, titleType, primaryTitle, originalTitle, isAdult, startYear, endYear, runtimeMinutes, genres) = fields
 
-  print(color_info("Processing IMDB data files")+ f" | Folder {args_imdbfolder}")
+  # Skip all lines that have an invalid IDENTIFIER or have '\N' missing indicator in critical fields
+  if not tconst.startswith(b'tt') or originalTitle == b'\\N' or primaryTitle == b'\\N' or startYear == b'\\N':
+    return None
 
-  printProgress(0, 100, prefix = 'Estimating size:', suffix = 'Working', barLength = 25)
-  total_lines = countLinesInFile(imdb_basics_file_path)
-  curr_line = 0
+  if int(startYear) <= 1930 or not isAdult == b'0':
+    return None
 
-  with open(imdb_basics_file_path, encoding="utf8") as f:
-    for line in f:
-      curr_line += 1
+  if primaryTitle == originalTitle:
+    return None
 
-      if( curr_line == 1 or curr_line % 10000 == 0):
-        printProgress(curr_line, total_lines, prefix = 'Reading Original Titles:', suffix = f" | item {curr_line:,} of {total_lines:,}", barLength = 25)
+  title_id = ImdbOriginalTitleIndex.parseTitleId(tconst.decode('ascii', errors='replace'))
+  if title_id is None:
+    return None
+  return title_id, originalTitle.decode('utf-8')
+
+# The IMDB title types that are indexed for offline matching and the names the IMDB suggestion api uses for them
+IMDB_SEARCH_TITLE_TYPES = {
+  'movie': 'feature',
+  'short': 'short',
+  'tvSeries': 'TV series',
+  'tvMiniSeries': 'TV mini-series',
+  'tvMovie': 'TV movie',
+  'tvSpecial': 'TV special',
+  'tvShort': 'TV short'
+}
 
-      (tconst, titleType, primaryTitle, originalTitle, isAdult, startYear, endYear, runtimeMinutes, genres) = line.split('\t')      
+# Splits a title into lower case words for the inverted index
+RE_IMDB_TITLE_TOKEN = re.compile(r'\w+', re.UNICODE)
 
-      # Skip all lines that have an invalid IDENTIFIER or have '\N' missing indicator in critical fields
-      if not tconst.startswith('tt') or originalTitle == '\\N' or primaryTitle == '\\N' or startYear == '\\N':
-        continue
+def tokenizeImdbTitle(title):
+  return RE_IMDB_TITLE_TOKEN.findall(title.lower()) if not title is None else []
 
-      if int(startYear) <= 1930 or not isAdult == '0':
-        continue
+# Key of a title for the exact title lookups in the offline title index, a 64 bit hash of the lower cased title so that the index does
+# not need to store a copy of the original titles, those are only kept in the original title index
+def getImdbTitleKey(title):
+  if title is None:
+    return None
+  return int.from_bytes(hashlib.blake2b(title.lower().encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+# Sqlite database of the titles in title.basics.tsv with an inverted index of the words in the primary and original titles, 
+# used to match RUV series and movies to IMDB without calling the IMDB suggestion api. The database is rebuilt when the tsv file changes.
+# The original titles of the matches are looked up in the original title index (see ImdbOriginalTitleIndex)
+class ImdbTitleSearchIndex:
+  # Increase when the layout of the tables changes
+  SCHEMA_VERSION = 3
+  # Upper limit on the number of titles returned for a search
+  MAX_CANDIDATES = 25
+
+  def __init__(self, db_file_name, original_titles=None):
+    self.conn = sqlite3.connect(db_file_name, check_same_thread=False)
+    self.original_titles = original_titles
+    self.lock = threading.Lock()
+
+  # Opens the database for the tsv file, returns None if it does not exist or was built from a different version of the tsv file
+  @classmethod
+  def open(cls, db_file_name, tsv_file_name, original_titles=None):
+    if not os.path.isfile(db_file_name):
+      return None
+    try:
+      tsv_stat = os.stat(tsv_file_name)
+      index = cls(db_file_name, original_titles)
+      row = index.conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+      if index.conn.execute("PRAGMA user_version").fetchone()[0] == cls.SCHEMA_VERSION and not row is None and row[0] == "{0}:{1}".format(tsv_stat.st_mtime_ns, tsv_stat.st_size):
+        return index
+      index.conn.close()
+    except (OSError, sqlite3.Error):
+      pass
+    return None
 
-      if primaryTitle == originalTitle:
-        continue
+  # True if the database exists and was built from the current version of the tsv file
+  @classmethod
+  def isCurrent(cls, db_file_name, tsv_file_name):
+    index = cls.open(db_file_name, tsv_file_name)
+    if index is None:
+      return False
+    index.conn.close()
+    return True
+
+  # Writes the titles read from the tsv file to a new database, see buildImdbTitleIndexes() and parseImdbSearchTitleFields()
+  @classmethod
+  def build(cls, db_file_name, tsv_stat, titles):
+    def writeDatabase(tmp_file_name):
+      conn = sqlite3.connect(tmp_file_name)
+      try:
+        conn.executescript("""
+          PRAGMA journal_mode = OFF;
+          PRAGMA synchronous = OFF;
+          CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+          CREATE TABLE titles (tconst INTEGER PRIMARY KEY, type TEXT NOT NULL, primary_title TEXT NOT NULL, year INTEGER, runtime INTEGER,
+                               primary_title_key INTEGER NOT NULL, original_title_key INTEGER, word_count INTEGER NOT NULL);
+          CREATE TABLE tokens (token TEXT NOT NULL, tconst INTEGER NOT NULL, PRIMARY KEY (token, tconst)) WITHOUT ROWID;
+        """)
+
+        for start in range(0, len(titles), 10000):
+          cls.insertTitles(conn, titles[start:start + 10000])
+          printProgress(min(start + 10000, len(titles)), max(len(titles), 1), prefix = 'Indexing IMDB titles:', suffix = f" | item {start:,}", barLength = 25)
+
+        # The exact title lookups are done on the title keys, the indexes are faster to create once all the titles are in
+        conn.execute("CREATE INDEX titles_primary_title_key ON titles (primary_title_key)")
+        conn.execute("CREATE INDEX titles_original_title_key ON titles (original_title_key)")
+        conn.execute("INSERT INTO meta (key, value) VALUES ('source', ?)", ("{0}:{1}".format(tsv_stat.st_mtime_ns, tsv_stat.st_size),))
+        conn.execute(f"PRAGMA user_version = {cls.SCHEMA_VERSION}")
+        conn.commit()
+      finally:
+        conn.close()
+    writeFileAtomically(db_file_name, writeDatabase, mode=None)
+
+    printProgress(len(titles), max(len(titles), 1), prefix = 'Indexing IMDB titles:', suffix = f" | Indexed {len(titles):,} items           ", barLength = 25)
+    print()
+
+  @staticmethod
+  def insertTitles(conn, titles):
+    conn.executemany("INSERT OR REPLACE INTO titles (tconst, type, primary_title, year, runtime, primary_title_key, original_title_key, word_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", 
+                     ((title_id, title_type, primary_title, year, runtime, 
+                       getImdbTitleKey(primary_title), 
+                       getImdbTitleKey(original_title), 
+                       min(len(tokenizeImdbTitle(primary_title)), len(tokenizeImdbTitle(original_title)) if not original_title is None else sys.maxsize)) 
+                      for title_id, title_type, primary_title, original_title, year, runtime in titles))
+    conn.executemany("INSERT OR IGNORE INTO tokens (token, tconst) VALUES (?, ?)", 
+                     ((token, title[0]) for title in titles for token in set(tokenizeImdbTitle(title[2]) + tokenizeImdbTitle(title[3]))))
+
+  # Finds the titles whose primary or original title is the title, followed by the titles that contain all the words in the title with 
+  # the titles that have the fewest words first. Returns them in the same format as the IMDB suggestion api (see lookupItemInIMDB) with 
+  # the titles closest to the year first when the titles have the same number of words. 
+  # The title database has no actors ('s') or images ('i') so the matches have neither
+  def findCandidates(self, item_title, item_year=None):
+    tokens = sorted(set(tokenizeImdbTitle(item_title)))
+    if len(tokens) < 1:
+      return []
+
+    year = int(item_year) if not item_year is None and str(item_year).isdigit() else None
+    columns = "tconst, type, primary_title, year, runtime"
+    order_by_year = "ABS(year - :year) IS NULL, ABS(year - :year), year DESC"
+    parameters = {'key': getImdbTitleKey(item_title), 'year': year, 'limit': self.MAX_CANDIDATES}
+    parameters.update({f"token{i}": token for i, token in enumerate(tokens)})
+    query = " INTERSECT ".join([f"SELECT tconst FROM tokens WHERE token = :token{i}" for i in range(len(tokens))])
+
+    with self.lock:
+      rows = self.conn.execute(f"SELECT {columns} FROM titles WHERE primary_title_key = :key OR original_title_key = :key ORDER BY {order_by_year} LIMIT :limit", 
+                               parameters).fetchall()
+      exact_tconsts = set(row[0] for row in rows)
+      rows += [row for row in self.conn.execute(f"SELECT {columns} FROM titles WHERE tconst IN ({query}) ORDER BY word_count, {order_by_year} LIMIT :limit", 
+                                                parameters).fetchall() if not row[0] in exact_tconsts]
+
+    candidates = []
+    for tconst, title_type, primary_title, title_year, runtime in rows[:self.MAX_CANDIDATES]:
+      candidate = {'id': formatImdbTitleId(tconst), 'l': primary_title, 'q': IMDB_SEARCH_TITLE_TYPES.get(title_type, title_type), 'runtime': runtime}
+      original_title = self.original_titles.get(candidate['id']) if not self.original_titles is None else None
+      if not original_title is None:
+        candidate['lo'] = original_title
+      if not title_year is None:
+        candidate['y'] = title_year
+      candidates.append(candidate)
+    return candidates
+
+# Returns the (numeric title id, type, primary title, original title, start year, runtime in minutes) for the fields of a line in the 
+# title.basics.tsv file, None for adult titles and titles of a type that is not indexed. The original title is the one parseImdbTitleFields() 
+# found for the line, so that the offline title index matches the same original titles that are stored in the original title index
+def parseImdbSearchTitleFields(fields, original_title):
+  if len(fields) != 9:
+    return None
+  (tconst, titleType, primaryTitle, originalTitle, isAdult, startYear, endYear, runtimeMinutes, genres) = fields
 
-      imdb_title_cache[tconst] = originalTitle
+  title_type = titleType.decode('ascii', errors='replace')
+  if not tconst.startswith(b'tt') or not title_type in IMDB_SEARCH_TITLE_TYPES or not isAdult == b'0' or primaryTitle == b'\\N':
+    return None
 
-  printProgress(total_lines, total_lines, prefix = 'Reading Original Titles:', suffix = f" | Processed {total_lines:,} items           ", barLength = 25)
-  print()
+  title_id = ImdbOriginalTitleIndex.parseTitleId(tconst.decode('ascii', errors='replace'))
+  if title_id is None:
+    return None
 
-  return imdb_title_cache
+  return (title_id, title_type, primaryTitle.decode('utf-8'), original_title,
+          int(startYear) if startYear.isdigit() else None,
+          int(runtimeMinutes) if runtimeMinutes.isdigit() else None)
+
+# Opens or builds the offline IMDB title index the first time a title needs to be matched, the index is built from the same pass over
+# the tsv file as the original titles (see buildImdbTitleIndexes) and the original titles of the matches are read from them
+class LazyImdbTitleSearchIndex:
+  def __init__(self, original_titles, db_file_name):
+    self.original_titles = original_titles
+    self.db_file_name = db_file_name
+    self.index = None
+    self.loaded = False
+    self.offline_matches = 0
+    self.remote_lookups = 0
+    self.lock = threading.Lock()
+
+  def getIndex(self):
+    with self.lock:
+      if not self.loaded:
+        self.loaded = True
+        args_imdbfolder = self.original_titles.args_imdbfolder
+        tsv_file_name = os.path.join(args_imdbfolder, "title.basics.tsv") if args_imdbfolder else None
+        if not tsv_file_name is None and os.path.isfile(tsv_file_name):
+          self.index = ImdbTitleSearchIndex.open(self.db_file_name, tsv_file_name, self.original_titles)
+          if self.index is None:
+            print(color_info("Building the offline IMDB title index")+ f" | Folder {args_imdbfolder}")
+            buildImdbTitleIndexes(tsv_file_name, self.original_titles.index_file_name, self.db_file_name)
+            self.index = ImdbTitleSearchIndex.open(self.db_file_name, tsv_file_name, self.original_titles)
+      return self.index
+
+  # Returns an empty list when there is no local title index
+  def findCandidates(self, item_title, item_year=None):
+    index = self.getIndex()
+    return index.findCandidates(item_title, item_year) if not index is None else []
+
+  def countLookup(self, matched_offline):
+    with self.lock:
+      if matched_offline:
+        self.offline_matches += 1
+      else:
+        self.remote_lookups += 1
+
+  def printStats(self):
+    if self.offline_matches + self.remote_lookups > 0:
+      print("{0} | {1} matched offline, {2} looked up with the IMDB api".format(color_info('IMDB matching'), self.offline_matches, self.remote_lookups))
+
+IMDB_TITLE_SEARCH_INDEX = None
+
+# Titles are found by --find if fuzz.partial_ratio of the search text and the title is above this
+SEARCH_MIN_PARTIAL_RATIO = 85
+
+# Letters that do not decompose into a base letter and an accent, each one is folded into a single letter 
+# so that a folded title has exactly the same length as the title, see getMinSearchBigramHits()
+SEARCH_FOLDED_LETTERS = {'ð': 'd', 'þ': 't', 'æ': 'a', 'ø': 'o', 'œ': 'o', 'ß': 's', 'ł': 'l', 'đ': 'd'}
+SEARCH_FOLDED_CHARACTERS = {}
+
+# Folds a lower case text to ascii letters where possible, searching for 'krakkafrettir' then also finds 'Krakkafréttir'
+def foldSearchText(text):
+  folded = []
+  for c in text:
+    folded_c = SEARCH_FOLDED_CHARACTERS.get(c)
+    if folded_c is None:
+      folded_c = SEARCH_FOLDED_LETTERS[c] if c in SEARCH_FOLDED_LETTERS else unicodedata.normalize('NFD', c)[0]
+      SEARCH_FOLDED_CHARACTERS[c] = folded_c
+    folded.append(folded_c)
+  return ''.join(folded)
+
+# Returns the number of times each pair of adjacent characters occurs in the text, the pairs are packed into a single integer
+def createSearchBigrams(text):
+  bigrams = {}
+  for i in range(len(text) - 1):
+    bigram = ord(text[i]) << 21 | ord(text[i+1])
+    bigrams[bigram] = bigrams.get(bigram, 0) + 1
+  return bigrams
+
+# The minimum number of the bigrams in a search text of the given length that a longer title must contain for the two to possibly have a 
+# partial_ratio above SEARCH_MIN_PARTIAL_RATIO. The ratio of the search text (length L) and a part of the title (length W) is 2M/(L+W) where
+# M is the number of characters in the blocks that match, so M >= 0.4275(L+W) and W >= 0.7467L. Every bigram inside a matching block also 
+# occurs in the title, there are at least M-B of those for B blocks and as the blocks are separated by at least one of the L+W-2M unmatched 
+# characters B <= L+W-2M+1. The title therefore contains at least 3M-(L+W)-1 >= 0.4934L-1 of the bigrams in the search text.
+def getMinSearchBigramHits(length):
+  return max(0, math.floor(0.49 * length - 1))
+
+# The titles of a schedule entry that are searched, the show title is searched either with or without the original title depending on --originaltitle
+SEARCH_TEXT_SHOW_TITLE = 0
+SEARCH_TEXT_ORIGINAL_SHOW_TITLE = 1
+SEARCH_TEXT_TITLE = 2
+SEARCH_TEXT_SERIES_TITLE = 3
+SEARCH_TEXT_ORIGINAL_TITLE = 4
+
+def createSearchTexts(schedule_item):
+  texts = {}
+  if isinstance(schedule_item.get('title'), str):
+    texts[SEARCH_TEXT_SHOW_TITLE] = createShowTitle(schedule_item, False).lower()
+    texts[SEARCH_TEXT_ORIGINAL_SHOW_TITLE] = createShowTitle(schedule_item, True).lower()
+    texts[SEARCH_TEXT_TITLE] = schedule_item['title'].lower()
+  if isinstance(schedule_item.get('series_title'), str):
+    texts[SEARCH_TEXT_SERIES_TITLE] = schedule_item['series_title'].lower()
+  if isinstance(schedule_item.get('original-title'), str):
+    texts[SEARCH_TEXT_ORIGINAL_TITLE] = schedule_item['original-title'].lower()
+  return texts
+
+# Determine if this program is an english sub program
+def isEnglishSubtitlesEntry(schedule_item):
+  return ( 'series_title' in schedule_item and 
+           ( fuzz.partial_ratio( 'with english subtitles', schedule_item['series_title'].lower() ) > 85 or
+             fuzz.partial_ratio( 'english subtitles', schedule_item['series_title'].lower() ) > 85
+           ))
+
+# Flags precomputed for each entry in the search index
+SEARCH_FLAG_ENGLISH_SUBTITLES = 1
+
+#
+# Sqlite database used by --find to search the titles in the tv schedule. Every distinct title is stored once, in lower case and folded to ascii,
+# along with the pairs of adjacent characters (bigrams) in the folded title. A search first selects the titles that contain enough of the 
+# bigrams in the search text to possibly be similar to it and then only compares those titles to the search text. The index is kept up to date 
+# with the schedule by update(), which only indexes the entries whose titles have changed.
+class TvScheduleSearchIndex:
+  # Increase when the layout of the tables changes, databases with an older layout are recreated
+  SCHEMA_VERSION = 1
+
+  def __init__(self, db_file_name):
+    os.makedirs(os.path.dirname(os.path.abspath(db_file_name)), exist_ok=True)
+    self.conn = sqlite3.connect(db_file_name)
+
+    if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+      self.conn.executescript("""
+        DROP TABLE IF EXISTS entries;
+        DROP TABLE IF EXISTS entry_texts;
+        DROP TABLE IF EXISTS texts;
+        DROP TABLE IF EXISTS bigrams;
+        DROP TABLE IF EXISTS meta;
+      """)
+      self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    self.conn.executescript("""
+      CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+      CREATE TABLE IF NOT EXISTS entries (pid TEXT PRIMARY KEY, source TEXT NOT NULL, flags INTEGER NOT NULL) WITHOUT ROWID;
+      CREATE TABLE IF NOT EXISTS entry_texts (pid TEXT NOT NULL, kind INTEGER NOT NULL, text_id INTEGER NOT NULL, PRIMARY KEY (pid, kind)) WITHOUT ROWID;
+      CREATE TABLE IF NOT EXISTS texts (id INTEGER PRIMARY KEY, text TEXT NOT NULL UNIQUE, folded TEXT NOT NULL, length INTEGER NOT NULL);
+      CREATE TABLE IF NOT EXISTS bigrams (bigram INTEGER NOT NULL, text_id INTEGER NOT NULL, PRIMARY KEY (bigram, text_id)) WITHOUT ROWID;
+      CREATE INDEX IF NOT EXISTS idx_entry_texts_text ON entry_texts (text_id);
+      CREATE INDEX IF NOT EXISTS idx_texts_length ON texts (length);
+    """)
+
+  # The fields that the searched titles and flags are created from, the entry is indexed again when any of them change
+  @staticmethod
+  def __createSource(schedule_item):
+    return '\x1f'.join(str(schedule_item.get(key)) for key in ('title', 'series_title', 'original-title'))
+
+  # Identifies the set of entries that was last indexed
+  @staticmethod
+  def __createPidsStamp(pids):
+    return hashlib.sha1('\n'.join(sorted(pids)).encode('utf-8')).hexdigest()
+
+  @staticmethod
+  def __getPids(schedule):
+    return [schedule_item['pid'] for key, schedule_item in schedule.items() if not key in TV_SCHEDULE_METADATA_KEYS and isinstance(schedule_item, Mapping) and 'pid' in schedule_item]
+
+  def __getMeta(self, key):
+    row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if not row is None else None
+
+  def __getTextId(self, text):
+    row = self.conn.execute("SELECT id FROM texts WHERE text = ?", (text,)).fetchone()
+    if not row is None:
+      return row[0]
+
+    folded = foldSearchText(text)
+    text_id = self.conn.execute("INSERT INTO texts (text, folded, length) VALUES (?, ?, ?)", (text, folded, len(folded))).lastrowid
+    self.conn.executemany("INSERT INTO bigrams (bigram, text_id) VALUES (?, ?)", [(bigram, text_id) for bigram in createSearchBigrams(folded)])
+    return text_id
+
+  # Brings the index up to date with the full schedule, entries that are no longer in the schedule are removed. Returns the number of entries indexed
+  def update(self, schedule):
+    existing_sources = dict(self.conn.execute("SELECT pid, source FROM entries").fetchall())
+    pids = set()
+    changed = []
+    for key, schedule_item in schedule.items():
+      if key in TV_SCHEDULE_METADATA_KEYS or not isinstance(schedule_item, Mapping) or not 'pid' in schedule_item:
+        continue
+      pids.add(schedule_item['pid'])
+      source = TvScheduleSearchIndex.__createSource(schedule_item)
+      if existing_sources.get(schedule_item['pid']) != source:
+        changed.append((schedule_item, source))
+
+    removed = [pid for pid in existing_sources if not pid in pids]
+    pids_stamp = TvScheduleSearchIndex.__createPidsStamp(pids)
+    if len(changed) <= 0 and len(removed) <= 0:
+      if self.__getMeta('pids') != pids_stamp:
+        with self.conn:
+          self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pids', ?)", (pids_stamp,))
+      return 0
+
+    if len(existing_sources) <= 0:
+      print(color_info("Building the search index")+ f" | {len(changed)} shows")
+
+    with self.conn:
+      outdated = removed + [schedule_item['pid'] for schedule_item, _ in changed if schedule_item['pid'] in existing_sources]
+      executeSqliteInChunks(self.conn, "DELETE FROM entries WHERE pid IN ({0})", outdated)
+      executeSqliteInChunks(self.conn, "DELETE FROM entry_texts WHERE pid IN ({0})", outdated)
+
+      for schedule_item, source in changed:
+        flags = SEARCH_FLAG_ENGLISH_SUBTITLES if isEnglishSubtitlesEntry(schedule_item) else 0
+        self.conn.execute("INSERT INTO entries (pid, source, flags) VALUES (?, ?, ?)", (schedule_item['pid'], source, flags))
+        self.conn.executemany("INSERT INTO entry_texts (pid, kind, text_id) VALUES (?, ?, ?)", 
+                              [(schedule_item['pid'], kind, self.__getTextId(text)) for kind, text in createSearchTexts(schedule_item).items()])
+
+      # Titles that are no longer used by any entry are removed along with their bigrams
+      for text_id, folded in self.conn.execute("SELECT id, folded FROM texts WHERE NOT id IN (SELECT text_id FROM entry_texts)").fetchall():
+        self.conn.executemany("DELETE FROM bigrams WHERE bigram = ? AND text_id = ?", [(bigram, text_id) for bigram in createSearchBigrams(folded)])
+        self.conn.execute("DELETE FROM texts WHERE id = ?", (text_id,))
+
+      self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pids', ?)", (pids_stamp,))
+
+    return len(changed)
+
+  # Updates the index only if the schedule does not have the same entries as when it was last indexed, the titles of the entries 
+  # are only compared by update() which is used whenever the schedule is refreshed
+  def sync(self, schedule):
+    if self.__getMeta('pids') == TvScheduleSearchIndex.__createPidsStamp(TvScheduleSearchIndex.__getPids(schedule)):
+      return 0
+    return self.update(schedule)
+
+  # Searches for the entries with a title similar to the search text, returns a dictionary of the pids found and their flags
+  def find(self, search_text, include_original_title=False):
+    search_text = search_text.lower()
+    folded_search_text = foldSearchText(search_text)
+    search_bigrams = createSearchBigrams(folded_search_text)
+    min_hits = getMinSearchBigramHits(len(folded_search_text))
+
+    if min_hits <= 0:
+      rows = self.conn.execute("SELECT id, text, folded FROM texts").fetchall()
+    else:
+      self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS search_bigrams (bigram INTEGER PRIMARY KEY, hits INTEGER NOT NULL)")
+      self.conn.execute("DELETE FROM search_bigrams")
+      self.conn.executemany("INSERT INTO search_bigrams (bigram, hits) VALUES (?, ?)", search_bigrams.items())
+      # Titles shorter than the search text are compared against parts of the search text instead and are always candidates
+      rows = self.conn.execute("""
+        SELECT id, text, folded FROM texts WHERE id IN (
+          SELECT b.text_id FROM bigrams b JOIN search_bigrams s ON b.bigram = s.bigram GROUP BY b.text_id HAVING SUM(s.hits) >= ?)
+        UNION
+        SELECT id, text, folded FROM texts WHERE length < ?
+      """, (min_hits, len(folded_search_text))).fetchall()
+
+    # The titles are compared both folded and as they are, the second comparison is skipped when folding did not change anything
+    is_search_text_folded = folded_search_text != search_text
+    matched_text_ids = [text_id for text_id, text, folded in rows 
+                          if fuzz.partial_ratio( folded_search_text, folded ) > SEARCH_MIN_PARTIAL_RATIO or 
+                             ((is_search_text_folded or folded != text) and fuzz.partial_ratio( search_text, text ) > SEARCH_MIN_PARTIAL_RATIO)]
+
+    excluded_kind = SEARCH_TEXT_SHOW_TITLE if include_original_title else SEARCH_TEXT_ORIGINAL_SHOW_TITLE
+    found = executeSqliteInChunks(self.conn, "SELECT e.pid, e.flags FROM entry_texts t JOIN entries e ON e.pid = t.pid WHERE t.text_id IN ({0}) AND t.kind != ?", matched_text_ids, excluded_kind)
+    return dict(found)
+
+# Opens the search index used by --find, returns None if the index cannot be used
+def openTvScheduleSearchIndex(args):
+  try:
+    return TvScheduleSearchIndex(createFullConfigFileName(args.portable, TV_SCHEDULE_SEARCH_DB_FILE))
+  except sqlite3.Error as ex:
+    print(color_warn(f"Could not open the search index, searching the full schedule instead, {ex}"))
+    return None
 
-def searchForItemsInTvSchedule(args, schedule):
+def searchForItemsInTvSchedule(args, schedule, search_index=None):
   download_list = []
+
+  # The search index finds the matching titles without comparing the search text to every title in the schedule
+  found_pids = None
+  if args.sid is None and args.pid is None and args.find is not None and not search_index is None:
+    try:
+      search_index.sync(schedule)
+      found_pids = search_index.find(args.find, args.originaltitle)
+    except sqlite3.Error as ex:
+      print(color_warn(f"Could not use the search index, searching the full schedule instead, {ex}"))
     
   for key, schedule_item in schedule.items():
   
@@ -1342,6 +3874,9 @@ def searchForItemsInTvSchedule(args, schedule):
     elif( args.pid is not None ):
       if( 'pid' in schedule_item and schedule_item['pid'] in args.pid):
         candidate_to_add = schedule_item
+    elif( found_pids is not None ):
+      if( schedule_item['pid'] in found_pids ):
+        candidate_to_add = schedule_item
     elif( args.find is not None ):
       if( 'title' in schedule_item and fuzz.partial_ratio( args.find.lower(), createShowTitle(schedule_item, args.originaltitle).lower() ) > 85 ):
         candidate_to_add = schedule_item
@@ -1361,13 +3896,12 @@ def searchForItemsInTvSchedule(args, schedule):
       if( not 'ep_num' in schedule_item or not 'ep_total' in schedule_item or int( schedule_item['ep_total']) < 2 or int(schedule_item['ep_num']) > 1 ):
         candidate_to_add = None # If the show is beyond ep 1 then it cannot be considered a new show so i'm not going to add it
 
-    # Determine if this program is an english sub program and exclude it unless explicitly told to include
-    if( not args.includeenglishsubs and
-        'series_title' in schedule_item and 
-        ( fuzz.partial_ratio( 'with english subtitles', schedule_item['series_title'].lower() ) > 85 or
-         fuzz.partial_ratio( 'english subtitles', schedule_item['series_title'].lower() ) > 85
-        )):
-      continue
+    # Exclude english sub programs unless explicitly told to include them
+    if( candidate_to_add is not None and not args.includeenglishsubs ):
+      if( found_pids is not None and found_pids[schedule_item['pid']] & SEARCH_FLAG_ENGLISH_SUBTITLES ):
+        continue
+      if( found_pids is None and isEnglishSubtitlesEntry(schedule_item) ):
+        continue
 
     # Now process the adding of the show if all the filter criteria were satisified
     if( candidate_to_add is not None ):
@@ -1376,7 +3910,45 @@ def searchForItemsInTvSchedule(args, schedule):
   return download_list
 
 
-def getVodSearchResults(search_query):
+#
+# Cache of the results of searches performed with the RUV GraphQL api, keyed by the lower case search text. The results are stored in a single
+# file with the time they were retrieved and are only used for a short while, so that running the same --find repeatedly does not search again
+class VodSearchResultCache:
+  def __init__(self, cache_file_name, max_age_minutes=VOD_SEARCH_CACHE_MAX_AGE_MINUTES):
+    self.cache_file_name = cache_file_name
+    self.max_age = max_age_minutes * 60
+
+  @staticmethod
+  def createKey(search_query):
+    return str(search_query).strip().lower()
+
+  def __loadEntries(self):
+    entries = getExistingJsonFile(self.cache_file_name) if os.path.isfile(self.cache_file_name) else None
+    if not isinstance(entries, dict):
+      return {}
+    cutoff = time.time() - self.max_age
+    return {key: entry for key, entry in entries.items() if isinstance(entry, dict) and entry.get('time', 0) >= cutoff and 'results' in entry}
+
+  # Returns the cached results for the search or None if there are no recent results
+  def load(self, search_query):
+    entry = self.__loadEntries().get(VodSearchResultCache.createKey(search_query))
+    return entry['results'] if not entry is None else None
+
+  # Stores the results of the search, expired entries are removed from the file at the same time
+  def store(self, search_query, results):
+    entries = self.__loadEntries()
+    entries[VodSearchResultCache.createKey(search_query)] = {'time': time.time(), 'results': results}
+    try:
+      writeFileAtomically(self.cache_file_name, lambda out_file: out_file.write(json.dumps(entries, ensure_ascii=False)))
+    except Exception as ex:
+      print(f"Could not store the search results for '{search_query}', {ex}")
+
+def getVodSearchResults(search_query, search_cache=None):
+
+  if not search_cache is None:
+    cached_results = search_cache.load(search_query)
+    if not cached_results is None:
+      return cached_results
 
   search_graphdata = '?operationName=getSearch&variables={"type":"tv","text":"'+str(search_query)+'"}&extensions={"persistedQuery":{"version":1,"sha256Hash":"823f9e99e09dadeca8896ea9f29374429e6fc3c4be2d2c2a93e7ce6dc65eec41"}}'
   data = requestsVodDataRetrieveWithRetries(search_graphdata)
@@ -1385,6 +3957,9 @@ def getVodSearchResults(search_query):
     print("Error: Could not retrieve search results from GraphQL url, unable to search for VOD details for query: "+str(search_query))
     return None
 
+  if not search_cache is None:
+    search_cache.store(search_query, data['data']['Search'])
+
   return data['data']['Search']
 
 def createSeriesIdIndex(schedule):
@@ -1403,6 +3978,173 @@ def createSeriesIdIndex(schedule):
   return series_index
   
     
+# Downloads the video, artworks and subtitles for a single show in the download list, returns the file name of the downloaded video 
+# or None if no video was downloaded
+def downloadScheduleItem(args, item, display_title, ffmpegexec, previously_recorded, previously_recorded_file_name, resume_dir):
+  # Get a valid name for the save file
+  local_filename = createLocalFileName(item, args.originaltitle, args.plex, args.suffix)
+
+  # If the output directory is set then check if it exists and create it if it is not
+  # pre-pend it to the file name then
+  if( args.output is not None ):
+    if not os.path.exists(args.output):
+      os.makedirs(args.output, exist_ok=True)
+    # Now prepend the directory to the filename
+    local_filename = os.path.join(args.output, local_filename)
+
+  # Check to see if the directory structure up to the final filename exists (in case the original local_filename included directories)
+  if not os.path.exists(local_filename):
+    Path(local_filename).parent.mkdir(parents=True, exist_ok=True)
+
+  #############################################
+  # First download the URL for the listing if needed
+  # Normally the url has already been resolved for all the episodes in the series by resolveVodEpisodeUrls
+  if not hasVodFileUrl(item):
+    data = requestsVodDataRetrieveWithRetries(createProgramTypeQuery(item['sid'], [item['pid']]))     
+    if data is None or len(data) < 1:
+      print("Error: Could not retrieve episode download url, unable to download VOD details, skipping "+item['title'])
+      return None
+    
+    if not data or not 'data' in data or not 'Program' in data['data'] or not 'episodes' in data['data']['Program'] or len(data['data']['Program']['episodes']) < 1:
+      print("Error: Could not retrieve episode download url, VOD did not return any data, skipping "+item['title'])
+      return None
+
+    ep_data = data['data']['Program']['episodes'][0] # First and only item
+    vod_url_full = ep_data['file']
+  else:
+    vod_url_full = item['file']
+
+  try:
+    item['vod_url_full'] = vod_url_full
+
+    # Store any references to subtitle files if available
+    if not 'subtitles' in item and item['subtitles'] is None:
+      item['subtitles'] = ep_data['subtitles'] if 'subtitles' in ep_data else None
+
+    # If no VOD code can be found then this cannot be downloaded
+    if vod_url_full is None:
+      print("Error: Could not locate VOD download URL in VOD data, skipping "+item['title'])
+      return None
+
+    # Get the base of the VOD url
+    item['vod_url'] = getGroup(RE_VOD_BASE_URL, 'vodbase', vod_url_full)
+
+  except:
+    print("Error: Could not retrieve episode download url due to parsing error in VOD data, skipping "+item['title'])
+    return None
+
+  result = None
+  reserved_filename = None
+  try:
+    if not args.novideo:
+      # If the file has already been registered as downloaded then don't attempt to re-download
+      if( not args.force and item['pid'] in previously_recorded ):
+        print("'{0}' already recorded (pid={1})".format(color_title(display_title), item['pid']))
+        cleanupDownloadResumeState(resume_dir, item['pid'])
+        return None
+
+      # Before we attempt to download the file we should make sure we're not accidentally overwriting an existing file
+      # or a file that another concurrent download is writing to
+      if( not args.force and not args.checklocal):
+        reserved_filename = reserveUniqueLocalFileName(local_filename)
+        if reserved_filename is None:
+          print("Error: unabled to create a local file name for '{0}', check your output folder (pid={1})".format(color_title(display_title), item['pid']))
+          return None
+        local_filename = reserved_filename
+
+      # If the checklocal option is enabled then we don't want to try to download unless force is set
+      if( not args.force and args.checklocal and not isLocalFileNameUnique(local_filename) ):
+        # Store the id as already recorded and save to the file 
+        print("'{0}' found locally and marked as already recorded (pid={1})".format(color_title(display_title), item['pid']))
+        appendNewPidAndSavePreviouslyRecordedShows(item['pid'], previously_recorded, previously_recorded_file_name)
+        cleanupDownloadResumeState(resume_dir, item['pid'])
+        return None
+
+      #############################################
+      # We will rely on ffmpeg to do the playlist download and merging for us
+      # the tool is much better suited to this than manually merging as there
+      # are always some corruption issues in the merged stream if done in code
+      
+      # Get the correct playlist url
+      playlist_data = find_m3u8_playlist_url(item, display_title, args.quality)
+      if playlist_data is None:
+        print("Error: Could not download show playlist, not found on server. Try requesting a different video quality.")
+        return None
+
+      #print(playlist_data
+      # Either download the segments ourselves and have FFMPEG remux them locally or ask FFMPEG to download and remux all the fragments for us,
+      # encrypted streams are always handed to FFMPEG
+      download_stats = {}
+      if args.hlsengine == 'native' and not playlist_data['playlist']['encrypted'] and len(playlist_data['playlist']['segments']) > 0:
+        result = download_m3u8_playlist_using_native(ffmpegexec, playlist_data['playlist'], local_filename, display_title, args.keeppartial, args.nometadata, item, args.segmentworkers, resume_dir, download_stats)
+      else:
+        # ffmpeg reads the playlist that was already downloaded from a local file
+        local_playlist_file_name = writeLocalM3u8Playlist(playlist_data['playlist'], local_filename)
+        try:
+          result = download_m3u8_playlist_using_ffmpeg(ffmpegexec, local_playlist_file_name, playlist_data['playlist']['duration'], local_filename, display_title, args.keeppartial, args.quality, args.nometadata, item, args.stalltimeout, download_stats)
+        finally:
+          os.remove(local_playlist_file_name)
+      if( not result is None ):
+        LOCAL_FILE_INVENTORY.add(local_filename)
+        # if everything was OK then save the pid as successfully downloaded
+        appendNewPidAndSavePreviouslyRecordedShows(item['pid'], previously_recorded, previously_recorded_file_name) 
+        cleanupDownloadResumeState(resume_dir, item['pid'])
+        # Without the progress bars there is no other indication that the download finished
+        if not SHOW_PROGRESS_BARS:
+          print("{0} | Complete -> {1}".format(color_title(display_title), result))
+        printDownloadThroughput(download_stats.get('bytes', 0), download_stats.get('elapsed_seconds', 0), download_stats.get('cpu_seconds'))
+  finally:
+    if not reserved_filename is None:
+      releaseLocalFileName(reserved_filename)
+
+  # Attempt to download artworks if available but only when plex is selected
+  if args.novideo:
+    print("Downloading only artworks and subtitle files")
+
+  if args.plex : 
+    if( item['is_movie'] or item['is_docu']):
+      downloadMoviePoster(local_filename, display_title, item, Path(args.output))
+    else: 
+      downloadTVShowPoster(local_filename, display_title, item, Path(args.output))
+
+  # Attempt to download any subtitles if available 
+  if not item['subtitles'] is None and len(item['subtitles']) > 0:
+    try:
+      downloadSubtitlesFiles(item['subtitles'], local_filename, display_title, item)
+    except Exception as ex:
+      print("Error: Could not download subtitle files for item, "+item['title'])
+      print(ex)
+      traceback.print_stack()
+
+  return result
+
+# Downloads several shows at the same time, the progress bars are turned off as they cannot be drawn for more than one download.
+# Returns the file names of the downloaded videos
+def downloadScheduleItemsConcurrently(download_list, download_item, max_workers):
+  global SHOW_PROGRESS_BARS
+  SHOW_PROGRESS_BARS = False
+
+  downloaded_files = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = {executor.submit(download_item, item_number, item): item for item_number, item in enumerate(download_list, 1)}
+    try:
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          local_filename = future.result()
+          if not local_filename is None:
+            downloaded_files.append(local_filename)
+        except Exception:
+          # A failed show should not stop the other downloads
+          print(color_error("Error while downloading {0} (pid={1})".format(futures[future]['title'], futures[future]['pid'])))
+          print(traceback.format_exc())
+    except KeyboardInterrupt:
+      # Stop the downloads that are running and skip the ones that have not started
+      DOWNLOADS_CANCELLED.set()
+      executor.shutdown(wait=True, cancel_futures=True)
+      raise
+
+  return downloaded_files
+
 # The main entry point for the script
 def runMain():
   try:
@@ -1416,42 +4158,83 @@ def runMain():
     # Construct the argument parser for the commandline
     args = parseArguments()
 
+    # Share a single keep-alive connection pool between all requests, make sure there are enough connections for all the workers
+    configureHttpPool(max(args.poolsize, args.refreshworkers, args.segmentworkers * max(1, args.parallel)))
+
+    # All transfers share a single bandwidth limit
+    global BANDWIDTH_LIMITER
+    if not args.maxrate is None:
+      try:
+        BANDWIDTH_LIMITER = BandwidthLimiter(parseMaxRateSchedule(args.maxrate), createFullConfigFileName(args.portable, BANDWIDTH_LEASE_DIR))
+      except (ValueError, IndexError):
+        print(color_error("Invalid --maxrate value '{0}'".format(args.maxrate)))
+        sys.exit(1)
+
+    # The files in the output folders are listed once and the listings are reused until the folders change
+    global LOCAL_FILE_INVENTORY
+    LOCAL_FILE_INVENTORY = LocalFileInventory(createFullConfigFileName(args.portable, OUTPUT_INVENTORY_FILE))
+
+    # Responses from the RUV program API are cached and revalidated on the next refresh
+    global HTTP_RESPONSE_CACHE
+    HTTP_RESPONSE_CACHE = HttpResponseCache(createFullConfigFileName(args.portable, HTTP_CACHE_DIR))
+
     # Get ffmpeg exec
     ffmpegexec = findffmpeg(args.ffmpeg, working_dir)
 
     # Create the full filenames for the config files
     previously_recorded_file_name = createFullConfigFileName(args.portable,PREV_LOG_FILE)
-    tv_schedule_file_name = createFullConfigFileName(args.portable,TV_SCHEDULE_LOG_FILE)
+    schedule_store = createTvScheduleStore(args)
+    resume_dir = createFullConfigFileName(args.portable, RESUME_DIR)
     
     # Get information about already downloaded episodes
     previously_recorded = getPreviouslyRecordedShows(previously_recorded_file_name)
 
-    # Get an existing tv schedule if possible
-    schedule = getExistingTvSchedule(tv_schedule_file_name)
+    # Get an existing tv schedule if possible, when only looking up series or episode ids there is no need to load the full schedule 
+    # (the find search looks through all the series and needs the full schedule)
+    if not args.refresh and args.find is None and (not args.sid is None or not args.pid is None):
+      schedule = schedule_store.load(pids=args.pid if args.sid is None else None, sids=args.sid)
+    else:
+      schedule = schedule_store.load()
     
     if( args.refresh or schedule is None  ):
     
-      # Only load the IMDB data if we are refreshing the schedule
-      imdb_orignal_titles = loadImdbOriginalTitles(args.imdbfolder)
+      # Only load the IMDB data if we are refreshing the schedule and a series is not already in the IMDB cache
+      imdb_title_search_db_file_name = createFullConfigFileName(args.portable, IMDB_TITLE_SEARCH_DB_FILE)
+      imdb_orignal_titles = LazyImdbOriginalTitles(args.imdbfolder, createFullConfigFileName(args.portable, IMDB_TITLE_INDEX_FILE), imdb_title_search_db_file_name)
+      global IMDB_TITLE_SEARCH_INDEX
+      IMDB_TITLE_SEARCH_INDEX = LazyImdbTitleSearchIndex(imdb_orignal_titles, imdb_title_search_db_file_name)
       imdb_cache_file_name = createFullConfigFileName(args.portable, IMDB_CACHE_FILE)
-      imdb_cache = getExistingJsonFile(imdb_cache_file_name)
-      if( imdb_cache is None ):
-        imdb_cache = {}
+      imdb_cache = ImdbLookupCache.load(imdb_cache_file_name, args.imdbcachedays, args.imdbmisscachedays)
 
       # Only clear out the schedule if we are not dealing with an incremental update
-      # or if the dates don't match anymore 
-      if not args.incremental or schedule['date'].date() < today or args.force:
+      # or if the last full refresh is too old, the periodic full refresh is a safety net for anything the incremental refresh misses
+      if not args.incremental or args.force or not isIncrementalRefreshPossible(schedule):
         schedule = {}
       
       # Downloading the full VOD available schedule as well, signal an incremental update if the schedule object has entries in it
-      schedule = getVodSchedule(schedule, len(schedule) > 0, imdb_cache, imdb_orignal_titles) 
+      schedule = getVodSchedule(schedule, len(schedule) > 0, imdb_cache, imdb_orignal_titles, args.refreshworkers) 
     
       # Save the tv schedule as the most current one, save it to ensure we format the today date
       if len(schedule) > 1 :
-        saveCurrentTvSchedule(schedule, tv_schedule_file_name)
+        schedule_store.save(schedule)
+        search_index = openTvScheduleSearchIndex(args)
+        try:
+          if not search_index is None:
+            search_index.update(schedule)
+        except sqlite3.Error as ex:
+          print(color_warn(f"Could not update the search index, {ex}"))
 
-      if len(imdb_cache) > 0:
-        saveImdbCache(imdb_cache, imdb_cache_file_name)
+      imdb_cache.save(imdb_cache_file_name)
+      imdb_cache.printStats()
+      imdb_orignal_titles.printStats()
+      IMDB_TITLE_SEARCH_INDEX.printStats()
+
+      if not HTTP_RESPONSE_CACHE is None:
+        HTTP_RESPONSE_CACHE.evict()
+        HTTP_RESPONSE_CACHE.printStats()
+
+      printHttpPoolStats()
+      VOD_GRAPHQL_CLIENT.printStats()
 
     if( args.debug ):
       for key, schedule_item in schedule.items():
@@ -1459,7 +4242,8 @@ def runMain():
 
     ########
     # Now determine what to download
-    download_list = searchForItemsInTvSchedule(args, schedule)
+    search_index = openTvScheduleSearchIndex(args) if not args.find is None else None
+    download_list = searchForItemsInTvSchedule(args, schedule, search_index)
     total_items = len(download_list)
 
     # Perform an optimistic search for the item and see if any of the results returned are series that have not been indexed, if so then index them
@@ -1470,30 +4254,38 @@ def runMain():
         # Create an inverse index for series ids for faster lookups
         series_index = createSeriesIdIndex(schedule)
 
-        # Get the list of sids to check on, either from args.find or args.sid (args.sid can be an array of sids
-        search_sids = []
+        # Get the list of series to check on, either from args.find or args.sid (args.sid can be an array of sids
+        search_programs = []
 
         if not args.find is None:
           # For each of the series returned see if its series id is present in the current schedule, if not then perform a full program download for all episodes and search again
-          search_results = getVodSearchResults(args.find)
-          for search_result in search_results:
+          search_results = getVodSearchResults(args.find, VodSearchResultCache(createFullConfigFileName(args.portable, VOD_SEARCH_CACHE_FILE)))
+          for search_result in (search_results if not search_results is None else []):
             search_sid = search_result['id'] if 'id' in search_result and search_result['id'] is not None and len(search_result['id']) > 0 else None
-            search_sids.append(search_sid)
+            search_programs.append({'id': search_sid, 'title': search_result['title'] if 'title' in search_result and not search_result['title'] is None else search_sid})
         elif not args.sid is None:
-          search_sids = args.sid
+          search_programs = [{'id': search_sid, 'title': search_sid} for search_sid in args.sid]
 
-        # Now iterate through the sids and attempt to download series information
-        for search_sid in search_sids:
-          if( search_sid is None):
-              continue
-          
-          if search_sid in series_index:
+        # Only the series that are not already in the schedule are downloaded, each series only once
+        programs_to_fetch = []
+        for program in search_programs:
+          if program['id'] is None or program['id'] in series_index:
             continue
-
-          # If the sid is directly specified then we just get that directly
-          program_schedule = getVodSeriesSchedule(search_sid, None, None, None)
+          series_index[program['id']] = True
+          programs_to_fetch.append(program)
+
+        # The series are downloaded concurrently and added to the schedule, which is saved once below. The series are added to the series index 
+        # of the schedule as well so that the next incremental refresh updates them and removes them once they are no longer available.
+        # The incremental refresh compares the number of episodes the api reports for the series, not the number of episodes in the schedule, 
+        # so the index stores the number from the series data (see parseVodSeriesSchedule)
+        schedule_series_index = schedule.setdefault('series_index', {})
+        for program, program_schedule in zip(programs_to_fetch, getVodSeriesSchedules(programs_to_fetch, None, None, max(SEARCH_SERIES_WORKERS, args.refreshworkers))):
           if not program_schedule is None and len(program_schedule) > 0:
             schedule.update(program_schedule)
+            schedule_series_index[str(program['id'])] = {
+              'web_available_episodes': next(iter(program_schedule.values())).get('web_available_episodes', len(program_schedule)),
+              'pids': list(program_schedule.keys())
+            }
             any_series_found_while_searching = True
 
       except Exception as ex:
@@ -1506,9 +4298,9 @@ def runMain():
       
       # Save the tv schedule as the most current one
       if len(schedule) > 1 :
-        saveCurrentTvSchedule(schedule, tv_schedule_file_name)
+        schedule_store.save(schedule, prune=False)
 
-      download_list = searchForItemsInTvSchedule(args, schedule)
+      download_list = searchForItemsInTvSchedule(args, schedule, search_index)
       total_items = len(download_list)
 
     # Now check for matches and if nothing is found exit
@@ -1529,130 +4321,36 @@ def runMain():
         printTvShowDetails(args, item)
       sys.exit(0)
     
-    curr_item = 1
-    for item in download_list:
-      # Get a valid name for the save file
-      local_filename = createLocalFileName(item, args.originaltitle, args.plex, args.suffix)
-      
-      # Create the display title for the current episode (used in console output)
-      display_title = "{0} of {1}: {2}".format(curr_item, total_items, createShowTitle(item, args.originaltitle)) 
-      curr_item += 1 # Count the file
-
-      # If the output directory is set then check if it exists and create it if it is not
-      # pre-pend it to the file name then
-      if( args.output is not None ):
-        if not os.path.exists(args.output):
-          os.makedirs(args.output, exist_ok=True)
-        # Now prepend the directory to the filename
-        local_filename = os.path.join(args.output, local_filename)
-
-      # Check to see if the directory structure up to the final filename exists (in case the original local_filename included directories)
-      if not os.path.exists(local_filename):
-        Path(local_filename).parent.mkdir(parents=True, exist_ok=True)
-
-      #############################################
-      # First download the URL for the listing if needed
-      if not 'file' in item or item['file'] is None or len(item['file']) < 1 or not str(item['file']).startswith(RUV_URL):
-        ep_graphdata = '?operationName=getProgramType&variables={"id":'+str(item['sid'])+',"episodeId":["'+str(item['pid'])+'"]}&extensions={"persistedQuery":{"version":1,"sha256Hash":"9d18a07f82fcd469ad52c0656f47fb8e711dc2436983b53754e0c09bad61ca29"}}'
-        data = requestsVodDataRetrieveWithRetries(ep_graphdata)     
-        if data is None or len(data) < 1:
-          print("Error: Could not retrieve episode download url, unable to download VOD details, skipping "+item['title'])
-          continue
-        
-        if not data or not 'data' in data or not 'Program' in data['data'] or not 'episodes' in data['data']['Program'] or len(data['data']['Program']['episodes']) < 1:
-          print("Error: Could not retrieve episode download url, VOD did not return any data, skipping "+item['title'])
-          continue
-
-        ep_data = data['data']['Program']['episodes'][0] # First and only item
-        vod_url_full = ep_data['file']
-      else:
-        vod_url_full = item['file']
-
-      try:
-        item['vod_url_full'] = vod_url_full
-
-        # Store any references to subtitle files if available
-        if not 'subtitles' in item and item['subtitles'] is None:
-          item['subtitles'] = ep_data['subtitles'] if 'subtitles' in ep_data else None
-
-        # If no VOD code can be found then this cannot be downloaded
-        if vod_url_full is None:
-          print("Error: Could not locate VOD download URL in VOD data, skipping "+item['title'])
-          continue
-
-        # Get the base of the VOD url
-        item['vod_url'] = getGroup(RE_VOD_BASE_URL, 'vodbase', vod_url_full)
-
-      except:
-        print("Error: Could not retrieve episode download url due to parsing error in VOD data, skipping "+item['title'])
-        continue
-
-      if not args.novideo:
-        # If the file has already been registered as downloaded then don't attempt to re-download
-        if( not args.force and item['pid'] in previously_recorded ):
-          print("'{0}' already recorded (pid={1})".format(color_title(display_title), item['pid']))
-          continue
-
-        # Before we attempt to download the file we should make sure we're not accidentally overwriting an existing file
-        if( not args.force and not args.checklocal):
-          # So, check for the existence of a file with the same name, if one is found then attempt to give
-          # our new file a different name and check again (append date and time), if still not unique then 
-          # create file name with guid, if still not unique then fail!
-          if( not isLocalFileNameUnique(local_filename) ):
-            # Check with date
-            local_filename = "{0}_{1}.mp4".format(local_filename.split(".mp4")[0], datetime.datetime.now().strftime("%Y-%m-%d"))
-            if( not isLocalFileNameUnique(local_filename)):
-              local_filename = "{0}_{1}.mp4".format(local_filename.split(".mp4")[0], str(uuid.uuid4()))
-              if( not isLocalFileNameUnique(local_filename)):      
-                print("Error: unabled to create a local file name for '{0}', check your output folder (pid={1})".format(color_title(display_title), item['pid']))
-                continue
-
-        # If the checklocal option is enabled then we don't want to try to download unless force is set
-        if( not args.force and args.checklocal and not isLocalFileNameUnique(local_filename) ):
-          # Store the id as already recorded and save to the file 
-          print("'{0}' found locally and marked as already recorded (pid={1})".format(color_title(display_title), item['pid']))
-          appendNewPidAndSavePreviouslyRecordedShows(item['pid'], previously_recorded, previously_recorded_file_name)
-          continue
-
-        #############################################
-        # We will rely on ffmpeg to do the playlist download and merging for us
-        # the tool is much better suited to this than manually merging as there
-        # are always some corruption issues in the merged stream if done in code
-        
-        # Get the correct playlist url
-        playlist_data = find_m3u8_playlist_url(item, display_title, args.quality)
-        if playlist_data is None:
-          print("Error: Could not download show playlist, not found on server. Try requesting a different video quality.")
-          continue
-
-        #print(playlist_data
-        # Now ask FFMPEG to download and remux all the fragments for us
-        result = download_m3u8_playlist_using_ffmpeg(ffmpegexec, playlist_data['url'], playlist_data['fragments'], local_filename, display_title, args.keeppartial, args.quality, args.nometadata, item)
-        if( not result is None ):
-          # if everything was OK then save the pid as successfully downloaded
-          appendNewPidAndSavePreviouslyRecordedShows(item['pid'], previously_recorded, previously_recorded_file_name) 
-
-      # Attempt to download artworks if available but only when plex is selected
-      if args.novideo:
-        print("Downloading only artworks and subtitle files")
-
-      if args.plex : 
-        if( item['is_movie'] or item['is_docu']):
-          downloadMoviePoster(local_filename, display_title, item, Path(args.output))
-        else: 
-          downloadTVShowPoster(local_filename, display_title, item, Path(args.output))
-
-      # Attempt to download any subtitles if available 
-      if not item['subtitles'] is None and len(item['subtitles']) > 0:
-        try:
-          downloadSubtitlesFiles(item['subtitles'], local_filename, display_title, item)
-        except Exception as ex:
-          print("Error: Could not download subtitle files for item, "+item['title'])
-          print(ex)
-          traceback.print_stack()
-          continue
+    # Look up the missing stream urls for each series in one go and keep them with the schedule
+    if resolveVodEpisodeUrls([item for item in download_list if args.force or not item['pid'] in previously_recorded]):
+      schedule_store.save(schedule, prune=False)
+
+    # Download the shows one after another or several at the same time
+    download_start_time = time.monotonic()
+    download_item = lambda item_number, item: downloadScheduleItem(args, item, "{0} of {1}: {2}".format(item_number, total_items, createShowTitle(item, args.originaltitle)), 
+                                                                   ffmpegexec, previously_recorded, previously_recorded_file_name, resume_dir)
+    if args.parallel > 1:
+      downloaded_files = downloadScheduleItemsConcurrently(download_list, download_item, args.parallel)
+    else:
+      downloaded_files = []
+      for item_number, item in enumerate(download_list, 1):
+        local_filename = download_item(item_number, item)
+        if not local_filename is None:
+          downloaded_files.append(local_filename)
+
+    if len(downloaded_files) > 0:
+      print("{0} | {1} show(s)".format(color_info('Finished'), len(downloaded_files)))
+      printDownloadThroughput(sum(os.path.getsize(file_name) for file_name in downloaded_files if os.path.isfile(file_name)), time.monotonic() - download_start_time)
+
+    printHttpPoolStats()
+    VOD_GRAPHQL_CLIENT.printStats()
     
   finally:
+    if not BANDWIDTH_LIMITER is None:
+      BANDWIDTH_LIMITER.close()
+    if not THROTTLED_SEGMENT_PROXY is None:
+      THROTTLED_SEGMENT_PROXY.close()
+    LOCAL_FILE_INVENTORY.save()
     deinit() #Deinitialize the colorama library
     
 
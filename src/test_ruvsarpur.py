@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Tests for ruvsarpur.py, run them from the src folder using
+      python -m unittest test_ruvsarpur
+"""
+
+import sys, os, time, io
+import tempfile, contextlib
+import unittest
+from unittest import mock
+
+import ruvsarpur
+
+# A master playlist in the format documented in find_m3u8_playlist_url(), the bandwidth of each stream includes the audio
+# and is higher than the bitrate of its quality
+MASTER_PLAYLIST_URL = 'https://ruv-vod.akamaized.net/opid/5234383T0/index.m3u8'
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-INDEPENDENT-SEGMENTS
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="2@48000-mp4a-0",NAME="Icelandic",LANGUAGE="is",AUTOSELECT=YES,DEFAULT=YES,CHANNELS="2",URI="audio/index.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=1277648,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=852x480,FRAME-RATE=25.000,AUDIO="2@48000-mp4a-0"
+1200/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2904238,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=1280x720,FRAME-RATE=25.000,AUDIO="2@48000-mp4a-0"
+2400/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=4406504,CODECS="avc1.640028,mp4a.40.2",RESOLUTION=1920x1080,FRAME-RATE=25.000,AUDIO="2@48000-mp4a-0"
+3600/index.m3u8
+"""
+
+class OrderM3u8VariantsTests(unittest.TestCase):
+
+  def orderedUris(self, playlist_text, video_quality):
+    variants = ruvsarpur.orderM3u8Variants(ruvsarpur.parseM3u8MasterPlaylist(playlist_text, MASTER_PLAYLIST_URL), video_quality)
+    return [variant['uri'].rsplit('/', 2)[-2] for variant in variants], variants
+
+  def test_picks_the_stream_for_each_quality(self):
+    for video_quality, code in (('HD1080', '3600'), ('HD720', '2400'), ('Normal', '1200')):
+      codes, variants = self.orderedUris(MASTER_PLAYLIST, video_quality)
+      self.assertEqual(code, codes[0], video_quality)
+      self.assertTrue(variants[0]['is_requested_quality'])
+
+  def test_picks_the_stream_by_resolution(self):
+    playlist = MASTER_PLAYLIST.replace('3600/', 'fhd/').replace('2400/', 'hd/').replace('1200/', 'sd/')
+    _, variants = self.orderedUris(playlist, 'HD1080')
+    self.assertTrue(variants[0]['uri'].endswith('/fhd/index.m3u8'))
+    self.assertTrue(variants[0]['is_requested_quality'])
+
+  def test_falls_back_to_the_highest_lower_bandwidth(self):
+    playlist = '\n'.join(MASTER_PLAYLIST.splitlines()[:-2])
+    codes, variants = self.orderedUris(playlist, 'HD1080')
+    self.assertEqual(['2400', '1200'], codes)
+    self.assertFalse(variants[0]['is_requested_quality'])
+
+  def test_falls_back_to_the_lowest_higher_bandwidth(self):
+    playlist = MASTER_PLAYLIST.replace('1200/', 'sd/').replace('RESOLUTION=852x480,', '')
+    codes, variants = self.orderedUris(playlist, 'Normal')
+    self.assertEqual(['sd', '2400', '3600'], codes)
+    self.assertFalse(variants[0]['is_requested_quality'])
+
+# A fake ffmpeg that prints a progress report every 0.1 seconds, the size grows by the given step and it exits after the given number of reports
+FAKE_FFMPEG = """
+import sys, time
+size_step, reports = int(sys.argv[1]), int(sys.argv[2])
+for i in range(reports):
+  print("total_size={0}".format(100 + i * size_step))
+  print("out_time_us=1000000")
+  print("progress=continue", flush=True)
+  time.sleep(0.1)
+"""
+
+class RunFfmpegProcessTests(unittest.TestCase):
+
+  def runFakeFfmpeg(self, size_step, reports, stall_timeout):
+    progress = {}
+    last_progress = {}
+    def isActivity(line):
+      ruvsarpur.parseFfmpegProgressLine(line, progress)
+      return ruvsarpur.isFfmpegDownloadProgressing(line, progress, last_progress)
+    start_time = time.monotonic()
+    ret = ruvsarpur.runFfmpegProcess([sys.executable, '-c', FAKE_FFMPEG, str(size_step), str(reports)], is_activity=isActivity, stall_timeout=stall_timeout)
+    return ret, time.monotonic() - start_time
+
+  def test_stops_ffmpeg_that_reports_the_same_progress(self):
+    ret, elapsed = self.runFakeFfmpeg(0, 200, stall_timeout=1)
+    self.assertTrue(ret['stalled'])
+    self.assertLess(elapsed, 5)
+
+  def test_keeps_ffmpeg_that_is_progressing(self):
+    ret, _ = self.runFakeFfmpeg(100, 20, stall_timeout=1)
+    self.assertFalse(ret['stalled'])
+    self.assertEqual(0, ret['returncode'])
+    self.assertEqual('progress=continue', ret['output'][-1])
+
+# A few lines in the title.basics.tsv format, there are two tv series called Friends with the same runtime and two movies
+# that are only told apart by their runtime
+IMDB_TITLE_BASICS = """tconst\ttitleType\tprimaryTitle\toriginalTitle\tisAdult\tstartYear\tendYear\truntimeMinutes\tgenres
+tt0096697\ttvSeries\tThe Simpsons\tThe Simpsons\t0\t1989\t\\N\t22\tAnimation,Comedy
+tt0462538\tmovie\tThe Simpsons Movie\tThe Simpsons Movie\t0\t2007\t\\N\t87\tAnimation,Comedy
+tt0118694\tmovie\tIn the Mood for Love\tFa yeung nin wah\t0\t2000\t\\N\t98\tDrama,Romance
+tt0108778\ttvSeries\tFriends\tFriends\t0\t1994\t2004\t22\tComedy,Romance
+tt9000001\ttvSeries\tFriends\tFriends\t0\t2019\t\\N\t22\tComedy
+tt9000002\tmovie\tHomecoming\tHomecoming\t0\t2019\t\\N\t137\tDocumentary
+tt9000003\tmovie\tHomecoming\tHomecoming\t0\t2019\t\\N\t91\tDrama
+"""
+
+class ImdbOfflineMatchingTests(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.folder = tempfile.TemporaryDirectory()
+    with open(os.path.join(cls.folder.name, 'title.basics.tsv'), 'w', encoding='utf-8') as tsv_file:
+      tsv_file.write(IMDB_TITLE_BASICS)
+    db_file_name = os.path.join(cls.folder.name, 'imdb-titles.db')
+    cls.original_titles = ruvsarpur.LazyImdbOriginalTitles(cls.folder.name, os.path.join(cls.folder.name, 'imdb-originaltitles.idx'), db_file_name)
+    cls.search_index = ruvsarpur.LazyImdbTitleSearchIndex(cls.original_titles, db_file_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+      cls.search_index.getIndex()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.search_index.getIndex().conn.close()
+    cls.folder.cleanup()
+
+  def setUp(self):
+    patcher = mock.patch.object(ruvsarpur, 'IMDB_TITLE_SEARCH_INDEX', self.search_index)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(ruvsarpur, 'fetchImdbSuggestions', return_value=None)
+    self.fetchImdbSuggestions = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def lookup(self, title, year, item_type='tvshow', sample_duration_sec=22*60):
+    return ruvsarpur.lookupItemInIMDB(title, year, item_type, sample_duration_sec, 10, False, self.original_titles)
+
+  def test_matches_an_exact_title_offline(self):
+    result = self.lookup('The Simpsons', None)
+    self.assertEqual('tt0096697', result['id'])
+    self.assertEqual('Exact primary title (offline)', result['foundvia'])
+    self.fetchImdbSuggestions.assert_not_called()
+
+  def test_matches_an_original_title_from_the_original_title_index(self):
+    result = self.lookup('Fa yeung nin wah', '2000', item_type='movie', sample_duration_sec=100*60)
+    self.assertEqual('tt0118694', result['id'])
+    self.assertEqual('Exact original title (offline)', result['foundvia'])
+
+  def test_breaks_ties_on_the_year(self):
+    self.assertEqual('tt0108778', self.lookup('Friends', '1994')['id'])
+    self.assertEqual('tt9000001', self.lookup('Friends', '2019')['id'])
+    self.fetchImdbSuggestions.assert_not_called()
+
+  def test_breaks_ties_on_the_runtime(self):
+    self.assertEqual('tt9000003', self.lookup('Homecoming', '2019', item_type='movie', sample_duration_sec=95*60)['id'])
+    self.fetchImdbSuggestions.assert_not_called()
+
+  def test_falls_back_to_the_api_for_an_ambiguous_title(self):
+    self.assertIsNone(self.lookup('Friends', None))
+    self.fetchImdbSuggestions.assert_called_once_with('Friends')
+
+if __name__ == '__main__':
+  unittest.main()